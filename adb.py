@@ -2,12 +2,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import binascii
+import hashlib
+import json
 import os
 import posixpath
 import re
 import shutil
 import subprocess
+import tarfile
 import tempfile
+import threading
 import time
 import traceback
 
@@ -15,6 +20,28 @@ from abc import ABCMeta, abstractmethod
 from distutils import dir_util
 
 
+# Cache of host file digests keyed by path and validated by the
+# file's size and modification time so that unchanged files are not
+# rehashed on every sync.
+_host_digests = {}
+
+
+def _host_file_digest(path):
+    """Return (size, sha1 hexdigest) for the host file path."""
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime)
+    cached = _host_digests.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            sha1.update(chunk)
+    digest = (stat.st_size, sha1.hexdigest())
+    _host_digests[path] = (key, digest)
+    return digest
+
+
 class ADBProcess(object):
     """ADBProcess encapsulates the data related to executing the adb process."""
 
@@ -491,6 +518,409 @@ class ADBHost(ADBCommand):
         return devices
 
 
+class ADBBatchResult(object):
+    """ADBBatchResult records the outcome of a single operation queued
+    in an :class:`ADBBatch`.
+
+    Until the batch has been executed, exitcode is None. Operations
+    which were not reached because an earlier checked operation
+    failed also have an exitcode of None.
+    """
+
+    def __init__(self, name, cmd, check=True):
+        #: name of the queued operation, e.g. 'rm' or 'mkdir'.
+        self.name = name
+        #: shell command or description of the operation.
+        self.cmd = cmd
+        #: boolean indicating if a failure aborts the batch.
+        self.check = check
+        #: exitcode of the operation or None if it was not run.
+        self.exitcode = None
+        #: combined stdout and stderr of the operation.
+        self.output = ''
+        #: exception raised by a host side operation.
+        self.error = None
+
+    @property
+    def ran(self):
+        """Return True if the operation was executed."""
+        return self.exitcode is not None
+
+    @property
+    def ok(self):
+        """Return True if the operation was executed successfully."""
+        return self.exitcode == 0
+
+    # The queries is_dir, exists, and is_file report their answer via
+    # the exitcode of the test.
+    value = ok
+
+    def __str__(self):
+        return ('%s: cmd: %s, exitcode: %s, output: %s, error: %s' % (
+            self.name, self.cmd, self.exitcode, self.output, self.error))
+
+
+class ADBBatch(object):
+    """ADBBatch queues file system operations on a device and executes
+    them with as few adb round trips as possible.
+
+    Consecutive shell operations are compiled into a single shell
+    script which is run with one adb shell invocation. Operations
+    which must be performed on the host, such as push or a recursive
+    chmod on devices which do not support chmod -R, split the script
+    into segments which are executed in order.
+
+    A failure of a checked operation stops the batch. The remaining
+    operations are not run and an ADBError is raised once the results
+    of the completed operations have been recorded. Unchecked
+    operations, such as rm with force=True or the is_dir, exists and
+    is_file queries, never stop the batch.
+
+    ::
+
+       with adbdevice.batch(root=True) as b:
+           b.rm('/sdcard/tests/foo', recursive=True, force=True)
+           b.mkdir('/sdcard/tests/foo', parents=True)
+           isdir = b.is_dir('/sdcard/tests/foo')
+       print isdir.value
+    """
+
+    # Longer scripts are pushed to the device rather than passed on
+    # the adb shell command line which has a limited length on older
+    # versions of adb.
+    _max_inline_script = 2048
+
+    def __init__(self, device, timeout=None, root=False):
+        """Initializes the ADBBatch object.
+
+        :param device: the :class:`ADBDevice` to operate on.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the operations should
+            be executed as root.
+        """
+        self._device = device
+        self._timeout = timeout
+        self._root = root
+        self._ops = []
+        self._marker = 'adbbatch_%s' % binascii.hexlify(os.urandom(4))
+        #: list of :class:`ADBBatchResult` in the order queued.
+        self.results = []
+        self.executed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None and not self.executed:
+            self.execute()
+        return False
+
+    def _add_shell(self, name, cmd, check):
+        result = ADBBatchResult(name, cmd, check=check)
+        self._ops.append((result, None))
+        self.results.append(result)
+        return result
+
+    def _add_host(self, name, description, func, check=True):
+        result = ADBBatchResult(name, description, check=check)
+        self._ops.append((result, func))
+        self.results.append(result)
+        return result
+
+    # Queued operations
+
+    def shell(self, cmd, check=True):
+        """Queue an arbitrary shell command.
+
+        :param str cmd: The command to be executed.
+        :param bool check: Flag specifying if a non-zero exitcode
+            stops the batch.
+        :returns: :class:`ADBBatchResult`
+        """
+        return self._add_shell('shell', cmd, check)
+
+    def exists(self, path):
+        """Queue a check if path exists on the device. The answer is
+        available as the value of the returned result after the batch
+        has been executed.
+        """
+        path = posixpath.normpath(path)
+        return self._add_shell('exists', 'ls -a %s >/dev/null 2>&1' % path,
+                               False)
+
+    def is_dir(self, path):
+        """Queue a check if path is an existing directory on the
+        device.
+        """
+        path = posixpath.normpath(path)
+        return self._add_shell('is_dir', 'ls -a %s/ >/dev/null 2>&1' % path,
+                               False)
+
+    def is_file(self, path):
+        """Queue a check if path is an existing file on the device."""
+        path = posixpath.normpath(path)
+        return self._add_shell('is_file',
+                               'if ls -a %s/ >/dev/null 2>&1; then false; '
+                               'else ls -a %s >/dev/null 2>&1; fi' % (path, path),
+                               False)
+
+    def rm(self, path, recursive=False, force=False):
+        """Queue the deletion of files or directories on the device.
+
+        :param str path: The path of the remote file or directory.
+        :param bool recursive: Flag specifying if the command is
+            to be applied recursively to the target.
+        :param bool force: Flag which if True will not stop the batch
+            if the deletion fails.
+        """
+        cmd = 'rm -r' if recursive else 'rm'
+        return self._add_shell('rm', '%s %s' % (cmd, path), not force)
+
+    def rmdir(self, path):
+        """Queue the deletion of an empty directory on the device."""
+        path = posixpath.normpath(path)
+        return self._add_shell('rmdir',
+                               'rmdir %s && if ls -a %s/ >/dev/null 2>&1; '
+                               'then false; fi' % (path, path),
+                               True)
+
+    def mkdir(self, path, parents=False):
+        """Queue the creation of a directory on the device.
+
+        :param str path: The directory name on the device.
+        :param bool parents: Flag indicating if the parent directories
+            are also to be created. Think mkdir -p path.
+        """
+        path = posixpath.normpath(path)
+        if not parents:
+            cmd = 'mkdir %s' % path
+        elif self._device._mkdir_p:
+            cmd = 'mkdir -p %s' % path
+        else:
+            # If mkdir -p is not supported, create each missing
+            # component of the path individually.
+            cmds = []
+            name = '/'
+            for part in path.split('/'):
+                if part:
+                    name = posixpath.join(name, part)
+                    cmds.append('{ ls -a %s/ >/dev/null 2>&1 || mkdir %s; }' %
+                                (name, name))
+            cmd = ' && '.join(cmds)
+            if self._device._mkdir_p is None:
+                cmd = '{ mkdir -p %s 2>/dev/null || { %s; }; }' % (path, cmd)
+        # Confirm the directory was created as ADBDevice.mkdir does.
+        cmd = '%s && ls -a %s/ >/dev/null 2>&1' % (cmd, path)
+        return self._add_shell('mkdir', cmd, True)
+
+    def chmod(self, path, recursive=False, mask='777'):
+        """Queue a change of the permissions of a path on the device.
+
+        :param str path: The path on the device.
+        :param bool recursive: Flag specifying if the command should be
+            executed recursively.
+        :param str mask: The octal permissions.
+        """
+        path = posixpath.normpath(path.strip())
+        if not recursive:
+            return self._add_shell('chmod', 'chmod %s %s' % (mask, path), True)
+        if self._device._chmod_R:
+            # Ignore 'No such file or directory' errors as
+            # ADBDevice.chmod does.
+            cmd = ('out=$(chmod -R %s %s 2>&1); rc=$?; echo "$out"; '
+                   'case "$out" in *"No such file or directory"*) rc=0;; esac; '
+                   'exit $rc' % (mask, path))
+            return self._add_shell('chmod', '(%s)' % cmd, True)
+
+        def func():
+            self._device.chmod(path, recursive=True, mask=mask,
+                               timeout=self._timeout, root=self._root)
+        return self._add_host('chmod', 'chmod -R %s %s' % (mask, path), func)
+
+    def push(self, local, remote):
+        """Queue a push of a file or directory to the device."""
+        def func():
+            self._device.push(local, remote, timeout=self._timeout)
+        return self._add_host('push', 'push %s %s' % (local, remote), func)
+
+    def push_tree(self, local, remote):
+        """Queue a push of a directory to the device using a tar
+        stream where supported. See :meth:`ADBDevice.push_tree`.
+        """
+        def func():
+            self._device.push_tree(local, remote, timeout=self._timeout,
+                                   root=self._root)
+        return self._add_host('push_tree', 'push_tree %s %s' % (local, remote),
+                              func)
+
+    def push_files(self, files):
+        """Queue a push of several files to the device.
+
+        :param list files: list of (local, remote) file tuples.
+
+        The files are sent in a single tar stream if the device
+        supports it, otherwise each file is pushed individually.
+        """
+        def func():
+            device = self._device
+            if len(files) > 1 and device._get_tar(timeout=self._timeout):
+                device._push_tar(files, timeout=self._timeout, root=self._root)
+            else:
+                for local, remote in files:
+                    device.push(local, remote, timeout=self._timeout)
+        return self._add_host('push_files', 'push_files %d files' % len(files),
+                              func)
+
+    # Execution
+
+    def _compile(self, segment, offset):
+        """Compile a list of queued shell operations into a script.
+
+        Each operation is bracketed by marker lines containing the
+        operation's index and exitcode so that the output can be
+        attributed to each operation.
+        """
+        lines = []
+        for i, (result, _) in enumerate(segment):
+            index = offset + i
+            lines.append('echo "%s %d"' % (self._marker, index))
+            if result.check:
+                lines.append('%s 2>&1 || { echo "%s %d $?"; exit 0; }' % (
+                    result.cmd, self._marker, index))
+                lines.append('echo "%s %d 0"' % (self._marker, index))
+            else:
+                lines.append('%s 2>&1; echo "%s %d $?"' % (
+                    result.cmd, self._marker, index))
+        return '\n'.join(lines) + '\n'
+
+    def _run_script(self, script):
+        """Run script on the device in a single adb shell invocation
+        returning its output. The script is run in a subshell so that
+        a failed checked operation can exit early.
+        """
+        device = self._device
+        inline = (len(script) <= self._max_inline_script and
+                  (not self._root or device._have_root_shell))
+        if inline:
+            return device.shell_output('(%s)' % script.replace('\n', '; '),
+                                       timeout=self._timeout, root=self._root)
+
+        # Push the script to the device since it is either too long
+        # for the command line or needs to be run under su which only
+        # applies to a single command.
+        tmpf = tempfile.NamedTemporaryFile(delete=False)
+        remote_script = '/data/local/tmp/%s.sh' % self._marker
+        try:
+            # The running shell keeps the script open so it can
+            # remove itself before any operation can exit early.
+            tmpf.write('rm %s\n' % remote_script)
+            tmpf.write(script)
+            tmpf.close()
+            device.push(tmpf.name, remote_script, timeout=self._timeout)
+            return device.shell_output('sh %s' % remote_script,
+                                       timeout=self._timeout, root=self._root)
+        finally:
+            os.unlink(tmpf.name)
+
+    def _parse_output(self, output):
+        current = None
+        for line in output.splitlines():
+            parts = line.strip().split(' ')
+            if parts[0] == self._marker and len(parts) in (2, 3):
+                index = int(parts[1])
+                if len(parts) == 2:
+                    current = self.results[index]
+                    current.output = ''
+                else:
+                    self.results[index].exitcode = int(parts[2])
+                    self.results[index].output = \
+                        self.results[index].output.rstrip()
+                    current = None
+            elif current is not None:
+                current.output += line + '\n'
+
+    def execute(self):
+        """Execute the queued operations.
+
+        :returns: list of :class:`ADBBatchResult` in the order queued.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        if self.executed:
+            raise ADBError('ADBBatch: batch has already been executed')
+        self.executed = True
+
+        # Split the operations into runs of shell operations separated
+        # by host operations.
+        segments = []
+        for index, (result, func) in enumerate(self._ops):
+            if func is None and segments and segments[-1][1] is None:
+                segments[-1][2].append((result, func))
+            else:
+                segments.append((index, func, [(result, func)]))
+
+        for offset, func, segment in segments:
+            if func is None:
+                self._parse_output(self._run_script(self._compile(segment,
+                                                                  offset)))
+            else:
+                result = segment[0][0]
+                try:
+                    func()
+                    result.exitcode = 0
+                except ADBError as e:
+                    result.exitcode = 1
+                    result.error = e
+                    result.output = e.message
+            for result, _ in segment:
+                if result.check and result.ran and not result.ok:
+                    self._device._logger.debug('ADBBatch: %s' % result)
+                    raise ADBError('ADBBatch: %s' % result)
+                if not result.ran:
+                    raise ADBError('ADBBatch: %s did not complete' % result)
+        return self.results
+
+
+class ADBProcessTable(object):
+    """ADBProcessTable is a parsed snapshot of the processes running on
+    a device together with an index of process ids by process name.
+    """
+
+    def __init__(self, processes):
+        #: list of [pid, name, user] lists for the running processes.
+        self.processes = processes
+        #: time the snapshot was taken.
+        self.timestamp = time.time()
+        self._by_name = {}
+        self._by_basename = {}
+        for pid, name, user in processes:
+            self._by_name.setdefault(name, []).append(pid)
+            self._by_basename.setdefault(name.split('/')[-1], []).append(pid)
+
+    @property
+    def age(self):
+        """Return the age of the snapshot in seconds."""
+        return time.time() - self.timestamp
+
+    def pids(self, name, basename=False):
+        """Return the list of process ids for processes named name.
+
+        :param str name: The name of the process. Note that only the
+            first 75 characters of the process name are significant.
+        :param bool basename: Flag specifying if name is to be compared
+            to the last path component of each process name.
+        """
+        index = self._by_basename if basename else self._by_name
+        return list(index.get(name[:75], []))
+
+
 class ADBDevice(ADBCommand):
     """ADBDevice is an abstract base class which provides methods which
     can be used to interact with the associated Android or B2G based
@@ -509,7 +939,8 @@ class ADBDevice(ADBCommand):
                  timeout=300,
                  verbose=False,
                  device_ready_retry_wait=20,
-                 device_ready_retry_attempts=3):
+                 device_ready_retry_attempts=3,
+                 capabilities_dir=None):
         """Initializes the ADBDevice object.
 
         :param device: When a string is passed, it is interpreted as the
@@ -539,6 +970,10 @@ class ADBDevice(ADBCommand):
             reboot.
         :param integer device_ready_retry_attempts: number of attempts when
             checking if a device is ready.
+        :param capabilities_dir: directory in which the capability
+            profile of the device is saved between instantiations. If
+            None, the device is probed each time.
+        :type capabilities_dir: str or None
 
         :raises: * ADBError
                  * ADBTimeoutError
@@ -556,8 +991,34 @@ class ADBDevice(ADBCommand):
         self._have_su = False
         self._have_android_su = False
 
-        # Catch exceptions due to the potential for segfaults
-        # calling su when using an improperly rooted device.
+        self._mkdir_p = None
+        # Most recent ADBProcessTable snapshot, the maximum age in
+        # seconds for which it may be reused and the ps command used
+        # to obtain it. The snapshot is discarded whenever another
+        # command is issued to the device since it may have started
+        # or stopped processes.
+        self._process_table = None
+        self.process_table_ttl = 1
+        self._ps = None
+        # Do we have pidof?
+        self._have_pidof = None
+        # Command used to run tar on the device for streaming
+        # transfers. None until it has been probed by _get_tar, then
+        # either the command or '' if streaming is not supported.
+        self._tar = None
+        # Cached values of the build's read only properties.
+        self._props = {}
+
+        # The capabilities of the device are saved in a profile in
+        # capabilities_dir keyed by the device serial and its build
+        # fingerprint. If the fingerprint has not changed since the
+        # profile was saved, the probes are skipped.
+        self._fingerprint = None
+        self._capabilities_path = None
+        if capabilities_dir:
+            self._capabilities_path = os.path.join(
+                capabilities_dir,
+                '%s.json' % re.sub(r'[^\w.-]', '_', self._device_serial or ''))
 
         # Note this check to see if adbd is running is performed on
         # the device in the state it exists in when the ADBDevice is
@@ -571,6 +1032,99 @@ class ADBDevice(ADBCommand):
         # performed again after a reboot.
 
         self._check_adb_root(timeout=timeout)
+        self._init_capabilities(timeout=timeout)
+
+        self._logger.debug("ADBDevice: %s" % self.__dict__)
+
+    # Names of the attributes which are saved in the capability
+    # profile.
+    _capability_names = ('_have_su', '_have_android_su', '_ls', '_have_cp',
+                         '_chmod_R', '_mkdir_p', '_ps', '_have_pidof',
+                         '_tar', '_props')
+
+    def _init_capabilities(self, timeout=None):
+        """Determine the capabilities of the device, loading them from
+        the saved capability profile if the device's build fingerprint
+        matches the profile, otherwise probing the device.
+        """
+        fingerprint = self.shell_output('getprop ro.build.fingerprint',
+                                        timeout=timeout)
+        if self._fingerprint == fingerprint:
+            return
+        self._fingerprint = fingerprint
+        self._props = {}
+        if self._load_capabilities():
+            return
+        self._probe_capabilities(timeout=timeout)
+        self._save_capabilities()
+
+    def _load_capabilities(self):
+        """Load the capability profile returning True if it exists and
+        matches the device's build fingerprint.
+        """
+        if not self._capabilities_path or \
+           not os.path.exists(self._capabilities_path):
+            return False
+        try:
+            with open(self._capabilities_path) as f:
+                profile = json.load(f)
+        except (IOError, ValueError) as e:
+            self._logger.warning('Unable to load capabilities %s: %s' %
+                                 (self._capabilities_path, e))
+            return False
+        if profile.get('fingerprint') != self._fingerprint:
+            self._logger.info('Build fingerprint changed from %s to %s' %
+                              (profile.get('fingerprint'), self._fingerprint))
+            return False
+        capabilities = profile.get('capabilities', {})
+        if not set(self._capability_names).issubset(capabilities):
+            return False
+        for name in self._capability_names:
+            value = capabilities[name]
+            if isinstance(value, unicode):
+                value = str(value)
+            setattr(self, name, value)
+        self._logger.info('Loaded capabilities from %s' %
+                          self._capabilities_path)
+        return True
+
+    def _save_capabilities(self):
+        """Save the capability profile if a capabilities_dir was
+        specified.
+        """
+        if not self._capabilities_path:
+            return
+        profile = {
+            'serial': self._device_serial,
+            'fingerprint': self._fingerprint,
+            'capabilities': dict([(name, getattr(self, name, None))
+                                  for name in self._capability_names]),
+        }
+        try:
+            capabilities_dir = os.path.dirname(self._capabilities_path)
+            if not os.path.isdir(capabilities_dir):
+                os.makedirs(capabilities_dir)
+            # Write to a temporary file and rename it so that a
+            # partially written profile is never loaded.
+            tmp_path = '%s.%d' % (self._capabilities_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(profile, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self._capabilities_path)
+        except (IOError, OSError) as e:
+            self._logger.warning('Unable to save capabilities %s: %s' %
+                                 (self._capabilities_path, e))
+
+    def _probe_capabilities(self, timeout=None):
+        """Probe the device for its capabilities."""
+        self._mkdir_p = None
+        self._ps = None
+        self._have_pidof = None
+        self._tar = None
+        self._have_su = False
+        self._have_android_su = False
+
+        # Catch exceptions due to the potential for segfaults
+        # calling su when using an improperly rooted device.
 
         uid = 'uid=0'
         # Do we have a 'Superuser' sh like su?
@@ -589,7 +1143,6 @@ class ADBDevice(ADBCommand):
         except ADBError:
             self._logger.debug("Check for su 0 failed")
 
-        self._mkdir_p = None
         # Force the use of /system/bin/ls or /system/xbin/ls in case
         # there is /sbin/ls which embeds ansi escape codes to colorize
         # the output.  Detect if we are using busybox ls. We want each
@@ -627,8 +1180,6 @@ class ADBDevice(ADBCommand):
                 self._chmod_R = True
         self._logger.info("Native chmod -R support: %s" % self._chmod_R)
 
-        self._logger.debug("ADBDevice: %s" % self.__dict__)
-
     def _get_device_serial(self, device):
         if device is None:
             devices = ADBHost(adb=self._adb_path, adb_host=self._adb_host,
@@ -804,9 +1355,9 @@ class ADBDevice(ADBCommand):
 
         try:
             dummy_dir = posixpath.join(test_root, 'dummy')
-            if self.is_dir(dummy_dir):
-                self.rm(dummy_dir, recursive=True)
-            self.mkdir(dummy_dir, parents=True)
+            with self.batch() as b:
+                b.rm(dummy_dir, recursive=True, force=True)
+                b.mkdir(dummy_dir, parents=True)
         except ADBError:
             self._logger.debug("%s is not writable" % test_root)
             return False
@@ -849,6 +1400,7 @@ class ADBDevice(ADBCommand):
         the stdout temporary file.
         """
 
+        self._process_table = None
         return ADBCommand.command(self, cmds,
                                   device_serial=self._device_serial,
                                   timeout=timeout)
@@ -870,6 +1422,7 @@ class ADBDevice(ADBCommand):
         :raises: * ADBTimeoutError
                  * ADBError
         """
+        self._process_table = None
         return ADBCommand.command_output(self, cmds,
                                          device_serial=self._device_serial,
                                          timeout=timeout)
@@ -963,8 +1516,38 @@ class ADBDevice(ADBCommand):
 
         self.command_output(cmd, timeout=timeout)
 
+    def _device_args(self):
+        """Return the adb arguments which select the device."""
+        args = [self._adb_path]
+        if self._adb_host:
+            args.extend(['-H', self._adb_host])
+        if self._adb_port:
+            args.extend(['-P', str(self._adb_port)])
+        if self._device_serial:
+            args.extend(['-s', self._device_serial, 'wait-for-device'])
+        return args
+
     # Device Shell methods
 
+    def _root_cmd(self, cmd, root):
+        """Return cmd wrapped to be executed as root if requested and
+        we do not already have a root shell.
+
+        :raises: ADBRootError
+        """
+        if root and not self._have_root_shell:
+            # If root was requested and we do not already have a root
+            # shell, then use the appropriate version of su to invoke
+            # the shell cmd. Prefer Android's su version since it may
+            # falsely report support for su -c.
+            if self._have_android_su:
+                cmd = "su 0 %s" % cmd
+            elif self._have_su:
+                cmd = "su -c \"%s\"" % cmd
+            else:
+                raise ADBRootError('Can not run command %s as root!' % cmd)
+        return cmd
+
     def shell(self, cmd, env=None, cwd=None, timeout=None, root=False):
         """Executes a shell command on the device.
 
@@ -1020,17 +1603,8 @@ class ADBDevice(ADBCommand):
         the stdout temporary files.
 
         """
-        if root and not self._have_root_shell:
-            # If root was requested and we do not already have a root
-            # shell, then use the appropriate version of su to invoke
-            # the shell cmd. Prefer Android's su version since it may
-            # falsely report support for su -c.
-            if self._have_android_su:
-                cmd = "su 0 %s" % cmd
-            elif self._have_su:
-                cmd = "su -c \"%s\"" % cmd
-            else:
-                raise ADBRootError('Can not run command %s as root!' % cmd)
+        self._process_table = None
+        cmd = self._root_cmd(cmd, root)
 
         # prepend cwd and env to command if necessary
         if cwd:
@@ -1245,8 +1819,17 @@ class ADBDevice(ADBCommand):
         :returns: string value of property.
         :raises: * ADBTimeoutError
                  * ADBError
+
+        The values of the build's read only ro.build.* and
+        ro.product.* properties are cached in the capability profile
+        since they can only change when the build fingerprint changes.
         """
+        if prop in self._props:
+            return self._props[prop]
         output = self.shell_output('getprop %s' % prop, timeout=timeout)
+        if prop.startswith('ro.build.') or prop.startswith('ro.product.'):
+            self._props[prop] = output
+            self._save_capabilities()
         return output
 
     def get_state(self, timeout=None):
@@ -1402,6 +1985,24 @@ class ADBDevice(ADBCommand):
         if not rv.startswith("remount succeeded"):
             raise ADBError("Unable to remount device")
 
+    def batch(self, timeout=None, root=False):
+        """Returns an :class:`ADBBatch` which queues file system
+        operations on the device and executes them together when the
+        with block exits or when its execute method is called.
+
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the operations should
+            be executed as root.
+        :returns: :class:`ADBBatch`
+        """
+        return ADBBatch(self, timeout=timeout, root=root)
+
     def chmod(self, path, recursive=False, mask="777", timeout=None, root=False):
         """Recursively changes the permissions of a directory on the
         device.
@@ -1627,9 +2228,7 @@ class ADBDevice(ADBCommand):
         else:
             recursive_flag = '-R'
             if path.startswith('/sdcard') and path.endswith('/'):
-                model = self.shell_output('getprop ro.product.model',
-                                          timeout=timeout,
-                                          root=root)
+                model = self.get_prop('ro.product.model', timeout=timeout)
                 if model == 'Nexus 4':
                     path += '*'
         lines = self.shell_output('%s %s %s' % (self._ls, recursive_flag, path),
@@ -1682,7 +2281,9 @@ class ADBDevice(ADBCommand):
                 # non-zero exitcode if -p is not supported.
                 if self.shell_bool('mkdir -p %s' % path, timeout=timeout,
                                    root=root):
-                    self._mkdir_p = True
+                    if self._mkdir_p is None:
+                        self._mkdir_p = True
+                        self._save_capabilities()
                     return
             # mkdir -p is not supported. create the parent
             # directories individually.
@@ -1806,6 +2407,293 @@ class ADBDevice(ADBCommand):
                 dir_util.copy_tree(local, original_local)
                 shutil.rmtree(temp_parent)
 
+    def _get_tar(self, timeout=None):
+        """Return the command used to run tar on the device or None if
+        tar streaming is not supported.
+
+        Streaming requires both a tar on the device, which may be
+        provided by toybox or busybox, and support for adb exec-in and
+        exec-out which, unlike adb shell, do not translate line
+        endings. The result of the probe is cached.
+        """
+        if self._tar is None:
+            self._tar = ''
+            try:
+                if self.command_output(['exec-out', 'echo', 'ok'],
+                                       timeout=timeout) == 'ok':
+                    for tar in ['tar', 'toybox tar', 'busybox tar']:
+                        if self.shell_bool('%s -cf - /system/build.prop '
+                                           '>/dev/null' % tar,
+                                           timeout=timeout):
+                            self._tar = tar
+                            break
+            except ADBError:
+                self._logger.debug('Check for exec-out failed')
+            self._logger.info('tar streaming support: %s' % (self._tar or False))
+            self._save_capabilities()
+        return self._tar or None
+
+    def _exec_stream(self, exec_cmd, cmd, func, timeout=None):
+        """Run cmd on the device via adb exec-in or exec-out and call
+        func with the process while the transfer is in progress.
+
+        :raises: * ADBTimeoutError
+                 * ADBError
+        """
+        if timeout is None:
+            timeout = self._timeout
+        args = self._device_args() + [exec_cmd, cmd]
+        stderr_file = tempfile.TemporaryFile()
+        if exec_cmd == 'exec-in':
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                    stdout=stderr_file, stderr=subprocess.STDOUT)
+        else:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                    stderr=stderr_file)
+        timedout = []
+
+        def kill():
+            timedout.append(True)
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        error = None
+        try:
+            try:
+                func(proc)
+            except (tarfile.TarError, IOError) as e:
+                error = e
+                proc.kill()
+            finally:
+                for f in (proc.stdin, proc.stdout):
+                    if f:
+                        f.close()
+                exitcode = proc.wait()
+        finally:
+            timer.cancel()
+            stderr_file.seek(0, os.SEEK_SET)
+            output = stderr_file.read().rstrip()
+            stderr_file.close()
+        if timedout:
+            raise ADBTimeoutError('%s %s: timed out after %s seconds' % (
+                exec_cmd, cmd, timeout))
+        if error:
+            raise ADBError('%s %s: %s' % (exec_cmd, cmd, error))
+        if exitcode:
+            raise ADBError('%s %s: exitcode: %s, output: %s' % (
+                exec_cmd, cmd, exitcode, output))
+
+    def _push_tar(self, files, timeout=None, root=False):
+        """Push files to the device in a single tar stream.
+
+        :param list files: list of (local, remote) tuples where local
+            is a host file or directory and remote is the absolute
+            path on the device.
+        """
+        tar = self._get_tar(timeout=timeout)
+        # Extract relative to / so that tar creates any missing parent
+        # directories of the remote paths.
+        cmd = self._root_cmd('%s -xf - -C /' % tar, root)
+
+        def owned_by_root(tarinfo):
+            # When extracting as root, tar restores the owner stored in
+            # the archive. Do not store the host's uid and gid, which
+            # can be those of an unrelated Android user or fail to be
+            # set on sdcard file systems.
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ''
+            return tarinfo
+
+        def send(proc):
+            archive = tarfile.open(fileobj=proc.stdin, mode='w|')
+            for local, remote in files:
+                archive.add(local,
+                            arcname=posixpath.normpath(remote).lstrip('/'),
+                            filter=owned_by_root)
+            archive.close()
+
+        self._exec_stream('exec-in', cmd, send, timeout=timeout)
+
+    def push_tree(self, local, remote, timeout=None, root=False):
+        """Pushes a directory to the device by streaming a tar archive
+        through adb exec-in rather than transferring each file with
+        adb push. The contents of the local directory are placed in
+        the remote directory which is created if necessary.
+
+        Falls back to push if the device does not support tar
+        streaming or if local is not a directory.
+
+        :param str local: The name of the local directory.
+        :param str remote: The name of the remote directory.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the archive should be
+            extracted as root.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        local = os.path.normpath(local)
+        remote = posixpath.normpath(remote)
+        if not os.path.isdir(local) or not self._get_tar(timeout=timeout):
+            self.push(local, remote, timeout=timeout)
+            return
+        self._push_tar([(local, remote)], timeout=timeout, root=root)
+        if not self.is_dir(remote, timeout=timeout, root=root):
+            raise ADBError('push_tree: failed to push %s to %s' % (local, remote))
+
+    def pull_tree(self, remote, local, timeout=None, root=False):
+        """Pulls a directory from the device by streaming a tar archive
+        through adb exec-out and unpacking it as it arrives rather
+        than transferring each file with adb pull. The contents of the
+        remote directory are placed in the local directory which is
+        created if necessary.
+
+        Falls back to pull if the device does not support tar
+        streaming.
+
+        :param str remote: The name of the remote directory.
+        :param str local: The name of the local directory.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the archive should be
+            created as root.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        tar = self._get_tar(timeout=timeout)
+        if not tar:
+            self.pull(remote, local, timeout=timeout)
+            return
+        local = os.path.normpath(local)
+        remote = posixpath.normpath(remote)
+        if not os.path.isdir(local):
+            os.makedirs(local)
+        # Discard tar's diagnostics since exec-out does not separate
+        # stderr from the archive.
+        cmd = self._root_cmd('%s -cf - -C %s . 2>/dev/null' % (tar, remote),
+                             root)
+
+        def receive(proc):
+            archive = tarfile.open(fileobj=proc.stdout, mode='r|')
+            archive.extractall(local)
+            archive.close()
+
+        self._exec_stream('exec-out', cmd, receive, timeout=timeout)
+
+    def _host_manifest(self, pushes):
+        """Return a manifest {remote_file: [size, sha1], ...} and the
+        corresponding {remote_file: local_file, ...} mapping for the
+        files described by pushes.
+        """
+        manifest = {}
+        sources = {}
+        for local, remote in pushes.iteritems():
+            local = os.path.normpath(local)
+            remote = posixpath.normpath(remote)
+            if os.path.isdir(local):
+                for dirpath, dirnames, filenames in os.walk(local):
+                    relpath = os.path.relpath(dirpath, local)
+                    for filename in filenames:
+                        local_file = os.path.join(dirpath, filename)
+                        remote_file = posixpath.normpath(posixpath.join(
+                            remote, relpath.replace(os.sep, '/'), filename))
+                        manifest[remote_file] = list(_host_file_digest(local_file))
+                        sources[remote_file] = local_file
+            else:
+                manifest[remote] = list(_host_file_digest(local))
+                sources[remote] = local
+        return manifest, sources
+
+    def sync(self, pushes, manifest_path, mask=None, timeout=None, root=False):
+        """Pushes only the files which have changed since the last sync.
+
+        A manifest of the size and sha1 of each file pushed is kept
+        on the device at manifest_path. The host files are compared
+        against the manifest and only new or changed files are pushed,
+        in a single tar stream where the device supports it, without
+        first copying them to a temporary directory on the host. Files recorded in the device manifest
+        which are no longer present on the host are removed. If
+        nothing has changed, the only adb call made is to read the
+        device manifest.
+
+        The device manifest is removed before any files are pushed and
+        is only replaced after all of the files have been pushed so
+        that an interrupted sync is never trusted.
+
+        :param dict pushes: Mapping of local files or directories to the
+            remote paths to which they are to be pushed.
+        :param str manifest_path: Path on the device of the manifest.
+        :param mask: If specified, the octal permissions applied
+            recursively to the directory containing the manifest after
+            the files are pushed.
+        :type mask: str or None
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the removal of stale files
+            and chmod should be executed as root.
+        :returns: list of the remote files which were pushed.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        host_manifest, sources = self._host_manifest(pushes)
+        try:
+            device_manifest = json.loads(
+                self.shell_output('cat %s' % manifest_path,
+                                  timeout=timeout, root=root))
+            if not isinstance(device_manifest, dict):
+                device_manifest = {}
+        except (ADBError, ValueError):
+            device_manifest = {}
+
+        changed = sorted([remote for remote in host_manifest
+                          if device_manifest.get(remote) != host_manifest[remote]])
+        stale = sorted(set(device_manifest).difference(host_manifest))
+        if not changed and not stale:
+            self._logger.debug('sync: %s is up to date' % manifest_path)
+            return []
+
+        self._logger.debug('sync: %s: pushing %d files, removing %d files' %
+                           (manifest_path, len(changed), len(stale)))
+        tmpf = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            # Terminate the manifest with a newline so that the exit
+            # code appended by shell() is on a line of its own when
+            # the manifest is read back with cat.
+            json.dump(host_manifest, tmpf, sort_keys=True)
+            tmpf.write('\n')
+            tmpf.close()
+            with self.batch(timeout=timeout, root=root) as b:
+                b.rm(manifest_path, force=True)
+                b.push_files([(sources[remote], remote) for remote in changed])
+                for remote in stale:
+                    b.rm(remote, force=True)
+                if mask:
+                    b.chmod(posixpath.dirname(manifest_path), recursive=True,
+                            mask=mask)
+                b.push(tmpf.name, manifest_path)
+        finally:
+            os.unlink(tmpf.name)
+        return changed
+
     def rm(self, path, recursive=False, force=False, timeout=None, root=False):
         """Delete files or directories on the device.
 
@@ -1831,9 +2719,13 @@ class ADBDevice(ADBCommand):
         cmd = "rm"
         if recursive:
             cmd += " -r"
+        with self.batch(timeout=timeout, root=root) as b:
+            removed = b.shell("%s %s" % (cmd, path), check=False)
+            is_file = b.is_file(path)
         try:
-            self.shell_output("%s %s" % (cmd, path), timeout=timeout, root=root)
-            if self.is_file(path, timeout=timeout, root=root):
+            if not removed.ok:
+                raise ADBError("%s" % removed)
+            if is_file.value:
                 raise ADBError('rm("%s") failed to remove file.' % path)
         except ADBError as e:
             if not force and 'No such file or directory' in e.message:
@@ -1856,12 +2748,127 @@ class ADBDevice(ADBCommand):
                  * ADBRootError
                  * ADBError
         """
-        self.shell_output("rmdir %s" % path, timeout=timeout, root=root)
-        if self.is_dir(path, timeout=timeout, root=root):
+        with self.batch(timeout=timeout, root=root) as b:
+            b.shell("rmdir %s" % path)
+            is_dir = b.is_dir(path)
+        if is_dir.value:
             raise ADBError('rmdir("%s") failed to remove directory.' % path)
 
     # Process management methods
 
+    def _parse_process_list(self, adb_process):
+        """Parse the output of ps returning a list of [pid, name, user]
+        lists.
+        """
+        # first line is the headers
+        header = adb_process.stdout_file.readline()
+        pid_i = -1
+        user_i = -1
+        els = header.split()
+        for i in range(len(els)):
+            item = els[i].lower()
+            if item == 'user':
+                user_i = i
+            elif item == 'pid':
+                pid_i = i
+        if user_i == -1 or pid_i == -1:
+            self._logger.error('get_process_list: %s' % header)
+            raise ADBError('get_process_list: Unknown format: %s: %s' % (
+                header, adb_process))
+        ret = []
+        line = adb_process.stdout_file.readline()
+        while line:
+            els = line.split()
+            try:
+                ret.append([int(els[pid_i]), els[-1], els[user_i]])
+            except ValueError:
+                self._logger.error('get_process_list: %s %s\n%s' % (
+                    header, line, traceback.format_exc()))
+                raise ADBError('get_process_list: %s: %s: %s' % (
+                    header, line, adb_process))
+            line = adb_process.stdout_file.readline()
+        return ret
+
+    def _run_ps(self, ps, timeout=None):
+        adb_process = None
+        try:
+            adb_process = self.shell(ps, timeout=timeout)
+            if adb_process.timedout:
+                raise ADBTimeoutError("%s" % adb_process)
+            elif adb_process.exitcode:
+                raise ADBError("%s" % adb_process)
+            return self._parse_process_list(adb_process)
+        finally:
+            if adb_process and isinstance(adb_process.stdout_file, file):
+                adb_process.stdout_file.close()
+
+    def get_ps_command(self, timeout=None):
+        """Returns the ps command which lists all of the processes on
+        the device, probing the device the first time it is called.
+
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :returns: string containing the ps command.
+        :raises: * ADBTimeoutError
+                 * ADBError
+        """
+        if self._ps is None:
+            self._ps = 'ps'
+            try:
+                # More than just the ps process itself must be listed.
+                if len(self._run_ps('ps -A -o PID,USER,NAME',
+                                    timeout=timeout)) > 1:
+                    self._ps = 'ps -A -o PID,USER,NAME'
+            except ADBError:
+                self._logger.debug('Check for ps -A failed')
+            self._logger.info('Using %s' % self._ps)
+            self._save_capabilities()
+        return self._ps
+
+    def get_process_table(self, timeout=None, max_age=None):
+        """Returns an :class:`ADBProcessTable` snapshot of the processes
+        running on the device.
+
+        Lookups made within max_age seconds of each other share the
+        same snapshot provided no other command has been issued to the
+        device in the meantime.
+
+        On devices whose ps supports it, ps -A -o PID,USER,NAME is used
+        since newer versions of ps only list the processes of the
+        current session by default.
+
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param max_age: The maximum age in seconds of a cached
+            snapshot which may be returned. If it is not specified,
+            the value of the process_table_ttl attribute is used.
+        :type max_age: integer or None
+        :returns: :class:`ADBProcessTable`
+        :raises: * ADBTimeoutError
+                 * ADBError
+        """
+        if max_age is None:
+            max_age = self.process_table_ttl
+        table = self._process_table
+        if table and table.age <= max_age:
+            return table
+
+        ps = self.get_ps_command(timeout=timeout)
+        table = ADBProcessTable(self._run_ps(ps, timeout=timeout))
+        self._logger.debug('get_process_table: %s' % table.processes)
+        self._process_table = table
+        return table
+
     def get_process_list(self, timeout=None):
         """Returns list of tuples (pid, name, user) for running
         processes on device.
@@ -1878,45 +2885,8 @@ class ADBDevice(ADBCommand):
         :raises: * ADBTimeoutError
                  * ADBError
         """
-        adb_process = None
-        try:
-            adb_process = self.shell("ps", timeout=timeout)
-            if adb_process.timedout:
-                raise ADBTimeoutError("%s" % adb_process)
-            elif adb_process.exitcode:
-                raise ADBError("%s" % adb_process)
-            # first line is the headers
-            header = adb_process.stdout_file.readline()
-            pid_i = -1
-            user_i = -1
-            els = header.split()
-            for i in range(len(els)):
-                item = els[i].lower()
-                if item == 'user':
-                    user_i = i
-                elif item == 'pid':
-                    pid_i = i
-            if user_i == -1 or pid_i == -1:
-                self._logger.error('get_process_list: %s' % header)
-                raise ADBError('get_process_list: Unknown format: %s: %s' % (
-                    header, adb_process))
-            ret = []
-            line = adb_process.stdout_file.readline()
-            while line:
-                els = line.split()
-                try:
-                    ret.append([int(els[pid_i]), els[-1], els[user_i]])
-                except ValueError:
-                    self._logger.error('get_process_list: %s %s\n%s' % (
-                        header, line, traceback.format_exc()))
-                    raise ADBError('get_process_list: %s: %s: %s' % (
-                        header, line, adb_process))
-                line = adb_process.stdout_file.readline()
-            self._logger.debug('get_process_list: %s' % ret)
-            return ret
-        finally:
-            if adb_process and isinstance(adb_process.stdout_file, file):
-                adb_process.stdout_file.close()
+        return [list(proc) for proc in
+                self.get_process_table(timeout=timeout).processes]
 
     def kill(self, pids, sig=None, attempts=3, wait=5,
              timeout=None, root=False):
@@ -1991,10 +2961,9 @@ class ADBDevice(ADBCommand):
                  * ADBRootError
                  * ADBError
         """
-        procs = self.get_process_list(timeout=timeout)
         # limit the comparion to the first 75 characters due to a
         # limitation in processname length in android.
-        pids = [proc[0] for proc in procs if proc[1] == appname[:75]]
+        pids = self.get_process_table(timeout=timeout).pids(appname)
         if not pids:
             return
 
@@ -2041,17 +3010,47 @@ class ADBDevice(ADBCommand):
         parts = pieces[0].split('/')
         app = parts[-1]
 
-        proc_list = self.get_process_list(timeout=timeout)
-        if not proc_list:
-            return False
+        # limit the comparion to the first 75 characters due to a
+        # limitation in processname length in android.
+        table = self.get_process_table(timeout=timeout)
+        return len(table.pids(app, basename=True)) > 0
 
-        for proc in proc_list:
-            proc_name = proc[1].split('/')[-1]
-            # limit the comparion to the first 75 characters due to a
-            # limitation in processname length in android.
-            if proc_name == app[:75]:
-                return True
-        return False
+    def wait_for_process_exit(self, process_name, timeout=None):
+        """Waits for all processes named process_name to exit.
+
+        If the device supports pidof, the polling is performed by a
+        loop on the device in a single adb call. Otherwise the device
+        is polled from the host once per second.
+
+        :param str process_name: The name of the process.
+        :param timeout: The maximum time in seconds to wait for the
+            process to exit. If it is not specified, the value set in
+            the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :returns: boolean - True if the process is no longer running.
+        :raises: * ADBTimeoutError
+                 * ADBError
+        """
+        if timeout is None:
+            timeout = self._timeout
+        timeout = int(max(timeout, 1))
+        if self._have_pidof is None:
+            self._have_pidof = self.shell_bool('type pidof', timeout=timeout)
+            self._logger.info('Native pidof support: %s' % self._have_pidof)
+            self._save_capabilities()
+        if self._have_pidof:
+            cmd = ('i=0; while pidof %s >/dev/null; do '
+                   'if [ $i -ge %d ]; then exit 1; fi; '
+                   'sleep 1; i=$((i+1)); done' % (process_name[:75], timeout))
+            # Allow the adb call time to complete after the loop.
+            return self.shell_bool(cmd, timeout=timeout + 30)
+
+        start_time = time.time()
+        while self.process_exist(process_name):
+            if time.time() - start_time >= timeout:
+                return False
+            time.sleep(1)
+        return True
 
     def cp(self, source, destination, recursive=False, timeout=None,
            root=False):
@@ -2172,7 +3171,11 @@ class ADBDevice(ADBCommand):
         # versions of adb.
         self.command_output([], timeout=timeout)
         self._check_adb_root(timeout=timeout)
-        return self.is_device_ready(timeout=timeout)
+        ready = self.is_device_ready(timeout=timeout)
+        # The device's capabilities only need to be probed again if
+        # the reboot installed a new build.
+        self._init_capabilities(timeout=timeout)
+        return ready
 
     @abstractmethod
     def is_device_ready(self, timeout=None):
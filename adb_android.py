@@ -3,6 +3,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import posixpath
 import re
 import time
 
@@ -10,7 +11,7 @@ from abc import ABCMeta
 
 import version_codes
 
-from adb import ADBDevice, ADBError, ADBRootError
+from adb import ADBDevice, ADBError, ADBRootError, _host_file_digest
 
 
 class ADBAndroid(ADBDevice):
@@ -28,6 +29,18 @@ class ADBAndroid(ADBDevice):
     """
     __metaclass__ = ABCMeta
 
+    _capability_names = ADBDevice._capability_names + ('selinux',)
+
+    #: True if SELinux is supported, None until it has been determined.
+    selinux = None
+
+    #: Directory on the device where apks are staged by install_app.
+    apk_stage_dir = '/data/local/tmp'
+
+    #: Seconds spent in each phase of the last install_app and the
+    #: install method used.
+    install_timings = None
+
     def __init__(self,
                  device=None,
                  adb='adb',
@@ -38,7 +51,8 @@ class ADBAndroid(ADBDevice):
                  timeout=300,
                  verbose=False,
                  device_ready_retry_wait=20,
-                 device_ready_retry_attempts=3):
+                 device_ready_retry_attempts=3,
+                 capabilities_dir=None):
         """Initializes the ADBAndroid object.
 
         :param device: When a string is passed, it is interpreted as the
@@ -68,6 +82,10 @@ class ADBAndroid(ADBDevice):
             reboot.
         :param integer device_ready_retry_attempts: number of attempts when
             checking if a device is ready.
+        :param capabilities_dir: directory in which the capability
+            profile of the device is saved between instantiations. If
+            None, the device is probed each time.
+        :type capabilities_dir: str or None
 
         :raises: * ADBError
                  * ADBTimeoutError
@@ -79,23 +97,28 @@ class ADBAndroid(ADBDevice):
                            logger_name=logger_name, timeout=timeout,
                            verbose=verbose,
                            device_ready_retry_wait=device_ready_retry_wait,
-                           device_ready_retry_attempts=device_ready_retry_attempts)
+                           device_ready_retry_attempts=device_ready_retry_attempts,
+                           capabilities_dir=capabilities_dir)
         # https://source.android.com/devices/tech/security/selinux/index.html
         # setenforce
         # usage:  setenforce [ Enforcing | Permissive | 1 | 0 ]
         # getenforce returns either Enforcing or Permissive
 
-        try:
-            self.selinux = True
-            if self.shell_output('getenforce', timeout=timeout) != 'Permissive':
-                self._logger.info('Setting SELinux Permissive Mode')
-                self.shell_output("setenforce Permissive", timeout=timeout, root=True)
-        except (ADBError, ADBRootError), e:
-            self._logger.warning('Unable to set SELinux Permissive due to %s.' % e)
-            self.selinux = False
-
-        self.version = int(self.shell_output("getprop ro.build.version.sdk",
-                                             timeout=timeout))
+        # If the capability profile records that the device does not
+        # support SELinux, there is no need to check again.
+        if self.selinux is not False:
+            try:
+                self.selinux = True
+                if self.shell_output('getenforce', timeout=timeout) != 'Permissive':
+                    self._logger.info('Setting SELinux Permissive Mode')
+                    self.shell_output("setenforce Permissive", timeout=timeout, root=True)
+            except (ADBError, ADBRootError), e:
+                self._logger.warning('Unable to set SELinux Permissive due to %s.' % e)
+                self.selinux = False
+            self._save_capabilities()
+
+        self.version = int(self.get_prop("ro.build.version.sdk",
+                                         timeout=timeout))
 
     def reboot(self, timeout=None):
         """Reboots the device.
@@ -254,9 +277,22 @@ class ADBAndroid(ADBDevice):
 
     # Application management methods
 
-    def install_app(self, apk_path, timeout=None):
+    def install_app(self, apk_path, timeout=None, staged=True):
         """Installs an app on the device.
 
+        If staged is True, the apk is pushed to apk_stage_dir under a
+        name derived from its sha1 and installed from there with pm
+        install. The staged copy is kept so that installing the same
+        apk again, e.g. for another test chunk or a retry, does not
+        transfer it again. Only the most recently staged apk is kept.
+
+        If staged is False or the apk can not be staged, the apk is
+        installed with adb install, using --streaming where the
+        host's adb and the device support it.
+
+        The time in seconds spent in each phase of the install is
+        recorded in the install_timings attribute.
+
         :param str apk_path: The apk file name to be installed.
         :param timeout: The maximum time in
             seconds for any spawned adb process to complete before
@@ -265,18 +301,79 @@ class ADBAndroid(ADBDevice):
             may exceed this value. If it is not specified, the value
             set in the ADB constructor is used.
         :type timeout: integer or None
+        :param bool staged: Flag specifying if the apk should be
+            installed from a staged copy on the device.
         :raises: * ADBTimeoutError
                  * ADBError
         """
+        self.install_timings = {}
+        if staged:
+            try:
+                staged_path = self._stage_apk(apk_path, timeout=timeout)
+            except ADBError, e:
+                self._logger.warning('install_app: unable to stage %s: %s' %
+                                     (apk_path, e))
+                staged_path = None
+            if staged_path:
+                start = time.time()
+                cmd = "pm install"
+                if self.version >= version_codes.M:
+                    cmd += " -g"
+                data = self.shell_output("%s %s" % (cmd, staged_path),
+                                         timeout=timeout)
+                self.install_timings['install'] = round(time.time() - start, 1)
+                self._logger.info('install_app: %s' % self.install_timings)
+                if data.find('Success') == -1:
+                    raise ADBError("install failed for %s. Got: %s" %
+                                   (apk_path, data))
+                return
+
+        start = time.time()
         cmd = ["install"]
+        if self._adb_version >= '1.0.40' and \
+           self.version >= version_codes.N:
+            cmd.append("--streaming")
+            self.install_timings['method'] = 'streaming'
+        else:
+            self.install_timings['method'] = 'adb install'
         if self.version >= version_codes.M:
             cmd.append("-g")
         cmd.append(apk_path)
         data = self.command_output(cmd, timeout=timeout)
+        self.install_timings['install'] = round(time.time() - start, 1)
+        self._logger.info('install_app: %s' % self.install_timings)
         if data.find('Success') == -1:
             raise ADBError("install failed for %s. Got: %s" %
                            (apk_path, data))
 
+    def _stage_apk(self, apk_path, timeout=None):
+        """Returns the path of the staged copy of apk_path on the
+        device, pushing it first if it is not already staged.
+        """
+        start = time.time()
+        size, sha1 = _host_file_digest(apk_path)
+        self.install_timings['digest'] = round(time.time() - start, 1)
+        staged_path = posixpath.join(self.apk_stage_dir,
+                                     'autophone-%s.apk' % sha1)
+        start = time.time()
+        if self.exists(staged_path, timeout=timeout):
+            self.install_timings['method'] = 'staged'
+            self.install_timings['stage'] = round(time.time() - start, 1)
+            return staged_path
+        # Push to a temporary name and rename it so that an
+        # interrupted push does not leave a partial apk which would
+        # be mistaken for a staged copy.
+        with self.batch(timeout=timeout) as b:
+            b.shell('rm -f %s %s' % (
+                posixpath.join(self.apk_stage_dir, 'autophone-*.apk'),
+                posixpath.join(self.apk_stage_dir, 'autophone-*.apk.tmp')),
+                    check=False)
+            b.push(apk_path, staged_path + '.tmp')
+            b.shell('mv %s.tmp %s' % (staged_path, staged_path))
+        self.install_timings['method'] = 'pushed'
+        self.install_timings['stage'] = round(time.time() - start, 1)
+        return staged_path
+
     def is_app_installed(self, app_name, timeout=None):
         """Returns True if an app is installed on the device.
 
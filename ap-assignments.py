@@ -3,12 +3,27 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+# Capacity planner for the production test assignments.
+#
+# Reads the device and test manifests, estimates the daily load of
+# each device from the per test durations and the push rate of each
+# repository, then reassigns the tests among the devices of each
+# device type so that their loads are balanced. The durations and
+# push rates default to the tables below and can be replaced by
+# measurements from worker logs and hg.mozilla.org.
+
 import ConfigParser
+import argparse
+import datetime
+import logging
 import os
+import re
 from glob import glob
 
+import utils
 from utils import autophone_path
 
+
 install_time = 2
 
 # Counts based on maximum pushes for 2017-09-01 through 2017-10-08
@@ -508,146 +523,452 @@ device_times = {
     },
 }
 
-repos = {} # repos[repo_name_build_type][test_name] = [device_names]
+# Repositories whose builds are only tested for the fraction of pushes
+# given in device_times.
+fraction_repos = ['autoland', 'mozilla-inbound']
 
-devices = {} # devices[device_name][test_name] = [repo_names_build_types]
+minutes_per_day = 24 * 60
 
-tests = {} # tests[test_name][repo_name_build_type] = [device_names]
+# Matches the message logged by PhoneTest.teardown_job.
+elapsed_re = re.compile(
+    r'PhoneTestJob \S+ \S+ (?P<build_type>\S+) \S+ \S+ \S+ '
+    r'Test (?P<test_name>\S+) elapsed time: '
+    r'(?:(?P<days>\d+) days?, )?(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>[0-9.]+) '
+    r'config: (?P<config>\S+) phone: (?P<phone>\S+)')
 
-devicecfg = ConfigParser.RawConfigParser()
 
-device_manifest_paths = glob(os.path.join(autophone_path(),
-                                          'production-autophone-*-devices.ini'))
-test_manifest_paths = glob(os.path.join(autophone_path(),
-                                        'tests/production-autophone-*.ini'))
+def get_device_type(device_name):
+    return '-'.join(device_name.split('-')[:-1])
 
-devicecfg.read(device_manifest_paths)
 
-for device in devicecfg.sections():
-    if device in devices:
-        print "ERROR: device %s already in %s" % (device, devices)
-    else:
-        devices[device] = {}
+class TestSection(object):
+    """A test section from a test manifest.
 
-test_manifests = ConfigParser.RawConfigParser()
+    devices is a dict of the lists of repositories indexed by the
+    device names which run the test. If it is empty, the test is run
+    by all devices.
+    """
+    def __init__(self, name, manifest, config, build_types):
+        self.name = name
+        self.manifest = manifest
+        self.config = config
+        self.build_types = build_types
+        self.devices = {}
 
-test_manifests.read(test_manifest_paths)
+    @property
+    def config_names(self):
+        return [os.path.basename(config) for config in self.config.split()]
 
-test_sections = test_manifests.sections()
-test_sections.sort()
 
-for test_name in test_sections:
-    if test_name not in tests:
-        tests[test_name] = {}
+def read_devices(device_manifest_pattern):
+    """Return a dict of the hosts, such as autophone-1, indexed by
+    device name."""
+    production_re = re.compile('production-(autophone-[0-9]+)-devices.ini')
+    device_hosts = {}
+    for device_manifest in sorted(glob(os.path.join(autophone_path(),
+                                                    device_manifest_pattern))):
+        devicecfg = ConfigParser.RawConfigParser()
+        devicecfg.read(device_manifest)
+        match = production_re.search(device_manifest)
+        host = match.group(1) if match else None
+        for device_name in devicecfg.sections():
+            if device_name in device_hosts:
+                print "ERROR: device %s already in %s" % (
+                    device_name, device_hosts[device_name])
+            else:
+                device_hosts[device_name] = host
+    return device_hosts
+
 
-    device_name = None # signal if any devices explicitly mentioned
-    test_options = test_manifests.options(test_name)
-    test_options.sort()
-    for test_option in test_options:
-        test_value = test_manifests.get(test_name, test_option)
-        #print "test_name: %s, test_option: %s, test_value: %s" % (test_name, test_option, test_value)
-        if test_option == 'config':
-            # config is required and is the first option in the section.
+def read_tests(test_manifest_pattern, device_hosts):
+    """Return the list of TestSections from the test manifests in
+    the order they appear."""
+    sections = []
+    for test_manifest in sorted(glob(os.path.join(autophone_path(),
+                                                  test_manifest_pattern))):
+        test_manifests = ConfigParser.RawConfigParser()
+        test_manifests.read(test_manifest)
+        for test_name in test_manifests.sections():
+            config = test_manifests.get(test_name, 'config')
             test_config = ConfigParser.RawConfigParser()
-            test_config.read("%s/tests/%s" % (autophone_path(),
-                                              test_value))
+            test_config.read([os.path.join(os.path.dirname(test_manifest), c)
+                              for c in config.split()])
             try:
                 test_build_types = test_config.get('builds', 'buildtypes').split()
             except ConfigParser.Error:
                 test_build_types = list(build_types)
-            #print "test_build_types: %s" % test_build_types
-            continue
-        device_name = test_option
-        if device_name not in devices:
-            print "ERROR: %s not in devices" % device_name
-            devices[device] = []
-        repo_names = test_value.split()
-        repo_names_build_types = []
-        for repo_name in repo_names:
-            for build_type in test_build_types:
-                repo_names_build_types.append('%s-%s' % (repo_name, build_type))
-        for repo_name_build_type in repo_names_build_types:
-            if repo_name_build_type not in repos:
-                repos[repo_name_build_type] = {}
-            if test_name not in repos[repo_name_build_type]:
-                repos[repo_name_build_type][test_name] = []
-            repos[repo_name_build_type][test_name].append(device_name)
-            #
-            if device_name not in devices:
-                devices[device_name] = {}
-            if test_name not in devices[device_name]:
-                devices[device_name][test_name] = []
-            devices[device_name][test_name].append(repo_name_build_type)
-            #
-            if test_name not in tests:
-                tests[test_name] = {}
-            if repo_name_build_type not in tests[test_name]:
-                tests[test_name][repo_name_build_type] = []
-            tests[test_name][repo_name_build_type].append(device_name)
-
-print "="* 10, "Device assignments", "="*10
-
-device_names = devices.keys()
-device_names.sort()
-
-for device_name in device_names:
-    device_type = ('-').join(device_name.split('-')[:-1])
-    device_repos = {} # repos seen so far
-    device_time = 0
-    test_names = devices[device_name].keys()
-    test_names.sort()
-    for test_name in test_names:
-        test_time = 0
-        repo_names_build_types = devices[device_name][test_name]
-        repo_names_build_types.sort()
-        print "device=%-28s test=%-30s repos=%s" % (device_name, test_name, repo_names_build_types)
-        for repo_name_build_type in repo_names_build_types:
-            repo_time = 0
-            repo_name_build_type_parts = repo_name_build_type.split('-')
-            repo_name = '-'.join(repo_name_build_type_parts[0:-1])
-            build_type = repo_name_build_type_parts[-1]
-            build_count = builds[repo_name]
-            #print "repo %s count %s" % (repo_name_build_type, build_count)
-            if repo_name_build_type not in device_repos:
-                #print "adding install time %s" % install_time
-                device_repos[repo_name_build_type] = 1
-                repo_time += install_time
-            repo_time += device_times[device_type][test_name][build_type]
-            if repo_name in ['autoland', 'mozilla-inbound']:
-                fraction = device_times[device_type][test_name]['fraction']
-            else:
-                fraction = 1.00
-            repo_time *= build_count*fraction
-            #print "repo %s time %s" % (repo_name_build_type, repo_time, fraction)
-            device_time += repo_time
-    print "device=%-28s time=%s" % (device_name, device_time)
-
-print "="* 10, "Repository-Build type assignments", "="*10
-
-repo_names_build_types = repos.keys()
-repo_names_build_types.sort()
-### ...
-for repo_name_build_type in repo_names_build_types:
-    test_names = repos[repo_name_build_type].keys()
-    test_names.sort()
-    for test_name in test_names:
-        device_names = repos[repo_name_build_type][test_name]
-        device_names.sort()
-        print "repo=%-30s test=%-30s devices=%s" % (repo_name_build_type, test_name, device_names)
+            section = TestSection(test_name, test_manifest, config,
+                                  test_build_types)
+            for device_name in test_manifests.options(test_name):
+                if device_name == 'config':
+                    continue
+                if device_name not in device_hosts:
+                    print "ERROR: %s not in devices" % device_name
+                    continue
+                test_value = test_manifests.get(test_name, device_name)
+                # Truncate any option comment then split into repos
+                section.devices[device_name] = re.sub(' *;.*', '',
+                                                      test_value).split()
+            sections.append(section)
+    return sections
+
+
+def read_durations(log_paths):
+    """Return the measured test durations in minutes from the worker
+    logs as a dict indexed by (device type, config name, build type).
+    The durations of the chunks of a test are summed."""
+    samples = {}
+    for log_path in log_paths:
+        with open(log_path) as log_file:
+            for line in log_file:
+                match = elapsed_re.search(line)
+                if not match:
+                    continue
+                minutes = (int(match.group('days') or 0) * minutes_per_day +
+                           int(match.group('hours')) * 60 +
+                           int(match.group('minutes')) +
+                           float(match.group('seconds')) / 60)
+                key = (get_device_type(match.group('phone')),
+                       match.group('config'),
+                       match.group('build_type'),
+                       match.group('test_name'))
+                samples.setdefault(key, []).append(minutes)
+    durations = {}
+    for (device_type, config, build_type, test_name), minutes in samples.iteritems():
+        key = (device_type, config, build_type)
+        durations[key] = (durations.get(key, 0) +
+                          sum(minutes) / len(minutes))
+    return durations
+
+
+def get_pushes_url(repo):
+    url = 'https://hg.mozilla.org/'
+    if repo in ('mozilla-beta', 'mozilla-aurora', 'mozilla-release'):
+        url += 'releases/'
+    elif repo not in ('mozilla-central', 'try'):
+        url += 'integration/'
+    return url + repo + '/json-pushes?startdate=%s&enddate=%s'
+
+
+def read_push_rates(repos, days):
+    """Return a dict of the maximum number of pushes per day over
+    the last days days indexed by repository."""
+    push_rates = {}
+    today = datetime.datetime.utcnow().date()
+    for repo in repos:
+        push_rates[repo] = 0
+        for day in range(1, days + 1):
+            start = today - datetime.timedelta(days=day)
+            end = start + datetime.timedelta(days=1)
+            pushes_json = utils.get_remote_json(get_pushes_url(repo) % (
+                start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+            if pushes_json:
+                keys = sorted(pushes_json.keys(), key=int)
+                count = int(keys[-1]) - int(keys[0]) + 1
+                push_rates[repo] = max(push_rates[repo], count)
+    return push_rates
+
+
+class LoadModel(object):
+    """Estimate the daily load in minutes of assigning a test and
+    repository to a device."""
+    def __init__(self, push_rates, durations):
+        self.push_rates = push_rates
+        self.durations = durations
+        self.missing = set()
+
+    def test_minutes(self, device_type, section, build_type):
+        if build_type not in section.build_types:
+            return 0
+        minutes = None
+        for config_name in section.config_names:
+            measured = self.durations.get((device_type, config_name, build_type))
+            if measured is not None:
+                minutes = (minutes or 0) + measured
+        if minutes is None:
+            minutes = device_times.get(device_type, {}).get(
+                section.name, {}).get(build_type)
+        if minutes is None:
+            self.missing.add((device_type, section.name, build_type))
+            minutes = 0
+        return minutes
+
+    def fraction(self, device_type, section, repo):
+        if repo not in fraction_repos:
+            return 1.00
+        return device_times.get(device_type, {}).get(
+            section.name, {}).get('fraction', 1.00)
+
+    def builds_per_day(self, device_type, section, repo):
+        if repo not in self.push_rates:
+            self.missing.add((device_type, section.name, repo))
+            return 0
+        return self.push_rates[repo] * self.fraction(device_type, section, repo)
+
+    def test_load(self, device_type, section, repo):
+        """Return the daily minutes spent running section for repo
+        excluding the time spent installing builds."""
+        return self.builds_per_day(device_type, section, repo) * sum(
+            self.test_minutes(device_type, section, build_type)
+            for build_type in section.build_types)
+
+    def device_load(self, device_name, assignments):
+        """Return (minutes per day, builds per day) for the device
+        with assignments, a dict of sets of repositories indexed by
+        TestSection. A build is installed once for all of the tests
+        which use it."""
+        device_type = get_device_type(device_name)
+        minutes = 0
+        installs = {}
+        for section, repos in assignments.iteritems():
+            for repo in repos:
+                minutes += self.test_load(device_type, section, repo)
+                builds_per_day = self.builds_per_day(device_type, section, repo)
+                for build_type in section.build_types:
+                    key = (repo, build_type)
+                    installs[key] = max(installs.get(key, 0), builds_per_day)
+        builds_per_day = sum(installs.values())
+        return minutes + builds_per_day * install_time, builds_per_day
+
+
+def queue_depth(minutes, builds_per_day):
+    """Return the projected mean number of builds waiting to be
+    tested by a device, treating each build as a job with the mean
+    service time in an M/D/1 queue, or the number of builds by which
+    the queue grows each day if the device is overloaded."""
+    if not builds_per_day:
+        return 0.0, False
+    utilisation = float(minutes) / minutes_per_day
+    if utilisation >= 1:
+        service_minutes = float(minutes) / builds_per_day
+        return (minutes - minutes_per_day) / service_minutes, True
+    return utilisation ** 2 / (2 * (1 - utilisation)), False
+
 
-print "="* 10, "Test assignments", "="*10
+def get_assignments(sections, device_hosts):
+    """Return a dict of the current assignments of each device
+    indexed by device name. See LoadModel.device_load."""
+    assignments = dict((device_name, {}) for device_name in device_hosts)
+    for section in sections:
+        for device_name, repos in section.devices.iteritems():
+            assignments[device_name].setdefault(section, set()).update(repos)
+    return assignments
 
-test_names = tests.keys()
-test_names.sort()
 
-for test_name in test_names:
-    repo_names_build_types = tests[test_name].keys()
-    repo_names_build_types.sort()
-    for repo_name_build_type in repo_names_build_types:
-        device_names = tests[test_name][repo_name_build_type]
+def balance(load_model, assignments, max_moves=1000):
+    """Return new assignments where the tests run by each device type
+    are spread over the devices of that type so that the maximum
+    daily load is minimized. A test which is run on a repository by n
+    devices is still run by n distinct devices of the same type.
+
+    The tests are placed longest first on the device where the
+    resulting load is least, then tests are moved off the most loaded
+    device while doing so reduces its load below the previous
+    maximum."""
+    device_types = {}
+    for device_name in assignments:
+        device_types.setdefault(get_device_type(device_name), []).append(device_name)
+    balanced = dict((device_name, {}) for device_name in assignments)
+    for device_type, device_names in device_types.iteritems():
         device_names.sort()
-        print "test=%-30s repo=%-25s devices=%s" % (test_name, repo_name_build_type, device_names)
+        items = []
+        for device_name in device_names:
+            for section, repos in assignments[device_name].iteritems():
+                for repo in repos:
+                    items.append((load_model.test_load(device_type, section, repo),
+                                  section, repo))
+        items.sort(key=lambda item: (-item[0], item[1].name, item[2]))
+
+        def load(device_name, section=None, repo=None):
+            device_assignments = balanced[device_name]
+            if section:
+                device_assignments = dict(device_assignments)
+                device_assignments[section] = device_assignments.get(
+                    section, set()) | set([repo])
+            return load_model.device_load(device_name, device_assignments)[0]
+
+        for item_load, section, repo in items:
+            candidates = [device_name for device_name in device_names
+                          if repo not in balanced[device_name].get(section, ())]
+            device_name = min(candidates,
+                              key=lambda d: (load(d, section, repo), d))
+            balanced[device_name].setdefault(section, set()).add(repo)
+
+        for move in range(max_moves):
+            loads = dict((device_name, load(device_name))
+                         for device_name in device_names)
+            busiest = max(device_names, key=lambda d: (loads[d], d))
+            best = None
+            for section, repos in balanced[busiest].items():
+                for repo in repos:
+                    remaining = dict(balanced[busiest])
+                    remaining[section] = remaining[section] - set([repo])
+                    busiest_load = load_model.device_load(busiest, remaining)[0]
+                    for device_name in device_names:
+                        if device_name == busiest or \
+                           repo in balanced[device_name].get(section, ()):
+                            continue
+                        new_max = max(busiest_load, load(device_name, section, repo))
+                        if new_max < loads[busiest] and \
+                           (best is None or new_max < best[0]):
+                            best = (new_max, section, repo, device_name)
+            if not best:
+                break
+            new_max, section, repo, device_name = best
+            balanced[busiest][section].discard(repo)
+            if not balanced[busiest][section]:
+                del balanced[busiest][section]
+            balanced[device_name].setdefault(section, set()).add(repo)
+    return balanced
+
+
+def print_loads(title, load_model, assignments):
+    print "="* 10, title, "="*10
+    for device_name in sorted(assignments):
+        for section in sorted(assignments[device_name], key=lambda s: s.name):
+            print "device=%-28s test=%-30s repos=%s" % (
+                device_name, section.name, sorted(assignments[device_name][section]))
+        minutes, builds_per_day = load_model.device_load(device_name,
+                                                         assignments[device_name])
+        depth, overloaded = queue_depth(minutes, builds_per_day)
+        print "device=%-28s time=%-8d utilisation=%3d%% %s=%.1f" % (
+            device_name, minutes, 100 * minutes / minutes_per_day,
+            'backlog/day' if overloaded else 'queue', depth)
+
+
+def print_assignments(sections):
+    repos = {} # repos[repo_name_build_type][test_name] = [device_names]
+    tests = {} # tests[test_name][repo_name_build_type] = [device_names]
+    for section in sections:
+        for device_name, repo_names in section.devices.iteritems():
+            for repo_name in repo_names:
+                for build_type in section.build_types:
+                    repo_name_build_type = '%s-%s' % (repo_name, build_type)
+                    repos.setdefault(repo_name_build_type, {}).setdefault(
+                        section.name, []).append(device_name)
+                    tests.setdefault(section.name, {}).setdefault(
+                        repo_name_build_type, []).append(device_name)
+
+    print "="* 10, "Repository-Build type assignments", "="*10
+    for repo_name_build_type in sorted(repos):
+        for test_name in sorted(repos[repo_name_build_type]):
+            device_names = sorted(repos[repo_name_build_type][test_name])
+            print "repo=%-30s test=%-30s devices=%s" % (repo_name_build_type, test_name, device_names)
+
+    print "="* 10, "Test assignments", "="*10
+    for test_name in sorted(tests):
+        for repo_name_build_type in sorted(tests[test_name]):
+            device_names = sorted(tests[test_name][repo_name_build_type])
+            print "test=%-30s repo=%-25s devices=%s" % (test_name, repo_name_build_type, device_names)
+
+
+def write_manifests(output_dir, sections, assignments, device_hosts):
+    """Write a production-autophone-<n>.ini test manifest for each
+    host containing the tests assigned to its devices. Tests which
+    are not restricted to specific devices are written to the
+    manifests where they were originally found."""
+    manifests = {}
+    for section in sections:
+        if not section.devices:
+            manifests.setdefault(os.path.basename(section.manifest), [])
+    for section in sections:
+        host_devices = {}
+        if section.devices:
+            for device_name, device_assignments in assignments.iteritems():
+                repos = device_assignments.get(section)
+                if repos:
+                    host_devices.setdefault(device_hosts[device_name], []).append(
+                        (device_name, repos))
+        else:
+            host_devices[None] = []
+        for host, devices in host_devices.iteritems():
+            if host:
+                manifest = 'production-%s.ini' % host
+            else:
+                manifest = os.path.basename(section.manifest)
+            lines = ['[%s]' % section.name, 'config = %s' % section.config]
+            for device_name, repos in sorted(devices):
+                ordered_repos = [repo for repo in builds if repo in repos]
+                ordered_repos.extend(sorted(repos - set(ordered_repos)))
+                lines.append('%s = %s' % (device_name, ' '.join(ordered_repos)))
+            manifests.setdefault(manifest, []).append('\n'.join(lines))
+    for manifest, manifest_sections in sorted(manifests.iteritems()):
+        manifest_path = os.path.join(output_dir, manifest)
+        with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write('# Generated by ap-assignments.py\n\n')
+            manifest_file.write('\n\n'.join(manifest_sections))
+            manifest_file.write('\n')
+        print "Wrote %s" % manifest_path
+
+
+def main():
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(
+        description="Estimate the daily load of each device from the test "
+        "assignments and balance the assignments within each device type.")
+    parser.add_argument("--device-manifests",
+                        dest="device_manifest_pattern",
+                        default="production-autophone-*-devices.ini",
+                        help="Pattern of the device manifests. "
+                        "(default: production-autophone-*-devices.ini)")
+    parser.add_argument("--test-manifests",
+                        dest="test_manifest_pattern",
+                        default="tests/production-autophone-*.ini",
+                        help="Pattern of the test manifests. "
+                        "(default: tests/production-autophone-*.ini)")
+    parser.add_argument("--log",
+                        dest="logs",
+                        action="append",
+                        default=[],
+                        help="Worker log file pattern from which to measure test "
+                        "durations. Tests without measurements use the built in "
+                        "durations. May be repeated.")
+    parser.add_argument("--push-days",
+                        dest="push_days",
+                        type=int,
+                        default=0,
+                        help="Use the maximum number of pushes per day to each "
+                        "repository over this many days from hg.mozilla.org "
+                        "rather than the built in push rates. (default: 0)")
+    parser.add_argument("--output-dir",
+                        dest="output_dir",
+                        default=None,
+                        help="Write the balanced test manifests to this directory.")
+
+    args = parser.parse_args()
+
+    device_hosts = read_devices(args.device_manifest_pattern)
+    sections = read_tests(args.test_manifest_pattern, device_hosts)
+
+    log_paths = []
+    for log_pattern in args.logs:
+        log_paths.extend(glob(log_pattern))
+    durations = read_durations(log_paths)
+
+    if args.push_days:
+        repos = set(builds)
+        for section in sections:
+            for repo_names in section.devices.values():
+                repos.update(repo_names)
+        push_rates = read_push_rates(sorted(repos), args.push_days)
+    else:
+        push_rates = builds
+
+    load_model = LoadModel(push_rates, durations)
+    assignments = get_assignments(sections, device_hosts)
+    print_loads("Device assignments", load_model, assignments)
+    print_assignments(sections)
+
+    balanced = balance(load_model, assignments)
+    print_loads("Balanced device assignments", load_model, balanced)
 
+    for missing in sorted(load_model.missing):
+        print "WARNING: no duration or push rate for %s" % (missing,)
 
+    if args.output_dir:
+        write_manifests(args.output_dir, sections, balanced, device_hosts)
 
 
+if __name__ == '__main__':
+    main()
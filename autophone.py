@@ -19,7 +19,6 @@ import socket
 import subprocess
 import sys
 import threading
-import traceback
 
 # Capture the python logger class before mozlog changes it.
 LOGGER_CLASS = logging.getLoggerClass()
@@ -39,6 +38,9 @@ from adb_android import ADBAndroid
 from autophonelogserver import LogRecordServer
 from autophonepulsemonitor import AutophonePulseMonitor
 from autophonetreeherder import AutophoneTreeherder
+from fleetexecutor import FleetExecutor
+from heartbeattable import HeartbeatTable
+from lockprofiler import LockProfiler
 from mailer import Mailer
 from options import AutophoneOptions
 from phonestatus import PhoneStatus
@@ -98,7 +100,19 @@ class AutoPhone(object):
                     if line == 'quit' or line == 'exit':
                         return
                     response = self.server.cmd_cb(line)
-                    self.request.send(response + '\n')
+                    if isinstance(response, basestring):
+                        self.request.send(response + '\n')
+                        continue
+                    # Stream the results of long running commands as
+                    # they become available. Make sure the generator
+                    # is closed in this thread so that it releases
+                    # the lock even if the connection is lost.
+                    try:
+                        for chunk in response:
+                            self.request.sendall(chunk)
+                        self.request.send('\n')
+                    finally:
+                        response.close()
 
     def __init__(self, loglevel, options):
         self.state = ProcessStates.STARTING
@@ -111,6 +125,12 @@ class AutoPhone(object):
                               allow_duplicates=options.allow_duplicate_jobs)
         self.phone_workers = {}  # indexed by phone id
         self.lock = threading.RLock()
+        self.lock_profiler = LockProfiler(
+            self.lock, sample_interval=options.lock_profile_interval)
+        self.fleet = FleetExecutor(LOGGER)
+        # (state, tuple of PhoneWorkerStatus) published by
+        # publish_status for the read only console commands.
+        self.status_snapshot = (None, ())
         self._tests = []
         self._devices = {} # dict indexed by device names found in devices ini file
         self.server = None
@@ -124,6 +144,18 @@ class AutoPhone(object):
         self.treeherder_thread = None
         self.logging_server = LogRecordServer(autophone=self)
         self.logging_server_thread = None
+        # Shared memory table of worker heartbeats. It must be created
+        # before any of the workers are started.
+        self.heartbeat_table = HeartbeatTable()
+        self.build_prefetcher = None
+        if options.build_prefetch_concurrency and not options.override_build_dir:
+            self.build_prefetcher = buildserver.BuildPrefetcher(
+                options.cache_dir,
+                port=options.build_cache_port,
+                max_concurrent=options.build_prefetch_concurrency,
+                max_queued=options.build_cache_size,
+                min_free_mb=options.build_prefetch_min_free_mb)
+            self.build_prefetcher.start()
 
         CONSOLE_LOGGER.info('Starting autophone.')
 
@@ -141,6 +173,7 @@ class AutoPhone(object):
         self.state = ProcessStates.RUNNING
         for worker in self.phone_workers.values():
             worker.start()
+        self.publish_status()
 
         if options.enable_pulse:
             self.pulse_monitor = AutophonePulseMonitor(
@@ -168,22 +201,22 @@ class AutoPhone(object):
                         'I will send you emails if I have any problems.\n\n')
             self.mailer.send(msg_subj, msg_body)
 
-    def _get_frames(self):
-        """Return the stack to the current location"""
-        frames = traceback.format_list(traceback.extract_stack())
-        return ''.join(frames[:-2])
+    def lock_acquire(self):
+        # Attribute the acquisition to our caller.
+        self.lock_profiler.acquire(depth=2)
 
-    def lock_acquire(self, data=None):
-        if LOGGER.getEffectiveLevel() == logging.DEBUG:
-            if self.options.verbose:
-                LOGGER.debug('lock_acquire: %s\n%s', data, self._get_frames())
-        self.lock.acquire()
+    def lock_release(self):
+        self.lock_profiler.release()
 
-    def lock_release(self, data=None):
-        if LOGGER.getEffectiveLevel() == logging.DEBUG:
-            if self.options.verbose:
-                LOGGER.debug('lock_release: %s\n%s', data, self._get_frames())
-        self.lock.release()
+    def publish_status(self):
+        """Replace the status snapshot used by the read only console
+        commands. Call with the lock held."""
+        phoneids = self.phone_workers.keys()
+        phoneids.sort()
+        self.status_snapshot = (
+            self.state,
+            tuple(self.phone_workers[phoneid].snapshot()
+                  for phoneid in phoneids))
 
     def run(self):
         self.server = self.CmdTCPServer(('0.0.0.0', self.options.port),
@@ -216,7 +249,15 @@ class AutoPhone(object):
         for worker in workers:
             if not worker.is_alive():
                 phoneid = worker.phone.id
-                LOGGER.debug('Worker %s %s is not alive', phoneid, worker.state)
+                timestamp, phone_status = worker.last_heartbeat()
+                if timestamp:
+                    last_heartbeat = '%s ago while %s' % (
+                        datetime.datetime.now(tz=pytz.utc) - timestamp,
+                        phone_status)
+                else:
+                    last_heartbeat = 'never'
+                LOGGER.debug('Worker %s %s is not alive, last heartbeat %s',
+                             phoneid, worker.state, last_heartbeat)
                 if phoneid in self.restart_workers:
                     initial_state = PhoneStatus.IDLE
                     LOGGER.info('Worker %s exited; restarting with new values.', phoneid)
@@ -231,8 +272,9 @@ class AutoPhone(object):
                     msg_body = ('Hello, this is Autophone. '
                                 'Just to let you know, '
                                 'the worker process '
-                                'for phone %s died.\n' %
-                                phoneid)
+                                'for phone %s died. '
+                                'Its last heartbeat was %s.\n' %
+                                (phoneid, last_heartbeat))
                     if worker.crashes.too_many_crashes():
                         initial_state = PhoneStatus.DISABLED
                         msg_subj += ' and was disabled'
@@ -257,6 +299,7 @@ class AutoPhone(object):
                 if worker.state == ProcessStates.STOPPING:
                     CONSOLE_LOGGER.info('Worker %s stopped', phoneid)
                     del self.phone_workers[phoneid]
+                    self.heartbeat_table.free(phoneid)
                 else:
                     if worker.state == ProcessStates.RESTARTING:
                         # The device is being restarted with a
@@ -307,17 +350,18 @@ class AutoPhone(object):
         workers which have exceeded the maximum heartbeat time.
         """
         for worker in self.phone_workers.values():
-            if not worker.last_status_msg:
+            timestamp, phone_status = worker.last_heartbeat()
+            if not timestamp:
                 continue
 
-            if worker.last_status_msg.phone_status == PhoneStatus.DISCONNECTED:
+            if phone_status == PhoneStatus.DISCONNECTED:
                 self.unrecoverable_error = True
 
             # Do not check the last timestamp of a worker that
             # is currently downloading a build due to the size
             # of the downloads and the unknown network speed.
-            elapsed = datetime.datetime.now(tz=pytz.utc) - worker.last_status_msg.timestamp
-            if worker.last_status_msg.phone_status != PhoneStatus.FETCHING and \
+            elapsed = datetime.datetime.now(tz=pytz.utc) - timestamp
+            if phone_status != PhoneStatus.FETCHING and \
                elapsed > datetime.timedelta(seconds=self.options.maximum_heartbeat):
                 CONSOLE_LOGGER.warning('check_for_unrecoverable_errors: '
                                        'Purging hung phone %s', worker.phone.id)
@@ -344,6 +388,7 @@ class AutoPhone(object):
                 if self.state == ProcessStates.RUNNING and self.pulse_monitor and \
                    not self.pulse_monitor.is_alive():
                     self.pulse_monitor.start()
+                self.publish_status()
                 # Temporarily release the lock while we are waiting
                 # for a message from the workers.
                 self.lock_release()
@@ -382,6 +427,7 @@ class AutoPhone(object):
                         # dictionary. Otherwise, the phone will be
                         # detected as dead and will be restarted.
                         del self.phone_workers[msg.phone.id]
+                        self.heartbeat_table.free(msg.phone.id)
                     CONSOLE_LOGGER.info('Worker %s shutdown', msg.phone.id)
         except KeyboardInterrupt:
             pass
@@ -399,8 +445,9 @@ class AutoPhone(object):
                 self.treeherder.shutdown()
                 if self.treeherder_thread:
                     self.treeherder_thread.join()
-            for p in self.phone_workers.values():
-                p.stop()
+            workers = self.phone_workers.values()
+            self.fleet.call(workers, 'stop')
+            for p in workers:
                 self.purge_worker(p.phone.id)
             self.lock_release()
 
@@ -448,6 +495,9 @@ class AutoPhone(object):
         app_name = job_data['app_name']
         build_url = job_data['build']
         tests = job_data['tests']
+        # The tests for which jobs were created determine what to
+        # prefetch.
+        prefetch_tests = []
 
         phoneids = set([test.phone.id for test in tests])
         for phoneid in phoneids:
@@ -485,6 +535,7 @@ class AutoPhone(object):
                                           enable_unittests=enable_unittests,
                                           device=phoneid)
             if new_tests:
+                prefetch_tests.extend(runnable_tests)
                 self.treeherder.submit_pending(phoneid,
                                                build_url,
                                                job_data['repo'],
@@ -500,15 +551,91 @@ class AutoPhone(object):
                             phoneid, build_url, runnable_tests,
                             enable_unittests)
                 p.new_job()
+        if prefetch_tests and self.build_prefetcher:
+            test_package_names = set()
+            for t in prefetch_tests:
+                test_package_names.update(t.get_test_package_names())
+            self.build_prefetcher.prefetch(
+                build_url,
+                enable_unittests=any(t.enable_unittests for t in prefetch_tests),
+                test_package_names=test_package_names,
+                builder_type=job_data['builder_type'])
 
     def route_cmd(self, data):
-        response = ''
-        self.lock_acquire(data=data)
+        """Return the response to the command in data either as a
+        string or as a generator of strings which must be closed by
+        the caller."""
+        response = self._route_read_only_cmd(data)
+        if response is not None:
+            return response
+        return self._route_locked_cmd(data)
+
+    def _route_locked_cmd(self, data):
+        # The lock is held until the response has been completely
+        # generated.
+        self.lock_acquire()
         try:
             response = self._route_cmd(data)
+            if isinstance(response, basestring):
+                yield response
+            else:
+                for chunk in response:
+                    yield chunk
+            self.publish_status()
         finally:
-            self.lock_release(data=data)
-        return response
+            self.lock_release()
+
+    def _fleet_response(self, workers, method, args):
+        """Generate the response to a device command as the results
+        from each of the workers arrive."""
+        for result in self.fleet.run(workers, method, *args):
+            prefix = '%s: ' % result.phoneid if len(workers) > 1 else ''
+            if result.error:
+                yield '%serror: %s\n' % (prefix, result.error)
+            elif result.value is not None:
+                yield '%s%s\n' % (prefix, result.value)
+        yield 'ok'
+
+    def _route_read_only_cmd(self, data):
+        """Respond to commands which only report status using the
+        last published status snapshot without acquiring the lock.
+        Return None if data is not a read only command."""
+        cmd, space, params = data.strip().partition(' ')
+        cmd = cmd.lower()
+        if cmd == 'autophone-status':
+            LOGGER.debug('route_cmd: %s', data)
+            state, workers = self.status_snapshot
+            response = 'state: %s\n' % state
+            for worker in workers:
+                response += worker.status()
+            response += 'ok'
+            return response
+        if cmd == 'device-status':
+            LOGGER.debug('route_cmd: %s', data)
+            phoneid, space, params = params.partition(' ')
+            response = 'error: phone not found'
+            state, workers = self.status_snapshot
+            for worker in workers:
+                if phoneid.lower() == 'all' or worker.phone.serial == phoneid or \
+                   worker.phone.id == phoneid:
+                    response = '%s\nok' % worker.status()
+            return response
+        if cmd == 'autophone-lockstats':
+            LOGGER.debug('route_cmd: %s', data)
+            return '%sok' % self.lock_profiler.report()
+        if cmd == 'autophone-jobspending':
+            LOGGER.debug('route_cmd: %s', data)
+            state, workers = self.status_snapshot
+            pending = sum(self.jobs.jobs_pending(device=worker.phone.id)
+                          for worker in workers)
+            return 'pending: %d\nok' % pending
+        if cmd == 'autophone-pulsestats':
+            LOGGER.debug('route_cmd: %s', data)
+            pulse_monitor = self.pulse_monitor
+            if not pulse_monitor:
+                return 'pulse disabled\nok'
+            return '%sok' % pulse_monitor.pipeline.report()
+        return None
 
     def _route_cmd(self, data):
         # There is not currently any way to get proper responses for commands
@@ -534,20 +661,15 @@ class AutoPhone(object):
                 response = 'Unknown command device-%s' % cmd
             else:
                 phoneid, space, params = params.partition(' ')
-                response = 'error: phone not found'
-                for worker in self.phone_workers.values():
-                    if phoneid.lower() == 'all' or worker.phone.serial == phoneid or \
-                       worker.phone.id == phoneid:
-                        f = getattr(worker, cmd)
-                        if params:
-                            value = f(params)
-                        else:
-                            value = f()
-                        if value is not None:
-                            response = '%s\n' % value
-                        else:
-                            response = ''
-                        response += 'ok'
+                workers = [worker for worker in self.phone_workers.values()
+                           if phoneid.lower() == 'all' or
+                           worker.phone.serial == phoneid or
+                           worker.phone.id == phoneid]
+                if not workers:
+                    response = 'error: phone not found'
+                else:
+                    args = (params,) if params else ()
+                    response = self._fleet_response(workers, cmd, args)
         elif cmd == 'autophone-add-device':
             phoneid, space, serialno = params.partition(' ')
             if phoneid in self.phone_workers:
@@ -559,8 +681,7 @@ class AutoPhone(object):
         elif cmd == 'autophone-restart':
             self.state = ProcessStates.RESTARTING
             CONSOLE_LOGGER.info('Restarting Autophone...')
-            for worker in self.phone_workers.values():
-                worker.shutdown()
+            self.fleet.call(self.phone_workers.values(), 'shutdown')
         elif cmd == 'autophone-stop':
             CONSOLE_LOGGER.info('Stopping Autophone...')
             self.stop()
@@ -571,13 +692,6 @@ class AutoPhone(object):
             LOGGER.info(params)
         elif cmd == 'autophone-triggerjobs':
             response = self.trigger_jobs(params)
-        elif cmd == 'autophone-status':
-            response = 'state: %s\n' % self.state
-            phoneids = self.phone_workers.keys()
-            phoneids.sort()
-            for i in phoneids:
-                response += self.phone_workers[i].status()
-            response += 'ok'
         elif cmd == 'autophone-help':
             response = '''
 Autophone command help:
@@ -601,6 +715,17 @@ autophone-shutdown
 autophone-status
     Generate a status report for each device.
 
+autophone-jobspending
+    Report the number of jobs pending on all of the devices.
+
+autophone-lockstats
+    Report the sampled wait and hold times of the Autophone lock for
+    each call site. Requires --lock-profile-interval.
+
+autophone-pulsestats
+    Report the queue depths of the pulse message pipeline and the
+    latency of each of its stages.
+
 autophone-stop
     Immediately stop autophone and all worker processes; may be
     delayed by pending download.
@@ -703,7 +828,9 @@ ok
                              self.options,
                              self.queue,
                              self.loglevel,
-                             self.mailer)
+                             self.mailer,
+                             self.heartbeat_table,
+                             self.heartbeat_table.allocate(phone.id))
         self.phone_workers[phone.id] = worker
         return worker
 
@@ -714,6 +841,7 @@ ok
             del self.phone_workers[phoneid]
         if phoneid in self.restart_workers:
             del self.restart_workers[phoneid]
+        self.heartbeat_table.free(phoneid)
         for t in PhoneTest.match(phoneid=phoneid):
             t.remove()
 
@@ -790,7 +918,8 @@ ok
                     device_ready_retry_attempts=self.options.device_ready_retry_attempts,
                     logger_name=device_name,
                     verbose=self.options.verbose,
-                    test_root=test_root)
+                    test_root=test_root,
+                    capabilities_dir=self.options.device_capabilities_dir or None)
                 dm._logger = utils.getLogger(name=device_name)
                 device = {"device_name": device_name,
                           "serialno": serialno,
@@ -975,8 +1104,7 @@ ok
 
     def reset_phones(self):
         LOGGER.info('Resetting phones...')
-        for phoneid, phone in self.phone_workers.iteritems():
-            phone.reboot()
+        self.fleet.call(self.phone_workers.values(), 'reboot')
 
     def on_build(self, build_data):
         LOGGER.debug('on_build: build_data: %s', build_data)
@@ -1115,10 +1243,13 @@ ok
             LOGGER.debug('AutoPhone.shutdown: stopping pulse monitor')
             self.pulse_monitor.stop()
             self.pulse_monitor = None
+        if self.build_prefetcher:
+            self.build_prefetcher.stop()
+            self.build_prefetcher = None
         LOGGER.debug('AutoPhone.shutdown: shutting down workers')
-        for p in self.phone_workers.values():
-            LOGGER.debug('AutoPhone.shutdown: shutting down worker %s', p.phone.id)
-            p.shutdown()
+        for result in self.fleet.run(self.phone_workers.values(), 'shutdown'):
+            LOGGER.debug('AutoPhone.shutdown: shut down worker %s %s',
+                         result.phoneid, result.error or '')
         LOGGER.debug('AutoPhone.shutdown: exit')
 
 def load_autophone_options(cmd_options):
@@ -1250,7 +1381,8 @@ def autophone_runner(options):
             override_build_dir=options.override_build_dir,
             build_cache_size=options.build_cache_size,
             build_cache_expires=options.build_cache_expires,
-            treeherder_url=options.treeherder_url)
+            treeherder_url=options.treeherder_url,
+            peers=buildserver.parse_peers(options.build_cache_peers))
     except builds.BuildCacheException, e:
         print '''%s
 
@@ -1265,7 +1397,7 @@ unpacked tests package for the build.
         raise
 
     build_cache_server = buildserver.BuildCacheServer(
-        ('127.0.0.1', options.build_cache_port),
+        (options.build_cache_host, options.build_cache_port),
         buildserver.BuildCacheHandler)
     build_cache_server.build_cache = build_cache
     build_cache_server_thread = threading.Thread(
@@ -1424,6 +1556,27 @@ def main():
                       default=False,
                       help='Process jobs in LIFO order. Default of False '
                       'implies FIFO order.')
+    parser.add_option('--build-affinity-max-age',
+                      dest='build_affinity_max_age',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='Prefer jobs whose build is already installed on '
+                      'the device or already cached on the host unless a job '
+                      'has been pending for more than this number of seconds, '
+                      'and keep a build installed while jobs for it are '
+                      'pending. Defaults to 0 which disables build affinity.')
+    parser.add_option('--device-pool-steal-age',
+                      dest='device_pool_steal_age',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='Allow a device with no jobs to claim a job which '
+                      'has been pending for more than this number of seconds '
+                      'on another device of the same type, i.e. whose name '
+                      'differs only in the trailing number, if the job\'s '
+                      'tests are defined identically for both devices. '
+                      'Defaults to 0 which disables claiming jobs.')
     parser.add_option('--build-cache-port',
                       dest='build_cache_port',
                       action='store',
@@ -1433,6 +1586,46 @@ def main():
                       'multiple instances of autophone, this will have to be '
                       'different in each. Defaults to %d.' %
                       buildserver.DEFAULT_PORT)
+    parser.add_option('--build-cache-host',
+                      dest='build_cache_host',
+                      action='store',
+                      type='string',
+                      default='127.0.0.1',
+                      help='Address on which the build-cache server listens. '
+                      'Set to the address of a network interface, or 0.0.0.0, '
+                      'to allow the build-cache servers of other autophone '
+                      'hosts to fetch cached builds from this host. Only '
+                      'local clients may request builds. Defaults to '
+                      '127.0.0.1.')
+    parser.add_option('--build-cache-peer',
+                      dest='build_cache_peers',
+                      action='append',
+                      default=[],
+                      help='host:port of the build-cache server of another '
+                      'autophone host. Builds and test packages are fetched '
+                      'from a peer which has already downloaded them before '
+                      'falling back to downloading them. The port defaults to '
+                      '%d. To specify multiple peers, specify them with '
+                      'additional --build-cache-peer options.' %
+                      buildserver.DEFAULT_PORT)
+    parser.add_option('--build-prefetch-concurrency',
+                      dest='build_prefetch_concurrency',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='Prefetch the build and test packages for new jobs '
+                      'into the build cache in the background, with at most '
+                      'this number of prefetches at a time. At most '
+                      'build_cache_size builds are queued for prefetching. '
+                      'Defaults to 0 which disables prefetching.')
+    parser.add_option('--build-prefetch-min-free-mb',
+                      dest='build_prefetch_min_free_mb',
+                      action='store',
+                      type='int',
+                      default=1024,
+                      help='Do not prefetch builds when the build cache '
+                      'directory has less than this number of megabytes free. '
+                      'Defaults to 1024.')
     parser.add_option('--devices',
                       dest='devicescfg',
                       action='store',
@@ -1567,6 +1760,26 @@ def main():
                       'of the test root to ADBAndroid. Can be overridden '
                       'via a test_root option for a device in the devices.ini '
                       'file.')
+    parser.add_option('--lock-profile-interval',
+                      dest='lock_profile_interval',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='Measure the wait and hold times of every Nth '
+                      'acquisition of the Autophone lock. The times are '
+                      'reported per call site by the autophone-lockstats '
+                      'command. Defaults to 0 which disables profiling.')
+    parser.add_option('--device-capabilities-dir',
+                      dest='device_capabilities_dir',
+                      action='store',
+                      type='string',
+                      default='device-capabilities',
+                      help='Directory where the probed capabilities of each '
+                      'device are saved so that they do not need to be '
+                      'probed again when Autophone restarts unless the '
+                      'build on the device has changed. Set to an empty '
+                      'string to always probe the devices. '
+                      'Defaults to device-capabilities.')
 
     (cmd_options, args) = parser.parse_args()
     options = load_autophone_options(cmd_options)
@@ -109,11 +109,30 @@ class AutophoneCrashProcessor(object):
         self.adb.rm(os.path.join(self.remote_profile_dir, 'minidumps', '*'),
                     force=True, recursive=True, root=root)
 
-    def clear(self):
-        """Delete any existing ANRs, tombstones and crash dumps on the device."""
-        self.delete_anr_traces()
-        self.delete_tombstones()
-        self.delete_crash_dumps()
+    def clear(self, root=True):
+        """Delete any existing ANRs, tombstones and crash dumps on the device.
+
+        The deletions are performed as a single batch of operations on
+        the device rather than one adb call per operation.
+        Errors deleting the tombstones and crash dumps are raised as
+        ADBErrors. A failure to initialize the ANR traces is only
+        logged.
+        """
+        with self.adb.batch(root=root) as b:
+            b.rm(TOMBSTONES, force=True, recursive=True)
+            b.rm(os.path.join(self.remote_profile_dir, 'minidumps', '*'),
+                 force=True, recursive=True)
+            b.rm(TRACES, force=True)
+            # Queue the traces initialization unchecked so that its
+            # failure does not stop the batch.
+            traces = [b.shell('echo > %s' % TRACES, check=False),
+                      b.shell('chmod 666 %s' % TRACES, check=False)]
+        for result in traces:
+            if not result.ok:
+                logger = utils.getLogger()
+                logger.warning("Could not initialize ANR traces %s, %s",
+                               TRACES, result)
+                break
 
     def check_for_tombstones(self, root=True):
         """Copies tombstones from the device to the upload_dir before deleting
@@ -126,7 +145,7 @@ class AutophoneCrashProcessor(object):
         if self.adb.exists(TOMBSTONES, root=root):
             self.adb.chmod(TOMBSTONES, root=root)
             self.adb.chmod(os.path.join(TOMBSTONES, '*'), mask='666', root=root)
-            self.adb.pull(TOMBSTONES, self.upload_dir)
+            self.adb.pull_tree(TOMBSTONES, self.upload_dir, root=root)
             self.delete_tombstones()
             for f in glob.glob(os.path.join(self.upload_dir, "tombstone_??")):
                 for i in xrange(1, sys.maxint):
@@ -300,13 +319,14 @@ class AutophoneCrashProcessor(object):
         # only process them once.
         temp_upload_dir = tempfile.mkdtemp()
         self.adb.chmod(self.remote_dump_dir, recursive=True, root=root)
-        self.adb.pull(self.remote_dump_dir, temp_upload_dir)
+        self.adb.pull_tree(self.remote_dump_dir, temp_upload_dir, root=root)
         if clean:
             self.adb.rm(self.remote_dump_dir + "/*", force=True, root=True)
         if self.adb.is_dir(self.remote_pending_crashreports_dir, root=root):
             self.adb.chmod(self.remote_pending_crashreports_dir, recursive=True,
                            root=root)
-            self.adb.pull(self.remote_pending_crashreports_dir, temp_upload_dir)
+            self.adb.pull_tree(self.remote_pending_crashreports_dir,
+                                temp_upload_dir, root=root)
             if clean:
                 self.adb.rm(self.remote_pending_crashreports_dir + "/*", force=True, root=True)
         dump_files = [(path, os.path.splitext(path)[0] + '.extra') for path in
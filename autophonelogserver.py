@@ -2,65 +2,341 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-# Modeled after the example https://docs.python.org/2.7/howto/logging-cookbook.html#sending-and-receiving-logging-events-across-a-network
+# Originally modeled after the example
+# https://docs.python.org/2.7/howto/logging-cookbook.html#sending-and-receiving-logging-events-across-a-network
+#
+# Rather than pickling each LogRecord and writing it to the socket
+# individually, workers encode a minimal set of record fields as JSON
+# lines which are accumulated into frames and sent from a background
+# thread. The main process reads the frames from all of the workers
+# in a single select loop.
 
-import SocketServer
+import Queue
+import errno
+import json
 import logging
 import logging.handlers
-import pickle
+import multiprocessing
+import multiprocessing.util
+import select
+import socket
 import struct
+import threading
+import time
 
 import utils
 
-class LogRecordHandler(SocketServer.StreamRequestHandler):
+# The LogRecord attributes which are sent to the main process. The
+# message is sent fully formatted so that args do not need to be
+# serialized.
+LOG_RECORD_FIELDS = ('name', 'levelno', 'levelname', 'pathname',
+                     'lineno', 'funcName', 'created', 'process',
+                     'processName', 'thread', 'threadName')
 
-    def handle(self):
+
+class LogRecordSocketHandler(logging.Handler):
+    """Handler which sends batches of log records to a LogRecordServer.
+
+    emit() only encodes the record and places it on a bounded queue
+    without blocking. Records which arrive while the queue is full or
+    while the LogRecordServer is unreachable are dropped and counted
+    in dropped. The count of dropped records is reported to the
+    LogRecordServer as a warning once the connection is available.
+
+    A background thread collects the queued records into frames which
+    are sent when they reach max_frame_size bytes or when
+    flush_interval seconds have elapsed since the first record in the
+    frame was queued. Each frame is a 4 byte big endian length
+    followed by the records encoded as JSON, one per line.
+    """
+
+    MAX_QUEUE_SIZE = 10000
+    MAX_FRAME_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 0.25
+    CLOSE_TIMEOUT = 5
+    RETRY_START = 1.0
+    RETRY_MAX = 30.0
+    RETRY_FACTOR = 2.0
+
+    def __init__(self,
+                 host='localhost',
+                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT,
+                 max_queue_size=MAX_QUEUE_SIZE,
+                 max_frame_size=MAX_FRAME_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        logging.Handler.__init__(self)
+        self.host = host
+        self.port = port
+        self.max_frame_size = max_frame_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(max_queue_size)
+        self.sock = None
+        self.retry_time = None
+        self.retry_period = self.RETRY_START
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.sent = 0
+        self.closing = threading.Event()
+        self.sender_thread = threading.Thread(target=self._sender,
+                                              name='LogSenderThread')
+        self.sender_thread.daemon = True
+        self.sender_thread.start()
+        # multiprocessing children exit without calling
+        # logging.shutdown, so make sure the queued records are sent
+        # when the process exits.
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def encode(self, record):
+        fields = dict((field, getattr(record, field, None))
+                      for field in LOG_RECORD_FIELDS)
+        msg = record.getMessage()
+        if isinstance(msg, str):
+            msg = msg.decode('utf-8', 'replace')
+        fields['msg'] = msg
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging._defaultFormatter.formatException(
+                record.exc_info)
+        if record.exc_text:
+            exc_text = record.exc_text
+            if isinstance(exc_text, str):
+                exc_text = exc_text.decode('utf-8', 'replace')
+            fields['exc_text'] = exc_text
+        return json.dumps(fields, separators=(',', ':')) + '\n'
+
+    def emit(self, record):
+        # emit is called with the handler's lock held.
         try:
-            data = ''
-            while True:
-                data = self.connection.recv(4)
-                if len(data) < 4:
-                    break
-                pickle_len = struct.unpack('>L', data)[0]
-                data = self.connection.recv(pickle_len)
-                while len(data) < pickle_len:
-                    data = data + self.connection.recv(pickle_len - len(data))
-                record = logging.makeLogRecord(pickle.loads(data))
-                logger = utils.getLogger(record.name)
-                logger.handle(record)
+            line = self.encode(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
         except:
-            logger = utils.getLogger()
-            logger.exception("Error receiving log record: data: %s", data)
+            self.handleError(record)
+            return
+        if self.closing.is_set():
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _drop(self, count):
+        self.acquire()
+        try:
+            self.dropped += count
+        finally:
+            self.release()
+
+    def _dropped_line(self):
+        """Return an encoded warning reporting the records dropped
+        since the last report or None if there are none."""
+        self.acquire()
+        try:
+            dropped = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+        finally:
+            self.release()
+        if not dropped:
+            return None
+        record = logging.makeLogRecord({
+            'name': utils.getLogger().name,
+            'levelno': logging.WARNING,
+            'levelname': logging.getLevelName(logging.WARNING),
+            'msg': 'LogRecordSocketHandler dropped %d log records '
+                   '(%d total)' % (dropped, self.dropped)})
+        return self.encode(record)
+
+    def _connect(self):
+        if self.sock:
+            return True
+        now = time.time()
+        if self.retry_time and now < self.retry_time:
+            return False
+        try:
+            self.sock = socket.create_connection((self.host, self.port))
+            self.retry_time = None
+            self.retry_period = self.RETRY_START
+            return True
+        except socket.error:
+            self.retry_time = now + self.retry_period
+            self.retry_period = min(self.retry_period * self.RETRY_FACTOR,
+                                    self.RETRY_MAX)
+            return False
+
+    def _disconnect(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def _send_frame(self, lines):
+        if not self._connect():
+            self._drop(len(lines))
+            return
+        dropped_line = self._dropped_line()
+        if dropped_line:
+            lines.insert(0, dropped_line)
+        payload = ''.join(lines)
+        try:
+            self.sock.sendall(struct.pack('>L', len(payload)) + payload)
+            self.sent += len(lines)
+        except socket.error:
+            self._disconnect()
+            self._drop(len(lines) - (1 if dropped_line else 0))
+
+    def _sender(self):
+        while True:
+            try:
+                line = self.queue.get(timeout=self.flush_interval)
+            except Queue.Empty:
+                if self.closing.is_set():
+                    break
+                continue
+            lines = [line]
+            size = len(line)
+            deadline = time.time() + self.flush_interval
+            while size < self.max_frame_size:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0 and not self.closing.is_set():
+                        line = self.queue.get(timeout=remaining)
+                    else:
+                        line = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                lines.append(line)
+                size += len(line)
+            self._send_frame(lines)
+        self._disconnect()
+
+    def close(self):
+        """Send any queued records and stop the sender thread."""
+        self.closing.set()
+        if self.sender_thread.is_alive():
+            self.sender_thread.join(self.CLOSE_TIMEOUT)
+        logging.Handler.close(self)
 
-class LogRecordServer(SocketServer.ThreadingTCPServer):
 
-    allow_reuse_address = True
+class LogRecordServer(object):
+    """Receive log records from LogRecordSocketHandlers and pass them
+    to the corresponding loggers in this process.
+
+    All connections are serviced by the thread calling serve_forever.
+    """
+
     request_queue_size = 100
+    recv_size = 64 * 1024
+    # Frames larger than this indicate a corrupt stream.
+    max_frame_size = 16 * 1024 * 1024
 
     def __init__(self,
                  autophone=None,
                  host='localhost',
-                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT,
-                 handler=LogRecordHandler):
-        SocketServer.ThreadingTCPServer.__init__(self, (host, port), handler)
+                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT):
         self.autophone = autophone
         self.shutdown_requested = False
         self.timeout = 1
+        self.connections = {} # dict of receive buffers indexed by socket
+        self.frames = 0
+        self.records = 0
+        self.errors = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
 
-    def serve_forever(self):
-        import select
-        while not self.shutdown_requested:
+    def _accept(self):
+        try:
+            conn, address = self.socket.accept()
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+            return
+        conn.setblocking(0)
+        self.connections[conn] = ''
+
+    def _close(self, conn):
+        del self.connections[conn]
+        try:
+            conn.close()
+        except socket.error:
+            pass
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(self.recv_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._close(conn)
+            return
+        buf = self.connections[conn] + data
+        offset = 0
+        while len(buf) - offset >= 4:
+            frame_len = struct.unpack('>L', buf[offset:offset+4])[0]
+            if frame_len > self.max_frame_size:
+                logger = utils.getLogger()
+                logger.error('Closing log connection: frame length %d '
+                             'exceeds %d', frame_len, self.max_frame_size)
+                self._close(conn)
+                return
+            end = offset + 4 + frame_len
+            if len(buf) < end:
+                break
+            self.handle_frame(buf[offset+4:end])
+            offset = end
+        self.connections[conn] = buf[offset:]
+
+    def make_record(self, fields):
+        # Return strings as str, as a pickled LogRecord would, so that
+        # the formatters do not mix unicode with utf-8 encoded data.
+        for key, value in fields.iteritems():
+            if isinstance(value, unicode):
+                fields[key] = value.encode('utf-8')
+        record = logging.makeLogRecord(fields)
+        record.msecs = (record.created - long(record.created)) * 1000
+        record.relativeCreated = (record.created - logging._startTime) * 1000
+        return record
+
+    def handle_frame(self, payload):
+        self.frames += 1
+        for line in payload.splitlines():
             try:
-                rlist, wlist, xlist = select.select(
-                    [self.socket.fileno()],
-                    [],
-                    [],
-                    self.timeout)
-                if rlist:
-                    self.handle_request()
+                record = self.make_record(json.loads(line))
+                logger = utils.getLogger(record.name)
+                logger.handle(record)
+                self.records += 1
             except:
+                self.errors += 1
                 logger = utils.getLogger()
-                logger.exception("Error selecting log record socket")
+                logger.exception("Error receiving log record: data: %r", line)
+
+    def serve_forever(self):
+        try:
+            while not self.shutdown_requested:
+                try:
+                    rlist, wlist, xlist = select.select(
+                        [self.socket] + self.connections.keys(),
+                        [],
+                        [],
+                        self.timeout)
+                    for sock in rlist:
+                        if sock is self.socket:
+                            self._accept()
+                        else:
+                            self._read(sock)
+                except:
+                    logger = utils.getLogger()
+                    logger.exception("Error selecting log record socket")
+        finally:
+            for conn in self.connections.keys():
+                self._close(conn)
+            self.socket.close()
 
     def shutdown(self):
         self.shutdown_requested = True
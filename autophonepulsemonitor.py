@@ -2,12 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import Queue as PyQueue
+import collections
 import json
 import logging
 import socket
 import threading
 import time
 
+from contextlib import contextmanager
+
 from kombu import Connection, Exchange, Queue
 import taskcluster
 
@@ -16,6 +20,182 @@ from builds import get_treeherder_tier
 
 DEFAULT_SSL_PORT = 5671
 
+
+class PulseStageStats(object):
+    """Accumulated latency in seconds of a pipeline stage."""
+    def __init__(self):
+        self.count = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds_total += seconds
+        self.seconds_max = max(self.seconds_max, seconds)
+
+
+class PulseItem(object):
+    """A pulse message being processed by a PulsePipeline.
+
+    repo is the repository of the message or None until it is known.
+    result is the value returned by process which is passed to
+    deliver if it is not None.
+    """
+    def __init__(self, pipeline, sequence, repo, process, deliver):
+        self.pipeline = pipeline
+        self.sequence = sequence
+        self.repo = repo
+        self.process = process
+        self.deliver = deliver
+        self.submitted = time.time()
+        self.completed = None
+        self.done = False
+        self.result = None
+
+    def set_repo(self, repo):
+        self.pipeline.set_repo(self, repo)
+
+    @contextmanager
+    def stage(self, name):
+        """Record the time spent in the with block as stage name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.pipeline.record(name, time.time() - start)
+
+
+class PulsePipeline(object):
+    """Process pulse messages on a bounded pool of worker threads.
+
+    submit() queues a message for processing and blocks while
+    max_queue_size messages are already waiting so that a burst of
+    messages applies back pressure to the pulse consumer rather than
+    growing without bound. process(item) is called on a worker thread
+    and returns the result to be passed to deliver(result) or None
+    if the message is to be ignored.
+
+    Results are delivered one at a time in the order the messages were
+    submitted among messages for the same repository. A result is
+    delivered once every earlier message has either completed or is
+    known to be for a different repository, so a slow message only
+    delays later messages for its own repository or whose repository
+    is not yet known.
+    """
+
+    WORKERS = 4
+    MAX_QUEUE_SIZE = 100
+
+    def __init__(self, workers=WORKERS, max_queue_size=MAX_QUEUE_SIZE):
+        self.queue = PyQueue.Queue(max_queue_size)
+        self.max_queue_size = max_queue_size
+        self.lock = threading.Lock()
+        self.deliver_lock = threading.Lock()
+        self.sequence = 0
+        self.pending = collections.OrderedDict() # PulseItems indexed by sequence
+        self.stats = collections.OrderedDict() # PulseStageStats indexed by stage
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='PulsePipeline-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.stats.get(name)
+            if not stats:
+                stats = self.stats[name] = PulseStageStats()
+            stats.add(seconds)
+
+    def submit(self, repo, process, deliver):
+        with self.lock:
+            self.sequence += 1
+            item = PulseItem(self, self.sequence, repo, process, deliver)
+            self.pending[item.sequence] = item
+        self.queue.put(item)
+        return item
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+
+    def set_repo(self, item, repo):
+        with self.lock:
+            item.repo = repo
+        self._deliver_ready()
+
+    def _worker(self):
+        logger = utils.getLogger()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.record('queued', time.time() - item.submitted)
+            try:
+                with item.stage('process'):
+                    item.result = item.process(item)
+            except:
+                logger.exception('PulsePipeline: error processing message')
+                item.result = None
+            with self.lock:
+                item.done = True
+                item.completed = time.time()
+            self._deliver_ready()
+
+    def _ready_items(self):
+        """Remove and return the completed items which can be
+        delivered. Must be called with lock held."""
+        ready = []
+        blocking_repos = set()
+        blocked_unknown = False
+        for sequence, item in self.pending.items():
+            if item.done and not blocked_unknown and \
+               (item.repo is None or item.repo not in blocking_repos):
+                del self.pending[sequence]
+                if item.result is not None:
+                    ready.append(item)
+                continue
+            if item.done and item.repo is None:
+                continue
+            if item.repo is None:
+                # Later messages may be for the same repository.
+                blocked_unknown = True
+            else:
+                blocking_repos.add(item.repo)
+        return ready
+
+    def _deliver_ready(self):
+        logger = utils.getLogger()
+        # Deliveries are serialized so that ready items are delivered
+        # in the order they were removed from pending.
+        with self.deliver_lock:
+            with self.lock:
+                ready = self._ready_items()
+            for item in ready:
+                self.record('ordering', time.time() - item.completed)
+                try:
+                    with item.stage('deliver'):
+                        item.deliver(item.result)
+                except:
+                    logger.exception('PulsePipeline: error delivering message')
+
+    def report(self):
+        """Return a text report of the queue depths and the latency
+        of each stage."""
+        with self.lock:
+            response = ('queued: %d/%d, in progress or awaiting delivery: %d\n' %
+                        (self.queue.qsize(), self.max_queue_size,
+                         len(self.pending)))
+            response += '%-16s %8s %10s %10s\n' % ('stage', 'count',
+                                                    'avg', 'max')
+            for name, stats in self.stats.iteritems():
+                response += '%-16s %8d %10.3f %10.3f\n' % (
+                    name, stats.count, stats.seconds_total / stats.count,
+                    stats.seconds_max)
+        return response
+
 class AutophonePulseMonitor(object):
     """AutophonePulseMonitor provides the means to be notified when
     Android builds are available for testing and when users have initiated
@@ -81,6 +261,17 @@ class AutophonePulseMonitor(object):
         drain_events. Defaults to 5 seconds.
     :param verbose: If True, will log build and job action messages.
         Defaults to False.
+    :param workers: Number of threads used to look up the metadata for
+        the messages. Defaults to PulsePipeline.WORKERS.
+    :param max_queue_size: Maximum number of messages waiting for a
+        worker thread before the pulse consumer blocks. Defaults to
+        PulsePipeline.MAX_QUEUE_SIZE.
+
+    Messages are acknowledged and filtered on the consumer thread by
+    their routing key and repository where possible. The remaining
+    messages are processed by a PulsePipeline, so the callbacks are
+    called on the pipeline's threads in the order the messages were
+    received for each repository.
     """
 
     def __init__(self,
@@ -98,7 +289,9 @@ class AutophonePulseMonitor(object):
                  platforms=[],
                  buildtypes=[],
                  timeout=5,
-                 verbose=False):
+                 verbose=False,
+                 workers=PulsePipeline.WORKERS,
+                 max_queue_size=PulsePipeline.MAX_QUEUE_SIZE):
 
         assert userid, "userid is required."
         assert password, "password is required."
@@ -127,12 +320,15 @@ class AutophonePulseMonitor(object):
         self.verbose = verbose
         self._stopping = threading.Event()
         self.listen_thread = None
+        self.pipeline = PulsePipeline(workers=workers,
+                                      max_queue_size=max_queue_size)
         self.queues = []
         taskcompleted_exchange = Exchange(name=taskcompleted_exchange_name, type='topic')
         # Add the new workerType names to the routing key...
         # See https://bugzilla.mozilla.org/show_bug.cgi?id=1307771
         platforms = list(self.platforms)
         platforms.extend(['gecko-%s-b-android' % level for level in [1,2,3]])
+        self.worker_types = set(platforms)
         for platform in platforms:
             # Create a queue for each platform
             self.queues.append(Queue(name='queue/%s/%s' % (userid, taskcompleted_queue_name),
@@ -167,6 +363,7 @@ class AutophonePulseMonitor(object):
         logger.debug('AutophonePulseMonitor stopping')
         self._stopping.set()
         self.listen_thread.join()
+        self.pipeline.stop()
         logger.debug('AutophonePulseMonitor stopped')
 
     def is_alive(self):
@@ -223,19 +420,50 @@ class AutophonePulseMonitor(object):
                 if connection and not restart:
                     connection.release()
 
+    def accept_routing_key(self, message):
+        """Return False if the routing key of a task-completed message
+        shows that the task was not run by one of the worker types of
+        interest."""
+        routing_key = getattr(message, 'delivery_info', {}).get('routing_key')
+        if not routing_key:
+            return True
+        # primary.<taskId>.<runId>.<workerGroup>.<workerId>.<provisionerId>.<workerType>...
+        fields = routing_key.split('.')
+        return len(fields) < 7 or fields[6] in self.worker_types
+
     def handle_message(self, data, message):
         if self._stopping.is_set():
             return
         message.ack()
         logger = utils.getLogger()
+        start = time.time()
         if (self.treeherder_url and 'action' in data and
               'project' in data and 'job_id' in data):
-            self.handle_jobaction(data, message)
+            if self.trees and data['project'] not in self.trees:
+                logger.debug('AutophonePulseMonitor.handle_message: '
+                             'ignoring job action %s on tree %s',
+                             data['action'], data['project'])
+                return
+            self.pipeline.record('filter', time.time() - start)
+            self.pipeline.submit(
+                data['project'],
+                lambda item: self.handle_jobaction(data, message, item),
+                self.jobaction_callback)
         elif 'status' in data:
             logger.debug('handle_message: data: %s, message: %s', data, message)
-            self.handle_taskcompleted(data, message)
-
-    def handle_jobaction(self, data, message):
+            if not self.accept_routing_key(message):
+                logger.debug('handle_message: ignoring routing key %s',
+                             message.delivery_info['routing_key'])
+                return
+            self.pipeline.record('filter', time.time() - start)
+            self.pipeline.submit(
+                None,
+                lambda item: self.handle_taskcompleted(data, message, item),
+                self.build_callback)
+
+    def handle_jobaction(self, data, message, item):
+        """Return the jobaction_data for the job action message or
+        None if it is to be ignored."""
         logger = utils.getLogger()
         if self.verbose:
             logger.debug(
@@ -253,7 +481,8 @@ class AutophonePulseMonitor(object):
                          'ignoring job action %s on tree %s', action, project)
             return
 
-        job = self.get_treeherder_job(project, job_id)
+        with item.stage('treeherder'):
+            job = self.get_treeherder_job(project, job_id)
         if not job:
             logger.debug('AutophonePulseMonitor.handle_jobaction_event: '
                          'ignoring unknown job id %s on tree %s', job_id, project)
@@ -268,7 +497,8 @@ class AutophonePulseMonitor(object):
                          'ignoring build type %s on tree %s', build_type, project)
             return
 
-        build_info = self.get_treeherder_privatebuild_info(project, job)
+        with item.stage('treeherder'):
+            build_info = self.get_treeherder_privatebuild_info(project, job)
         if not build_info:
             logger.debug('AutophonePulseMonitor.handle_jobaction_event: '
                          'ignoring missing build info on tree %s', project)
@@ -276,7 +506,8 @@ class AutophonePulseMonitor(object):
         build_url = build_info['build_url']
         builder_type = build_info['builder_type']
 
-        build_data = utils.get_build_data(build_url, builder_type=builder_type)
+        with item.stage('build_data'):
+            build_data = utils.get_build_data(build_url, builder_type=builder_type)
         if not build_data:
             logger.debug('AutophonePulseMonitor.handle_jobaction_event: '
                          'ignoring missing build_data on url %s', build_url)
@@ -315,9 +546,11 @@ class AutophonePulseMonitor(object):
             'builder_type': builder_type,
         }
         jobaction_data.update(build_data)
-        self.jobaction_callback(jobaction_data)
+        return jobaction_data
 
-    def handle_taskcompleted(self, data, message):
+    def handle_taskcompleted(self, data, message, item):
+        """Return the build_data for the task-completed message or
+        None if it is to be ignored."""
         logger = utils.getLogger()
         if self.verbose:
             logger.debug(
@@ -329,8 +562,13 @@ class AutophonePulseMonitor(object):
         artifact_data = {}
         task_id = data['status']['taskId']
         run_id = data['runId']
-        task_definition = utils.get_taskcluster_task_definition(task_id)
+        with item.stage('task_definition'):
+            task_definition = utils.get_taskcluster_task_definition(task_id)
         logger.debug('handle_taskcompleted: task_definition: %s', task_definition)
+        if not task_definition:
+            logger.warning('handle_taskcompleted: task_id: %s, run_id: %s: '
+                           'no task definition', task_id, run_id)
+            return
         # Test the repo early in order to prevent unnecessary IO for irrelevent branches.
         try:
             MH_BRANCH = task_definition['payload']['env']['MH_BRANCH']
@@ -339,6 +577,7 @@ class AutophonePulseMonitor(object):
                              'skip task_definition MH_BRANCH %s',
                              task_id, run_id, MH_BRANCH)
                 return
+            item.set_repo(MH_BRANCH)
         except KeyError:
             pass
         worker_type = task_definition['workerType']
@@ -356,7 +595,8 @@ class AutophonePulseMonitor(object):
         app_data = {}
         while True:
             try:
-                artifact = artifacts.next()
+                with item.stage('artifacts'):
+                    artifact = artifacts.next()
             except StopIteration:
                 break
             key = artifact['name'].replace('public/build/', '')
@@ -367,13 +607,16 @@ class AutophonePulseMonitor(object):
             if key == 'target.apk':
                 # The actual app name may be slightly different depending on the repository.
                 app_data['org.mozilla.fennec'] = build_url
-                build_data = utils.get_build_data(build_url, builder_type=builder_type)
+                with item.stage('build_data'):
+                    build_data = utils.get_build_data(build_url, builder_type=builder_type)
                 if not build_data:
                     logger.warning('handle_taskcompleted: task_id: %s, run_id: %s: '
                                    'could not get build data for %s', task_id, run_id, build_url)
                     return
 
-                tier = get_treeherder_tier(build_data['repo'], task_id, run_id)
+                item.set_repo(build_data['repo'])
+                with item.stage('tier'):
+                    tier = get_treeherder_tier(build_data['repo'], task_id, run_id)
                 if builder_type != 'buildbot' and tier != 1:
                     logger.debug('handle_taskcompleted: ignoring worker_type: %s, tier: %s',
                                  worker_type, tier)
@@ -421,21 +664,21 @@ class AutophonePulseMonitor(object):
         logger.debug('handle_taskcompleted: task_id: %s, run_id: %s: build_data: %s',
                      task_id, run_id, build_data)
 
-        rev_json_url = build_data['changeset'].replace('/rev/', '/json-rev/')
-        rev_json = utils.get_remote_json(rev_json_url)
+        with item.stage('revision'):
+            rev_json = utils.get_revision_json(build_data['changeset'])
         if rev_json:
             build_data['comments'] = rev_json['desc']
         else:
             build_data['comments'] = 'unknown'
             logger.warning('handle_taskcompleted: task_id: %s, run_id: %s: could not get %s',
-                           task_id, run_id, rev_json_url)
+                           task_id, run_id, build_data['changeset'])
 
         if build_data['repo'] == 'try' and 'autophone' not in build_data['comments']:
             logger.debug('handle_taskcompleted: task_id: %s, run_id: %s: skip %s %s',
                          task_id, run_id, build_data['repo'], build_data['comments'])
             return
 
-        self.build_callback(build_data)
+        return build_data
 
     def get_treeherder_job(self, project, job_id):
         url = '%s/api/project/%s/jobs/%s/' % (
@@ -6,22 +6,28 @@ import ConfigParser
 import base64
 import datetime
 import glob
+import hashlib
 import json
 import os
 import re
 import shutil
+import socket
 import tempfile
+import time
 import urllib
 import urlparse
 import zipfile
 
+from multiprocessing.pool import ThreadPool
+
 import slugid
 import taskcluster
-from thclient import TreeherderClient
 
-from bs4 import BeautifulSoup
 from requests import HTTPError
 
+import buildserver
+import ftpindex
+import metadataclient
 import utils
 
 from build_dates import (TIMESTAMP, DIRECTORY_DATE, DIRECTORY_DATETIME,
@@ -43,24 +49,18 @@ REPO_URLS = {
 
 URLS_REPOS = dict([(URL, REPO) for REPO, URL in REPO_URLS.items()])
 
-# lifted from mozregression:utils.py:urlLinks
-def url_links(url):
+def url_links(url, immutable=False):
     """Return list of all non-navigation links found in web page.
 
     arguments:
     url - location of web page.
+    immutable - True if the page will not change once it exists or
+                a function of the page's links which returns True if
+                the page will not change.
 
-    returns: list of BeautifulSoup links.
+    returns: list of (href, name) tuples.
     """
-    content = utils.get_remote_text(url)
-    if not content:
-        return []
-
-    soup = BeautifulSoup(content, 'html.parser')
-    # do not return a generator but an array, so we can store it for later use
-    return [link for link in soup.findAll('a')
-            if not link.get('href').startswith('?') and
-            link.get_text() != 'Parent Directory']
+    return ftpindex.FtpIndex().links(url, immutable=immutable)
 
 def get_revision_datetimes(repo, first_revision, last_revision):
     """Returns a tuple containing dates for the revisions from
@@ -76,12 +76,13 @@ def get_revision_datetimes(repo, first_revision, last_revision):
     returns: first_datetime, last_datetime.
     """
     prefix = '%sjson-pushes?changeset=' % REPO_URLS[repo]
-    first = utils.get_remote_json('%s%s' % (prefix, first_revision))
+    client = metadataclient.get_client()
+    first = client.get_json('%s%s' % (prefix, first_revision))
     if first:
         first_timestamp = first[first.keys()[0]]['date']
     else:
         first_timestamp = None
-    last = utils.get_remote_json('%s%s' % (prefix, last_revision))
+    last = client.get_json('%s%s' % (prefix, last_revision))
     if last:
         last_timestamp = last[last.keys()[0]]['date']
     else:
@@ -127,11 +128,7 @@ def get_treeherder_job(repo, job_guid):
     logger = utils.getLogger()
     job = None
     try:
-        # Note this uses the production instance of Treeherder which
-        # should be alright since we are looking up build jobs which
-        # will always be available on the production instance.
-        client = TreeherderClient()
-        jobs = client.get_jobs(repo, job_guid=job_guid)
+        jobs = metadataclient.get_client().treeherder_jobs(repo, job_guid)
 
         if len(jobs) == 0 or len(jobs) > 1:
             logger.warning('get_treeherder_job: job_guid: %s returned %s jobs',
@@ -219,14 +216,40 @@ class BuildLocation(object):
 
 
 class TaskClusterBuilds(BuildLocation):
+    """Find builds using the TaskCluster index.
+
+    The index, task, Treeherder and artifact lookups for each revision
+    and task are independent and are made concurrently on a pool of at
+    most discovery_workers threads. Their immutable results are kept
+    in the shared metadata cache so that repeated searches over the
+    same range do not make the requests again.
+    """
+
+    DISCOVERY_WORKERS = 8
+
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext, nightly):
+                 product, build_platforms, buildfile_ext, nightly,
+                 discovery_workers=DISCOVERY_WORKERS):
         BuildLocation.__init__(self, repos, buildtypes,
                                product, build_platforms, buildfile_ext)
         self.nightly = nightly
+        self.discovery_workers = discovery_workers
         self.index = taskcluster.index.Index()
         self.queue = taskcluster.queue.Queue()
 
+    def _imap_unordered(self, func, items):
+        """Yield func(item) for each of items in the order the calls
+        complete."""
+        if not items:
+            return
+        pool = ThreadPool(min(self.discovery_workers, len(items)))
+        try:
+            for result in pool.imap_unordered(func, items):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
     def find_latest_builds(self):
         task_ids_by_repo = self._find_latest_task_ids()
         builds_by_repo = self._find_builds_by_task_ids(task_ids_by_repo)
@@ -278,19 +301,87 @@ class TaskClusterBuilds(BuildLocation):
                 logger.error('No builds found.')
                 builds = []
         else:
-            if self.nightly:
-                ftp_build_location = FtpNightly(self.repos, self.buildtypes,
-                                                self.product, self.build_platforms,
-                                                self.buildfile_ext)
-            else:
-                ftp_build_location = FtpTinderbox(self.repos, self.buildtypes,
-                                                  self.product, self.build_platforms,
-                                                  self.buildfile_ext)
-            builds = ftp_build_location.find_builds_by_directory(directory)
+            builds = self._ftp_build_location().find_builds_by_directory(directory)
         logger.debug('find_builds_by_directory: builds %s', builds)
         return builds
 
-    def find_builds_by_time(self, start_time, end_time, inclusive=True):
+    def _ftp_build_location(self):
+        if self.nightly:
+            return FtpNightly(self.repos, self.buildtypes,
+                              self.product, self.build_platforms,
+                              self.buildfile_ext)
+        return FtpTinderbox(self.repos, self.buildtypes,
+                            self.product, self.build_platforms,
+                            self.buildfile_ext)
+
+    def _ftp_builds_by_time(self, repo, repo_builds, start_time, end_time):
+        """Return the FTP builds for the part of start_time to end_time
+        before the first of the TaskCluster repo_builds."""
+        logger = utils.getLogger()
+        if len(repo_builds) == 0:
+            ftp_start_time = start_time
+            ftp_end_time = end_time
+            inclusive = True
+        else:
+            first_build_date = repo_builds[0]['date']
+            logger.debug('find_builds_by_time: repo: %s, first_build_date: %s',
+                         repo, first_build_date)
+            if first_build_date <= start_time:
+                return []
+            ftp_start_time = start_time
+            ftp_end_time = first_build_date
+            inclusive = False
+        # TaskCluster does not have builds for the full range of dates.
+        # Fallback to the FTP locations.
+        logger.debug('find_builds_by_time: fallback to ftp: repo: %s, %s-%s',
+                     repo, ftp_start_time, ftp_end_time)
+        return self._ftp_build_location().find_builds_by_time(ftp_start_time,
+                                                              ftp_end_time,
+                                                              inclusive=inclusive)
+
+    def _ftp_builds_by_revision(self, repo, repo_builds, start_revision, end_revision):
+        """Return the FTP builds for the part of start_revision to
+        end_revision before the first of the TaskCluster repo_builds."""
+        logger = utils.getLogger()
+        if len(repo_builds) == 0:
+            ftp_start_revision = start_revision
+            ftp_end_revision = end_revision
+            inclusive = True
+        else:
+            first_revision = repo_builds[0]['revision']
+            if first_revision[:12] == start_revision[:12]:
+                return []
+            ftp_start_revision = start_revision
+            ftp_end_revision = first_revision
+            inclusive = False
+        # TaskCluster does not have builds for the full range of revisions.
+        # Fallback to the FTP locations.
+        logger.debug('find_builds_by_revision: fallback to ftp: repo: %s, %s-%s',
+                     repo, ftp_start_revision, ftp_end_revision)
+        return self._ftp_build_location().find_builds_by_revision(ftp_start_revision,
+                                                                  ftp_end_revision,
+                                                                  inclusive=inclusive)
+
+    def _iter_builds(self, task_ids_by_repo, ftp_builds):
+        """Yield (repo, position, build_data) for the TaskCluster builds
+        of the tasks in task_ids_by_repo as they are resolved, followed
+        by the builds returned by ftp_builds(repo, repo_builds) for
+        each repo where repo_builds are the repo's TaskCluster builds
+        in push order. Sorting by (repo, position) orders each repo's
+        TaskCluster builds by push followed by its FTP builds."""
+        resolved_by_repo = dict((repo, []) for repo in task_ids_by_repo)
+        for repo, position, builds in self._iter_builds_by_task_ids(task_ids_by_repo):
+            resolved_by_repo[repo].append((position, builds))
+            for i, build_data in enumerate(builds):
+                yield repo, (0, position, i), build_data
+        for repo in resolved_by_repo:
+            repo_builds = [build_data
+                           for position, builds in sorted(resolved_by_repo[repo])
+                           for build_data in builds]
+            for i, build_data in enumerate(ftp_builds(repo, repo_builds)):
+                yield repo, (1, i), build_data
+
+    def _iter_builds_by_time(self, start_time, end_time):
         logger = utils.getLogger()
         logger.debug('find_builds_by_time(%s, %s)', start_time, end_time)
         if not start_time.tzinfo or not end_time.tzinfo:
@@ -298,169 +389,158 @@ class TaskClusterBuilds(BuildLocation):
 
         revisions_by_repo = self._find_revisions_by_dates(start_time, end_time)
         task_ids_by_repo = self._find_task_ids_by_revisions(revisions_by_repo)
-        builds_by_repo = self._find_builds_by_task_ids(task_ids_by_repo)
-        builds = []
-        for repo in builds_by_repo:
-            repo_builds = builds_by_repo[repo]
-            ftp_fallback = False
-            if len(repo_builds) == 0:
-                ftp_fallback = True
-                ftp_start_time = start_time
-                ftp_end_time = end_time
-                inclusive = True
-            else:
-                first_build_date = repo_builds[0]['date']
-                logger.debug('find_builds_by_time: repo: %s, first_build_date: %s',
-                             repo, first_build_date)
-                if first_build_date > start_time:
-                    ftp_fallback = True
-                    ftp_start_time = start_time
-                    ftp_end_time = first_build_date
-                    inclusive = False
-            if ftp_fallback:
-                # TaskCluster does not have builds for the full range of dates.
-                # Fallback to the FTP locations.
-                logger.debug('find_builds_by_time: fallback to ftp: repo: %s, %s-%s',
-                             repo, ftp_start_time, ftp_end_time)
-                if self.nightly:
-                    ftp_build_location = FtpNightly(self.repos, self.buildtypes,
-                                                    self.product, self.build_platforms,
-                                                    self.buildfile_ext)
-                else:
-                    ftp_build_location = FtpTinderbox(self.repos, self.buildtypes,
-                                                      self.product, self.build_platforms,
-                                                      self.buildfile_ext)
-                repo_builds.extend(ftp_build_location.find_builds_by_time(ftp_start_time,
-                                                                          ftp_end_time,
-                                                                          inclusive=inclusive))
-
+        ftp_builds = lambda repo, repo_builds: self._ftp_builds_by_time(
+            repo, repo_builds, start_time, end_time)
+        for repo, position, build_data in self._iter_builds(task_ids_by_repo,
+                                                            ftp_builds):
             # Filter by exact start and end times.
-            all_builds = list(repo_builds)
-            repo_builds = []
-            for build_data in all_builds:
-                build_date = build_data['date']
-                if build_date >= start_time and build_date <= end_time:
-                    builds.append(build_data)
-        logger.debug('find_builds_by_time: %s', builds)
-        return builds
+            build_date = build_data['date']
+            if build_date >= start_time and build_date <= end_time:
+                yield repo, position, build_data
 
-    def find_builds_by_revision(self, start_revision, end_revision, inclusive=True):
-        logger = utils.getLogger()
+    def _iter_builds_by_revision(self, start_revision, end_revision, inclusive=True):
         revisions_by_repo = self._find_revisions_by_revisions(start_revision,
                                                               end_revision,
                                                               inclusive=inclusive)
         task_ids_by_repo = self._find_task_ids_by_revisions(revisions_by_repo)
-        builds_by_repo = self._find_builds_by_task_ids(task_ids_by_repo)
-        builds = []
-        for repo in builds_by_repo:
-            repo_builds = builds_by_repo[repo]
-            ftp_fallback = False
-
-            if len(repo_builds) == 0:
-                ftp_fallback = True
-                ftp_start_revision = start_revision
-                ftp_end_revision = end_revision
-                inclusive = True
-            else:
-                first_revision = repo_builds[0]['revision']
-                if first_revision[:12] != start_revision[:12]:
-                    ftp_fallback = True
-                    ftp_start_revision = start_revision
-                    ftp_end_revision = first_revision
-                    inclusive = False
-
-            if ftp_fallback:
-                # TaskCluster does not have builds for the full range of revisions.
-                # Fallback to the FTP locations.
-                logger.debug('find_builds_by_revision: fallback to ftp: repo: %s, %s-%s',
-                             repo, ftp_start_revision, ftp_end_revision)
-                if self.nightly:
-                    ftp_build_location = FtpNightly(self.repos, self.buildtypes,
-                                                    self.product, self.build_platforms,
-                                                    self.buildfile_ext)
-                else:
-                    ftp_build_location = FtpTinderbox(self.repos, self.buildtypes,
-                                                      self.product, self.build_platforms,
-                                                      self.buildfile_ext)
-                repo_builds.extend(
-                    ftp_build_location.find_builds_by_revision(ftp_start_revision,
-                                                               ftp_end_revision,
-                                                               inclusive=inclusive))
-            builds.extend(repo_builds)
+        ftp_builds = lambda repo, repo_builds: self._ftp_builds_by_revision(
+            repo, repo_builds, start_revision, end_revision)
+        return self._iter_builds(task_ids_by_repo, ftp_builds)
+
+    def iter_builds_by_time(self, start_time, end_time):
+        """Yield the builds between start_time and end_time as they are
+        found. The TaskCluster builds are yielded in the order they are
+        resolved, followed by any FTP builds for the earlier part of
+        the range which TaskCluster does not cover."""
+        for repo, position, build_data in self._iter_builds_by_time(start_time,
+                                                                    end_time):
+            yield build_data
+
+    def iter_builds_by_revision(self, start_revision, end_revision, inclusive=True):
+        """Yield the builds from start_revision to end_revision as they
+        are found. The TaskCluster builds are yielded in the order they
+        are resolved, followed by any FTP builds for the earlier
+        revisions which TaskCluster does not cover."""
+        for repo, position, build_data in self._iter_builds_by_revision(
+                start_revision, end_revision, inclusive=inclusive):
+            yield build_data
+
+    def find_builds_by_time(self, start_time, end_time, inclusive=True):
+        logger = utils.getLogger()
+        builds = [build_data for repo, position, build_data in
+                  sorted(self._iter_builds_by_time(start_time, end_time),
+                         key=lambda item: item[:2])]
+        logger.debug('find_builds_by_time: %s', builds)
+        return builds
+
+    def find_builds_by_revision(self, start_revision, end_revision, inclusive=True):
+        logger = utils.getLogger()
+        builds = [build_data for repo, position, build_data in
+                  sorted(self._iter_builds_by_revision(start_revision,
+                                                       end_revision,
+                                                       inclusive=inclusive),
+                         key=lambda item: item[:2])]
         logger.debug('find_builds_by_revision: %s', builds)
         return builds
 
+    def _find_task_builds(self, repo, task_id, only_run_id=None, start_time=None, end_time=None):
+        """Return the list of build_data objects for the builds of the
+        latest completed run of task_id."""
+        logger = utils.getLogger()
+        builds = []
+        url_format = 'https://queue.taskcluster.net/v1/task/%s/runs/%s/artifacts/%s'
+        re_fennec = re.compile(r'(fennec|target|geckoview_example).*apk$')
+        status = self.queue.status(task_id)['status']
+        worker_type = status['workerType']
+        builder_type = 'buildbot' if (worker_type == 'buildbot') else 'taskcluster'
+        logger.debug('_find_builds_by_task_ids: status: %s', status)
+        build_found = False
+        for run in reversed(status['runs']): # runs
+            if build_found:
+                break
+            if run['state'] != 'completed':
+                continue
+            run_id = run['runId']
+            if only_run_id is not None and only_run_id != run_id:
+                continue
+            tier = get_treeherder_tier(repo, task_id, run_id)
+            build_data = build_date = build_url = None
+            for artifact in metadataclient.get_client().artifacts(task_id, run_id):
+                # Collect all matching builds for this run.
+                artifact_name = artifact['name']
+                search = re_fennec.search(artifact_name)
+                if search:
+                    build_url = url_format % (task_id, run_id, artifact_name)
+                    if build_data:
+                        # We have already obtained build_data for this run.
+                        # We only need to copy the dict and update the build_url
+                        # for this new artifact.
+                        build_data = dict(build_data)
+                        build_data['url'] = build_url
+                    else:
+                        build_data = utils.get_build_data(build_url,
+                                                          builder_type=builder_type)
+                    if not build_data:
+                        # Failed to get the build data for this
+                        # build. Break out of the artifacts for this
+                        # run but keep looking for a build in earlier
+                        # runs.
+                        logger.warning('_find_builds_by_task_ids: '
+                                       'task_id: %s, run_id: %s: '
+                                       'could not get %s', task_id, run_id, build_url)
+                        break # artifacts
+                    # Fall back to the taskcluster workerType to get the sdk if possible
+                    if build_data['sdk'] is None:
+                        (platform, sdk) = parse_taskcluster_worker_type(worker_type)
+                        if sdk:
+                            build_data['platform'] = worker_type
+                            build_data['sdk'] = sdk
+                    if 'nightly_build' in build_data and not build_data['nightly_build']:
+                        break # artifacts
+                    build_date = build_data['date']
+                    if (start_time and end_time and build_date >= start_time and build_date <= end_time) or (start_time and build_date >= start_time) or (end_time and build_date <= end_time) or (not start_time and not end_time):
+                        build_found = True
+                        logger.debug('_find_builds_by_task_ids: adding worker_type: '
+                                     '%s, build_data: %s, tier: %s',
+                                     worker_type, build_data, tier)
+                        builds.append(build_data)
+        return builds
+
+    def _iter_builds_by_task_ids(self, task_ids_by_repo, only_run_id=None, start_time=None, end_time=None):
+        """Yield (repo, position, builds) for each of the tasks in
+        task_ids_by_repo in the order they are resolved, where position
+        is the index of the task in its repo's list and builds is the
+        list of build_data objects for the task's build_urls.
+        """
+        def find_task_builds(item):
+            repo, position, task_id = item
+            return repo, position, self._find_task_builds(repo, task_id,
+                                                          only_run_id=only_run_id,
+                                                          start_time=start_time,
+                                                          end_time=end_time)
+
+        items = [(repo, position, task_id)
+                 for repo in task_ids_by_repo
+                 for position, task_id in enumerate(task_ids_by_repo[repo])]
+        for result in self._imap_unordered(find_task_builds, items):
+            yield result
+
     def _find_builds_by_task_ids(self, task_ids_by_repo, only_run_id=None, start_time=None, end_time=None):
         """Return a list of build_data objects for the build_urls for the
         specified tasks.
         """
         logger = utils.getLogger()
+        resolved_by_repo = dict((repo, []) for repo in task_ids_by_repo)
+        for repo, position, builds in self._iter_builds_by_task_ids(
+                task_ids_by_repo, only_run_id=only_run_id,
+                start_time=start_time, end_time=end_time):
+            resolved_by_repo[repo].append((position, builds))
         builds_by_repo = {}
-        url_format = 'https://queue.taskcluster.net/v1/task/%s/runs/%s/artifacts/%s'
-        re_fennec = re.compile(r'(fennec|target|geckoview_example).*apk$')
-        for repo in task_ids_by_repo:
-            builds_by_repo[repo] = builds = []
-            for task_id in task_ids_by_repo[repo]:
-                status = self.queue.status(task_id)['status']
-                worker_type = status['workerType']
-                builder_type = 'buildbot' if (worker_type == 'buildbot') else 'taskcluster'
-                logger.debug('_find_builds_by_task_ids: status: %s', status)
-                build_found = False
-                for run in reversed(status['runs']): # runs
-                    if build_found:
-                        break
-                    if run['state'] != 'completed':
-                        continue
-                    run_id = run['runId']
-                    if only_run_id is not None and only_run_id != run_id:
-                        continue
-                    tier = get_treeherder_tier(repo, task_id, run_id)
-                    artifacts = utils.taskcluster_artifacts(task_id, run_id)
-                    try:
-                        build_data = build_date = build_url = None
-                        while True: # artifacts
-                            # Collect all matching builds for this run.
-                            artifact = artifacts.next()
-                            artifact_name = artifact['name']
-                            search = re_fennec.search(artifact_name)
-                            if search:
-                                build_url = url_format % (task_id, run_id, artifact_name)
-                                if build_data:
-                                    # We have already obtained build_data for this run.
-                                    # We only need to copy the dict and update the build_url
-                                    # for this new artifact.
-                                    build_data = dict(build_data)
-                                    build_data['url'] = build_url
-                                else:
-                                    build_data = utils.get_build_data(build_url,
-                                                                      builder_type=builder_type)
-                                if not build_data:
-                                    # Failed to get the build data for this
-                                    # build. Break out of the artifacts for this
-                                    # run but keep looking for a build in earlier
-                                    # runs.
-                                    logger.warning('_find_builds_by_task_ids: '
-                                                   'task_id: %s, run_id: %s: '
-                                                   'could not get %s', task_id, run_id, build_url)
-                                    break # artifacts
-                                # Fall back to the taskcluster workerType to get the sdk if possible
-                                if build_data['sdk'] is None:
-                                    (platform, sdk) = parse_taskcluster_worker_type(worker_type)
-                                    if sdk:
-                                        build_data['platform'] = worker_type
-                                        build_data['sdk'] = sdk
-                                if 'nightly_build' in build_data and not build_data['nightly_build']:
-                                    break # artifacts
-                                build_date = build_data['date']
-                                if (start_time and end_time and build_date >= start_time and build_date <= end_time) or (start_time and build_date >= start_time) or (end_time and build_date <= end_time) or (not start_time and not end_time):
-                                    build_found = True
-                                    logger.debug('_find_builds_by_task_ids: adding worker_type: '
-                                                 '%s, build_data: %s, tier: %s',
-                                                 worker_type, build_data, tier)
-                                    builds.append(build_data)
-                    except StopIteration:
-                        pass
-            logger.debug('_find_builds_by_task_ids: %s', builds)
+        for repo in resolved_by_repo:
+            builds_by_repo[repo] = [build_data
+                                    for position, builds in sorted(resolved_by_repo[repo])
+                                    for build_data in builds]
+        logger.debug('_find_builds_by_task_ids: %s', builds_by_repo)
         return builds_by_repo
 
     def _find_latest_task_ids(self):
@@ -495,8 +575,12 @@ class TaskClusterBuilds(BuildLocation):
                 # gecko.v2.mozilla-central.nightly.latest.mobile.android-api-16-opt
                 logger.debug('_find_latest_task_ids: task: %s', task)
                 task_id = task['taskId']
-                task_definition = self.queue.task(task_id)
+                task_definition = utils.get_taskcluster_task_definition(task_id)
                 logger.debug('_find_latest_task_ids: task_definition: %s', task_definition)
+                if not task_definition:
+                    logger.warning('_find_latest_task_ids: no task definition '
+                                   'for task_id: %s', task_id)
+                    continue
                 worker_type = task_definition['workerType']
                 # Just hard-code run_id 0 since we are only interested in the tier.
                 tier = get_treeherder_tier(repo, task_id, 0)
@@ -586,90 +670,113 @@ class TaskClusterBuilds(BuildLocation):
         namespace_version = 'v2'
         namespace_format = 'gecko.%s.%s.revision.%s.mobile'
 
-        task_ids_by_repo = {}
-
         logger.debug('_find_task_ids_by_revisions: revisions_by_repo: %s',
                      revisions_by_repo)
 
-        for repo in revisions_by_repo:
-            task_ids_by_repo[repo] = task_ids = []
-            for revision in revisions_by_repo[repo]:
-                logger.debug('_find_task_ids_by_revisions: repo: %s, revision: %s',
-                             repo, revision)
-                # We could iterate over the build_platforms by adding
-                # the build_platform to the routing key, but that will
-                # end up paying a cost of looking up obsolete
-                # platforms in perpetuity. Instead we can list the
-                # namespaces under mobile and get the currently
-                # supported namespaces and filter those.
-
-                namespace = namespace_format % (namespace_version, repo, revision)
-                payload = {}
-                response = self.index.listTasks(namespace, payload)
-                for task in response['tasks']:
-                    logger.debug('_find_task_ids_by_revisions: task: %s', task)
-                    task_id = task['taskId']
-                    task_namespace = task['namespace']
-                    task_definition = self.queue.task(task_id)
-                    logger.debug('_find_task_ids_by_revisions: task_definition: %s',
-                                 task_definition)
-                    build_data = utils.get_build_data_from_taskcluster_task_definition(task_definition)
-                    logger.debug('_find_task_ids_by_revisions: build_data: %s',
-                                 build_data)
-                    worker_type = task_definition['workerType']
-                    builder_type = 'buildbot' if worker_type == 'buildbot' else 'taskcluster'
-                    # Just hard-code run_id 0 since the tier shouldn't change.
-                    tier = get_treeherder_tier(repo, task_id, 0)
-                    platform = build_type = None
-                    if build_data:
-                        logger.debug('_find_task_ids_by_revisions: using build_data')
-                        platform = build_data['platform']
-                        build_type = build_data['build_type']
-                    elif builder_type == 'buildbot':
-                        logger.debug('_find_task_ids_by_revisions: using task_namespace')
-                        (platform, build_type) = parse_taskcluster_namespace(task_namespace)
-                    else:
-                        logger.debug('_find_task_ids_by_revisions: using task_definition')
-                        if 'metadata' in task_definition and \
-                           'name' in task_definition['metadata'] and \
-                           '/' in task_definition['metadata']['name']:
-                            logger.debug('_find_task_ids_by_revisions: '
-                                         'using task_definition["metadata"]["name"]')
-                            # task_definition['metadata']['name'] has the form:
-                            # 'build-<platform>/<buildtype>'. For example:
-                            # 'build-android-api-16/debug'
-                            (platform, build_type) = task_definition['metadata']['name'].split('/')
-                            platform = platform.replace('build-', '')
-                        if build_type is None and 'extra' in task_definition and \
-                           'build_type' in task_definition['extra']:
-                            logger.debug('_find_task_ids_by_revisions: '
-                                         'using task_definition["workerType"] and '
-                                         'task_definition["extra"]["build_type"]')
-                            platform = task_definition['workerType']
-                            build_type = task_definition['extra']['build_type']
-                        if build_type is None:
-                            logger.warning('_find_task_ids_by_revisions: could not determine build_type')
-                    logger.debug('_find_task_ids_by_revisions: builder_type: %s, '
-                                 'platform: %s, build_platforms: %s, '
-                                 'build_type: %s, build_types: %s, '
-                                 'tier: %s',
-                                 builder_type,
-                                 platform, self.build_platforms,
-                                 build_type, self.buildtypes,
-                                 tier)
-                    # We must relax the tier 1 requirement since we want geckoview_example
-                    # builds but they are tier 2.
-                    if platform in self.build_platforms and \
-                       build_type in self.buildtypes and \
-                       (builder_type == 'buildbot' or tier >= 1):
-                        logger.debug('_find_task_ids_by_revisions: adding builder_type: %s, '
-                                     'task_id: %s, tier: %s, repo: %s, platform: %s, '
-                                     'build_type; %s',
-                                     builder_type, task_id, tier, repo, platform, build_type)
-                        task_ids.append(task_id)
+        # We could iterate over the build_platforms by adding
+        # the build_platform to the routing key, but that will
+        # end up paying a cost of looking up obsolete
+        # platforms in perpetuity. Instead we can list the
+        # namespaces under mobile and get the currently
+        # supported namespaces and filter those.
+        def list_tasks(item):
+            repo, revision_position, namespace = item
+            return [(repo, (revision_position, task_position), task)
+                    for task_position, task in
+                    enumerate(metadataclient.get_client().list_tasks(namespace))]
+
+        def match_task(item):
+            repo, position, task = item
+            logger.debug('_find_task_ids_by_revisions: repo: %s, task: %s',
+                         repo, task)
+            return repo, position, task['taskId'], self._match_revision_task(repo, task)
+
+        namespaces = [(repo, revision_position,
+                       namespace_format % (namespace_version, repo, revision))
+                      for repo in revisions_by_repo
+                      for revision_position, revision in enumerate(revisions_by_repo[repo])]
+        tasks = []
+        for repo_tasks in self._imap_unordered(list_tasks, namespaces):
+            tasks.extend(repo_tasks)
+        matches = [(repo, position, task_id)
+                   for repo, position, task_id, matched in self._imap_unordered(match_task, tasks)
+                   if matched]
+
+        task_ids_by_repo = dict((repo, []) for repo in revisions_by_repo)
+        for repo, position, task_id in sorted(matches):
+            task_ids_by_repo[repo].append(task_id)
         logger.debug('_find_task_ids_by_revisions: %s', task_ids_by_repo)
         return task_ids_by_repo
 
+    def _match_revision_task(self, repo, task):
+        """Return True if the indexed task builds one of the build
+        platforms and build types."""
+        logger = utils.getLogger()
+        task_id = task['taskId']
+        task_namespace = task['namespace']
+        task_definition = utils.get_taskcluster_task_definition(task_id)
+        logger.debug('_find_task_ids_by_revisions: task_definition: %s',
+                     task_definition)
+        if not task_definition:
+            logger.warning('_find_task_ids_by_revisions: no task definition '
+                           'for task_id: %s', task_id)
+            return False
+        build_data = utils.get_build_data_from_taskcluster_task_definition(task_definition)
+        logger.debug('_find_task_ids_by_revisions: build_data: %s',
+                     build_data)
+        worker_type = task_definition['workerType']
+        builder_type = 'buildbot' if worker_type == 'buildbot' else 'taskcluster'
+        # Just hard-code run_id 0 since the tier shouldn't change.
+        tier = get_treeherder_tier(repo, task_id, 0)
+        platform = build_type = None
+        if build_data:
+            logger.debug('_find_task_ids_by_revisions: using build_data')
+            platform = build_data['platform']
+            build_type = build_data['build_type']
+        elif builder_type == 'buildbot':
+            logger.debug('_find_task_ids_by_revisions: using task_namespace')
+            (platform, build_type) = parse_taskcluster_namespace(task_namespace)
+        else:
+            logger.debug('_find_task_ids_by_revisions: using task_definition')
+            if 'metadata' in task_definition and \
+               'name' in task_definition['metadata'] and \
+               '/' in task_definition['metadata']['name']:
+                logger.debug('_find_task_ids_by_revisions: '
+                             'using task_definition["metadata"]["name"]')
+                # task_definition['metadata']['name'] has the form:
+                # 'build-<platform>/<buildtype>'. For example:
+                # 'build-android-api-16/debug'
+                (platform, build_type) = task_definition['metadata']['name'].split('/')
+                platform = platform.replace('build-', '')
+            if build_type is None and 'extra' in task_definition and \
+               'build_type' in task_definition['extra']:
+                logger.debug('_find_task_ids_by_revisions: '
+                             'using task_definition["workerType"] and '
+                             'task_definition["extra"]["build_type"]')
+                platform = task_definition['workerType']
+                build_type = task_definition['extra']['build_type']
+            if build_type is None:
+                logger.warning('_find_task_ids_by_revisions: could not determine build_type')
+        logger.debug('_find_task_ids_by_revisions: builder_type: %s, '
+                     'platform: %s, build_platforms: %s, '
+                     'build_type: %s, build_types: %s, '
+                     'tier: %s',
+                     builder_type,
+                     platform, self.build_platforms,
+                     build_type, self.buildtypes,
+                     tier)
+        # We must relax the tier 1 requirement since we want geckoview_example
+        # builds but they are tier 2.
+        if platform in self.build_platforms and \
+           build_type in self.buildtypes and \
+           (builder_type == 'buildbot' or tier >= 1):
+            logger.debug('_find_task_ids_by_revisions: adding builder_type: %s, '
+                         'task_id: %s, tier: %s, repo: %s, platform: %s, '
+                         'build_type; %s',
+                         builder_type, task_id, tier, repo, platform, build_type)
+            return True
+        return False
+
 
 class FtpBuildLocation(BuildLocation):
     def __init__(self, repos, buildtypes,
@@ -781,8 +888,7 @@ class FtpBuildLocation(BuildLocation):
         directory_tuple = urlparse.urlparse(directory)
         if directory_tuple.scheme.startswith('http'):
             build_links = url_links(directory)
-            for build_link in build_links:
-                filename = build_link.get_text()
+            for href, filename in build_links:
                 logger.debug('find_builds_by_directory: checking filename: %s', filename)
                 if self.build_regex.match(filename):
                     logger.debug('find_builds_by_directory: found filename: %s', filename)
@@ -818,14 +924,14 @@ class FtpBuildLocation(BuildLocation):
         if not start_time.tzinfo or not end_time.tzinfo:
             raise Exception('find_builds_by_time: naive times not permitted')
 
-        builds = []
+        directory_hrefs = []
 
         for directory_repo, directory in self.get_search_directories_by_time(start_time,
                                                                              end_time):
             logger.debug('Checking repo %s directory %s...', directory_repo, directory)
             directory_links = url_links(directory)
-            for directory_link in directory_links:
-                directory_name = directory_link.get_text().rstrip('/')
+            for href, directory_name in directory_links:
+                directory_name = directory_name.rstrip('/')
                 directory_href = '%s%s/' % (directory, directory_name)
                 logger.debug('find_builds_by_time: directory: href: %s, name: %s',
                              directory_href, directory_name)
@@ -839,21 +945,50 @@ class FtpBuildLocation(BuildLocation):
                    (not inclusive and build_time >= end_time):
                     continue
 
-                build_links = url_links(directory_href)
-                for build_link in build_links:
-                    filename = build_link.get_text()
-                    logger.debug('find_builds_by_time: checking filename: %s', filename)
-                    if self.build_regex.match(filename):
-                        logger.debug('find_builds_by_time: found filename: %s', filename)
-                        build_url = '%s%s' % (directory_href, filename)
-                        build_data = utils.get_build_data(build_url, builder_type='buildbot')
-                        if build_data:
-                            builds.append(build_data)
-                        break
+                directory_hrefs.append(directory_href)
+
+        # Index the build directories concurrently then look up the
+        # builds they contain.
+        builds = []
+        if directory_hrefs:
+            ftpindex.FtpIndex().crawl(directory_hrefs,
+                                      immutable=self.build_directory_complete)
+            pool = ThreadPool(min(ftpindex.FtpIndex.MAX_CONCURRENT, len(directory_hrefs)))
+            try:
+                builds = [build_data for build_data in
+                          pool.map(self._find_build_in_directory, directory_hrefs)
+                          if build_data]
+            finally:
+                pool.close()
+                pool.join()
         if not builds:
             logger.error('No builds found.')
         return builds
 
+    def build_directory_complete(self, links):
+        """Return True if the build directory listing links contains
+        both the build and its txt file, i.e. the build's upload has
+        completed and the listing will not change."""
+        names = set()
+        for href, name in links:
+            names.add(name)
+            names.add(href.rstrip('/').split('/')[-1])
+        return (any(self.build_regex.match(name) for name in names) and
+                any(self.buildtxt_regex.match(name) for name in names))
+
+    def _find_build_in_directory(self, directory_href):
+        """Return the build_data for the first build in the build
+        directory directory_href or None."""
+        logger = utils.getLogger()
+        for href, filename in url_links(directory_href,
+                                        immutable=self.build_directory_complete):
+            logger.debug('find_builds_by_time: checking filename: %s', filename)
+            if self.build_regex.match(filename):
+                logger.debug('find_builds_by_time: found filename: %s', filename)
+                build_url = '%s%s' % (directory_href, filename)
+                return utils.get_build_data(build_url, builder_type='buildbot')
+        return None
+
     def find_builds_by_revision(self, first_revision, last_revision, inclusive=True):
         logger = utils.getLogger()
         logger.debug('Finding builds between revisions %s and %s',
@@ -895,9 +1030,10 @@ class FtpBuildLocation(BuildLocation):
                 formatstr = None
                 datetimestamps = []
 
-                for link in url_links(search_directory):
+                search_directory_links = url_links(search_directory)
+                for href, name in search_directory_links:
                     try:
-                        datetimestring = link.get('href').strip('/')
+                        datetimestring = href.strip('/')
                         if self.does_build_directory_contain_repo_name() and repo not in datetimestring:
                             logger.info('find_builds_by_revisions:'
                                         'skipping datetimestring: repo: %s, '
@@ -925,6 +1061,22 @@ class FtpBuildLocation(BuildLocation):
 
                 logger.debug('find_builds_by_revisions: datetimestamps: %s', datetimestamps)
 
+                # Only the candidate build directories which are
+                # present in the search directory can contain builds.
+                # Index them concurrently so that the search below is
+                # answered from the index.
+                directory_names = set()
+                for href, name in search_directory_links:
+                    directory_names.add(name.strip('/'))
+                    directory_names.add(href.rstrip('/').split('/')[-1])
+                ftpindex.FtpIndex().crawl(
+                    ["%s%s/" % (search_directory, directory_name)
+                     for datetimestamp in datetimestamps
+                     for directory_repo, directory_name in
+                     self.directory_names_from_datetimestamp(datetimestamp)
+                     if directory_name in directory_names],
+                    immutable=self.build_directory_complete)
+
                 start_time = None
                 end_time = None
                 for datetimestamp in datetimestamps:
@@ -946,9 +1098,11 @@ class FtpBuildLocation(BuildLocation):
                                      search_directory, directory_repo,
                                      directory_name)
 
-                        links = url_links("%s%s/" % (search_directory, directory_name))
-                        for link in links:
-                            href = link.get('href')
+                        if directory_name not in directory_names:
+                            continue
+                        links = url_links("%s%s/" % (search_directory, directory_name),
+                                          immutable=self.build_directory_complete)
+                        for href, name in links:
                             match = self.buildtxt_regex.match(href)
                             if match:
                                 build_url = "%s%s/%s%s" % (search_directory,
@@ -1093,16 +1247,29 @@ class BuildCacheException(Exception):
 
 
 class BuildCache(object):
+    """Cache of downloaded builds, symbols and test packages.
+
+    The size and sha512 of each downloaded build, robocop and test
+    package artifact are recorded by url in the manifest.json file of
+    its cached build directory. If peers is specified, it is a list of
+    (host, port) build cache servers on other hosts which are asked
+    for an artifact before it is downloaded from its url. An artifact
+    is only accepted from a peer if it matches the peer's manifest.
+    A peer which can not be reached is not asked again for
+    PEER_RETRY_AFTER seconds.
+    """
 
     MAX_NUM_BUILDS = 20
     EXPIRE_AFTER_DAYS = 1
+    MANIFEST = 'manifest.json'
+    PEER_RETRY_AFTER = 300
 
     def __init__(self, repos, buildtypes,
                  product, build_platforms, buildfile_ext,
                  cache_dir='builds', override_build_dir=None,
                  build_cache_size=MAX_NUM_BUILDS,
                  build_cache_expires=EXPIRE_AFTER_DAYS,
-                 treeherder_url=None):
+                 treeherder_url=None, peers=None):
         logger = utils.getLogger()
         self.repos = repos
         self.buildtypes = buildtypes
@@ -1125,6 +1292,9 @@ class BuildCache(object):
         self.build_cache_size = build_cache_size
         self.build_cache_expires = build_cache_expires
         self.treeherder_url = treeherder_url
+        self.peers = peers or []
+        # Time of the last failure of each peer indexed by (host, port).
+        self.peer_failures = {}
         logger.debug('BuildCache: %s', self.__dict__)
 
     def build_location(self, s):
@@ -1174,8 +1344,27 @@ class BuildCache(object):
 
         return build_location.find_builds_by_revision(first_revision, last_revision)
 
+    def iter_builds_by_time(self, start_time, end_time, build_location_name='nightly'):
+        """Yield the builds found by find_builds_by_time as they are
+        resolved rather than after the search completes."""
+        logger = utils.getLogger()
+        logger.debug('Iterating %s builds between %s and %s',
+                     build_location_name, start_time, end_time)
+        if not start_time.tzinfo or not end_time.tzinfo:
+            raise Exception('iter_builds_by_time: naive times not permitted')
+
+        build_location = self.build_location(build_location_name)
+        return build_location.iter_builds_by_time(start_time, end_time)
+
+    def iter_builds_by_revision(self, first_revision, last_revision,
+                                build_location_name='nightly'):
+        """Yield the builds found by find_builds_by_revision as they
+        are resolved rather than after the search completes."""
+        build_location = self.build_location(build_location_name)
+        return build_location.iter_builds_by_revision(first_revision, last_revision)
+
     def get(self, build_url, force=False, enable_unittests=False,
-            test_package_names=None, builder_type=None):
+            test_package_names=None, builder_type=None, progress=None):
         """Returns info on a cached build, fetching it if necessary.
         Returns a dict with a boolean 'success' item.
         If 'success' is False, the dict also contains an 'error' item holding a
@@ -1191,8 +1380,13 @@ class BuildCache(object):
         it will still try to open fennec.apk to read in the metadata).
         See BuildMetadata and BuildCache.build_metadata() for the other
         metadata items.
+        If progress is specified, it is called as progress(stage, url)
+        before each of the build, symbols, robocop and test_package
+        downloads.
         """
         logger = utils.getLogger()
+        if not progress:
+            progress = lambda stage, url: None
         is_geckoview_example = build_url.endswith('geckoview_example.apk')
         if self.override_build_dir:
             tests_path = os.path.join(self.override_build_dir, 'tests')
@@ -1237,7 +1431,7 @@ class BuildCache(object):
         # directory and downloaded auxiliary files such as the crash
         # symbols, etc. Note that we will need to create a separate
         # metadata json file for each apk type we are downloading.
-        build_dir = base64.b64encode(os.path.dirname(build_url))
+        build_dir = self.build_dir_name(build_url)
         self.clean_cache([build_dir])
         cache_build_dir = os.path.join(self.cache_dir, build_dir)
         if is_geckoview_example:
@@ -1262,16 +1456,18 @@ class BuildCache(object):
         if download_build:
             # retrieve to temporary file then move over, so we don't end
             # up with half a file if it aborts
+            progress('build', build_url)
             tmpf = tempfile.NamedTemporaryFile(delete=False)
             tmpf.close()
             try:
-                utils.urlretrieve(build_url, tmpf.name)
+                self.retrieve(build_url, tmpf.name)
             except:
                 os.unlink(tmpf.name)
                 err = 'IO Error retrieving build: %s.' % build_url
                 logger.exception(err)
                 return {'success': False, 'error': err}
             shutil.move(tmpf.name, build_path)
+            self.add_to_manifest(cache_build_dir, build_url, build_path)
         file(os.path.join(cache_build_dir, 'lastused'), 'w')
 
         if is_geckoview_example:
@@ -1283,7 +1479,9 @@ class BuildCache(object):
             # download fennec here.
             if force or not os.path.exists(fennec_build_path):
                 try:
-                    utils.urlretrieve(fennec_build_url, fennec_build_path)
+                    self.retrieve(fennec_build_url, fennec_build_path)
+                    self.add_to_manifest(cache_build_dir, fennec_build_url,
+                                         fennec_build_path)
                 except HTTPError, http_error:
                     if 'Not Found' in str(http_error):
                         logger.info('No %s found.', fennec_build_url)
@@ -1299,6 +1497,7 @@ class BuildCache(object):
             tmpf.close()
             # XXX: assumes fixed fennec_build_url-> symbols_url mapping
             symbols_url = re.sub('.apk$', '.crashreporter-symbols.zip', fennec_build_url)
+            progress('symbols', symbols_url)
             try:
                 utils.urlretrieve(symbols_url, tmpf.name)
                 symbols_zipfile = zipfile.ZipFile(tmpf.name)
@@ -1332,16 +1531,18 @@ class BuildCache(object):
             robocop_url = urlparse.urljoin(fennec_build_url, 'robocop.apk')
             robocop_path = os.path.join(cache_build_dir, 'robocop.apk')
             if force or not os.path.exists(robocop_path):
+                progress('robocop', robocop_url)
                 tmpf = tempfile.NamedTemporaryFile(delete=False)
                 tmpf.close()
                 try:
-                    utils.urlretrieve(robocop_url, tmpf.name)
+                    self.retrieve(robocop_url, tmpf.name)
                 except:
                     os.unlink(tmpf.name)
                     err = 'Error retrieving robocop.apk: %s.' % robocop_url
                     logger.exception(err)
                     return {'success': False, 'error': err}
                 shutil.move(tmpf.name, robocop_path)
+                self.add_to_manifest(cache_build_dir, robocop_url, robocop_path)
             test_packages_url = re.sub('.apk$', '.test_packages.json', fennec_build_url)
             logger.info('downloading test package json %s', test_packages_url)
             test_packages = utils.get_remote_json(test_packages_url)
@@ -1387,10 +1588,11 @@ class BuildCache(object):
                                 'test package %s', test_package_url)
                     continue
                 logger.info('downloading test package %s', test_package_url)
+                progress('test_package', test_package_url)
                 tmpf = tempfile.NamedTemporaryFile(delete=False)
                 tmpf.close()
                 try:
-                    utils.urlretrieve(test_package_url, tmpf.name)
+                    self.retrieve(test_package_url, tmpf.name)
                 except:
                     os.unlink(tmpf.name)
                     err = 'IO Error retrieving tests: %s.' % test_package_url
@@ -1404,6 +1606,8 @@ class BuildCache(object):
                     # build directory so we can check if it has been
                     # downloaded.
                     shutil.move(tmpf.name, test_package_path)
+                    self.add_to_manifest(cache_build_dir, test_package_url,
+                                         test_package_path)
                 except zipfile.BadZipfile:
                     err = 'Zip file error retrieving tests: %s.' % test_package_url
                     logger.exception(err)
@@ -1426,6 +1630,92 @@ class BuildCache(object):
             'metadata': metadata_json
         }
 
+    def retrieve(self, url, path):
+        """Retrieve the artifact url to path from the first of the
+        peers which has it, otherwise from url."""
+        logger = utils.getLogger()
+        if urlparse.urlparse(url).scheme.startswith('http'):
+            for host, port in self.peers:
+                failed = self.peer_failures.get((host, port))
+                if failed and time.time() - failed < self.PEER_RETRY_AFTER:
+                    continue
+                try:
+                    fetched = buildserver.fetch_from_peer(host, port, url, path)
+                except socket.error, e:
+                    logger.warning('BuildCache.retrieve: peer %s:%s: %s. '
+                                   'Not using it for %d seconds.',
+                                   host, port, e, self.PEER_RETRY_AFTER)
+                    self.peer_failures[(host, port)] = time.time()
+                    continue
+                self.peer_failures.pop((host, port), None)
+                if fetched:
+                    return
+        logger.debug('BuildCache.retrieve: %s', url)
+        utils.urlretrieve(url, path)
+
+    def read_manifest(self, cache_build_dir):
+        """Return the manifest of the cached build directory."""
+        manifest_path = os.path.join(cache_build_dir, self.MANIFEST)
+        try:
+            with open(manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except (IOError, ValueError):
+            return {}
+
+    def add_to_manifest(self, cache_build_dir, url, path):
+        """Record the size and sha512 of the artifact url which has
+        been downloaded to path in the cached build directory."""
+        digest = hashlib.sha512()
+        with open(path, 'rb') as artifact_file:
+            for data in iter(lambda: artifact_file.read(1024 * 1024), ''):
+                digest.update(data)
+        manifest = self.read_manifest(cache_build_dir)
+        manifest[url] = {
+            'file': os.path.basename(path),
+            'size': os.path.getsize(path),
+            'sha512': digest.hexdigest(),
+        }
+        # Write the manifest to a temporary file and rename it so that
+        # peers never see a partially written manifest.
+        manifest_path = os.path.join(cache_build_dir, self.MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(manifest_path + '.tmp', manifest_path)
+
+    def peer_artifact(self, url):
+        """Return (path, entry) for the artifact url if it is in the
+        cache where entry is its manifest entry, otherwise None."""
+        if self.override_build_dir:
+            return None
+        cache_build_dir = os.path.join(self.cache_dir, self.build_dir_name(url))
+        entry = self.read_manifest(cache_build_dir).get(url)
+        if not entry:
+            return None
+        path = os.path.join(cache_build_dir, os.path.basename(entry['file']))
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return None
+        except OSError:
+            return None
+        return path, entry
+
+    @staticmethod
+    def build_dir_name(build_url):
+        """Return the name of the cached build directory for build_url."""
+        return base64.b64encode(os.path.dirname(build_url))
+
+    @staticmethod
+    def is_cached(cache_dir, build_url):
+        """Return True if the apk for build_url has already been
+        downloaded to the build cache in cache_dir."""
+        if build_url.endswith('geckoview_example.apk'):
+            apk_name = 'geckoview_example.apk'
+        else:
+            apk_name = 'fennec.apk'
+        return os.path.exists(os.path.join(cache_dir,
+                                           BuildCache.build_dir_name(build_url),
+                                           apk_name))
+
     def clean_cache(self, preserve=[]):
         def lastused_path(d):
             return os.path.join(self.cache_dir, d, 'lastused')
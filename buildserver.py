@@ -2,24 +2,327 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import Queue
 import SocketServer
 import errno
+import hashlib
 import json
+import os
 import socket
+import struct
 import threading
+import time
 import urlparse
 
+import utils
+import zerocopy
+
 DEFAULT_PORT = 28008
 
+# Requests and responses are JSON objects sent as frames prefixed with
+# their length as a 4 byte unsigned integer in network byte order.
+# Since frames must be smaller than MAX_FRAME_SIZE, the first byte of
+# a frame is always 0 which distinguishes framed connections from
+# connections using the original line protocol whose requests begin
+# with a build url.
+#
+# Each request is an object with keys:
+#
+#   'id'                 : request id chosen by the client
+#   'verb'               : 'get', 'prefetch', 'fetch' or 'quit'
+#   'url'                : build url or artifact url for fetch
+#   'force'              : see BuildCache.get
+#   'enable_unittests'   : see BuildCache.get
+#   'test_package_names' : see BuildCache.get
+#   'builder_type'       : see BuildCache.get
+#   'progress'           : True to receive progress events
+#
+# Requests on a connection are processed concurrently and their
+# responses may arrive in any order. Each response is an object with
+# the 'id' of its request and an 'event' of:
+#
+#   'accepted' : a prefetch request has been queued.
+#   'progress' : a download has started. 'stage' is one of build,
+#                symbols, robocop or test_package and 'url' is the
+#                url being downloaded.
+#   'result'   : the request has completed. 'result' is the value
+#                returned by BuildCache.get.
+#
+# Prefetch requests report progress and continue even if the client
+# closes the connection.
+#
+# A fetch request asks for an artifact which has been downloaded to
+# the cache. It must be the only request on its connection. Its result
+# contains 'found' and, if it is True, the 'size' and 'sha512' of the
+# artifact recorded in the build's manifest. The size bytes of the
+# artifact follow the result frame and the connection is closed.
+# Connections from other hosts may only make fetch requests, which
+# allows several Autophone hosts to share their build caches.
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Peers are on the same network so a connection which is not made
+# quickly will not be made at all.
+PEER_CONNECT_TIMEOUT = 2
+PEER_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+
+def recv_exactly(sock, size):
+    """Return size bytes read from sock or None if the connection is
+    closed first."""
+    chunks = []
+    while size:
+        data = sock.recv(min(size, CHUNK_SIZE))
+        if not data:
+            return None
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def recv_frame(sock):
+    """Return the next message from sock or None if the connection is
+    closed."""
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    size = FRAME_HEADER.unpack(header)[0]
+    if size >= MAX_FRAME_SIZE:
+        raise ValueError('frame size %d is not less than %d' %
+                         (size, MAX_FRAME_SIZE))
+    data = recv_exactly(sock, size)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def send_frame(sock, message):
+    """Send message to sock. Raises ValueError if the encoded message
+    is not smaller than MAX_FRAME_SIZE."""
+    data = json.dumps(message)
+    if len(data) >= MAX_FRAME_SIZE:
+        raise ValueError('frame size %d is not less than %d' %
+                         (len(data), MAX_FRAME_SIZE))
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def parse_peers(peers):
+    """Return the list of (host, port) for the list of host[:port]
+    peers."""
+    result = []
+    for peer in peers:
+        host, sep, port = peer.rpartition(':')
+        if not sep:
+            host, port = peer, DEFAULT_PORT
+        result.append((host.strip('[]'), int(port)))
+    return result
+
+
+def fetch_from_peer(host, port, url, path,
+                    connect_timeout=PEER_CONNECT_TIMEOUT, timeout=PEER_TIMEOUT):
+    """Stream the artifact url from the build cache of the peer at
+    host:port to path. Return True if the peer had the artifact and
+    its content matched the size and sha512 of the peer's manifest,
+    otherwise False. Raises socket.error if the peer can not be reached
+    or the transfer fails."""
+    logger = utils.getLogger()
+    sock = socket.create_connection((host, port), connect_timeout)
+    sock.settimeout(timeout)
+    try:
+        send_frame(sock, {'id': 1, 'verb': 'fetch', 'url': url})
+        response = recv_frame(sock)
+        if not response or not response['result'].get('found'):
+            return False
+        size = response['result']['size']
+        digest = hashlib.sha512()
+        with open(path, 'wb') as artifact_file:
+            while size:
+                data = sock.recv(min(size, CHUNK_SIZE))
+                if not data:
+                    raise socket.error(errno.ECONNRESET,
+                                       '%s truncated' % url)
+                artifact_file.write(data)
+                digest.update(data)
+                size -= len(data)
+        if digest.hexdigest() != response['result']['sha512']:
+            logger.warning('fetch_from_peer: %s:%s: %s does not match its '
+                           'manifest', host, port, url)
+            return False
+        logger.info('fetch_from_peer: fetched %s from %s:%s', url, host, port)
+        return True
+    except ValueError, e:
+        raise socket.error(errno.EPROTO, 'invalid response: %s' % e)
+    finally:
+        sock.close()
+
+
 class BuildCacheServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serve the build_cache to the workers.
+
+    Builds are fetched one at a time since BuildCache.get cleans and
+    updates the shared cache directory. Gets waiting for the cache
+    take priority over waiting prefetches so that a worker is not
+    held up behind builds which are not needed yet.
+    """
 
     build_cache = None
-    cache_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        SocketServer.TCPServer.__init__(self, *args, **kwargs)
+        self.cache_condition = threading.Condition()
+        self.cache_busy = False
+        self.gets_waiting = 0
+
+    def acquire_cache(self, prefetch=False):
+        with self.cache_condition:
+            if not prefetch:
+                self.gets_waiting += 1
+            while self.cache_busy or (prefetch and self.gets_waiting):
+                self.cache_condition.wait()
+            if not prefetch:
+                self.gets_waiting -= 1
+            self.cache_busy = True
+
+    def release_cache(self):
+        with self.cache_condition:
+            self.cache_busy = False
+            self.cache_condition.notify_all()
+
+    def get_build(self, build, force=False, enable_unittests=False,
+                  test_package_names=None, builder_type=None, progress=None,
+                  prefetch=False):
+        self.acquire_cache(prefetch=prefetch)
+        try:
+            results = self.build_cache.get(
+                build,
+                force=force,
+                enable_unittests=enable_unittests,
+                test_package_names=test_package_names,
+                builder_type=builder_type,
+                progress=progress)
+        except Exception, e:
+            results = {
+                'success': False,
+                'error': 'Exception: %s' % e,
+                'metadata': ''
+            }
+        finally:
+            self.release_cache()
+        return results
 
 
 class BuildCacheHandler(SocketServer.BaseRequestHandler):
 
+    def is_local(self):
+        return self.client_address[0].startswith('127.') or \
+            self.client_address[0] == '::1'
+
     def handle(self):
+        try:
+            first = self.request.recv(1, socket.MSG_PEEK)
+        except socket.error, e:
+            if e.errno == errno.ECONNRESET:
+                return
+            raise e
+        if not first:
+            return
+        if first == '\0':
+            self.handle_frames()
+        elif self.is_local():
+            self.handle_lines()
+
+    def handle_frames(self):
+        send_lock = threading.Lock()
+
+        def send(message):
+            with send_lock:
+                try:
+                    send_frame(self.request, message)
+                except socket.error:
+                    # The client has gone away. Prefetches continue.
+                    pass
+
+        threads = []
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except socket.error, e:
+                if e.errno != errno.ECONNRESET:
+                    raise e
+                request = None
+            if request is None or request.get('verb') in ('quit', 'exit'):
+                break
+            if request.get('verb') == 'fetch':
+                for thread in threads:
+                    thread.join()
+                self.handle_fetch(request)
+                return
+            if not self.is_local():
+                send({'id': request.get('id'), 'event': 'result',
+                      'result': {'success': False,
+                                 'error': 'Only fetch is permitted from peers',
+                                 'metadata': ''}})
+                continue
+            thread = threading.Thread(target=self.handle_request,
+                                      args=(request, send),
+                                      name='BuildCacheRequest')
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+            threads = [t for t in threads if t.is_alive()]
+        # Wait for the outstanding requests before the connection is
+        # closed by the server.
+        for thread in threads:
+            thread.join()
+
+    def handle_fetch(self, request):
+        artifact = self.server.build_cache.peer_artifact(request['url'])
+        if not artifact:
+            send_frame(self.request, {'id': request.get('id'), 'event': 'result',
+                                      'result': {'found': False}})
+            return
+        path, entry = artifact
+        try:
+            artifact_file = open(path, 'rb')
+        except IOError:
+            send_frame(self.request, {'id': request.get('id'), 'event': 'result',
+                                      'result': {'found': False}})
+            return
+        with artifact_file:
+            send_frame(self.request, {'id': request.get('id'), 'event': 'result',
+                                      'result': {'found': True,
+                                                 'size': entry['size'],
+                                                 'sha512': entry['sha512']}})
+            zerocopy.send_file(self.request, artifact_file, entry['size'])
+
+    def handle_request(self, request, send):
+        request_id = request.get('id')
+        verb = request.get('verb', 'get')
+        if verb not in ('get', 'prefetch'):
+            send({'id': request_id, 'event': 'result',
+                  'result': {'success': False,
+                             'error': 'Unknown verb %s' % verb,
+                             'metadata': ''}})
+            return
+        progress = None
+        if verb == 'prefetch' or request.get('progress'):
+            progress = lambda stage, url: send({'id': request_id,
+                                                'event': 'progress',
+                                                'stage': stage,
+                                                'url': url})
+        if verb == 'prefetch':
+            send({'id': request_id, 'event': 'accepted'})
+        results = self.server.get_build(
+            request['url'],
+            force=request.get('force', False),
+            enable_unittests=request.get('enable_unittests', False),
+            test_package_names=set(request.get('test_package_names') or []),
+            builder_type=request.get('builder_type'),
+            progress=progress,
+            prefetch=verb == 'prefetch')
+        send({'id': request_id, 'event': 'result', 'result': results})
+
+    def handle_lines(self):
         buff = ''
         while True:
             try:
@@ -62,31 +365,32 @@ class BuildCacheHandler(SocketServer.BaseRequestHandler):
                         builder_type = 'taskcluster'
                     elif cmd.lower() == 'test_packages':
                         collecting_test_packages = True
-                self.server.cache_lock.acquire()
-                try:
-                    results = self.server.build_cache.get(
-                        build,
-                        force=force,
-                        enable_unittests=enable_unittests,
-                        test_package_names=test_package_names,
-                        builder_type=builder_type)
-                except Exception, e:
-                    results = {
-                        'success': False,
-                        'error': 'Exception: %s' % e,
-                        'metadata': ''
-                    }
-                finally:
-                    self.server.cache_lock.release()
+                results = self.server.get_build(
+                    build,
+                    force=force,
+                    enable_unittests=enable_unittests,
+                    test_package_names=test_package_names,
+                    builder_type=builder_type)
                 self.request.send(json.dumps(results) + '\n')
 
 
 class BuildCacheClient(object):
+    """Client for the BuildCacheServer framed protocol. Several
+    requests may be outstanding on the connection at once. A client
+    must only be used by one thread.
+
+    The events of each request are kept until they are consumed by
+    next_event or wait, except for requests submitted with follow
+    False whose events are discarded as they arrive."""
 
     def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
         self.host = host
         self.port = port
         self.sock = None
+        self.next_id = 0
+        # Lists of unconsumed events of the followed requests indexed
+        # by request id.
+        self.events = {}
 
     def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -95,29 +399,214 @@ class BuildCacheClient(object):
     def close(self):
         self.sock.close()
         self.sock = None
+        self.events = {}
 
-    def get(self, url, force=False, enable_unittests=False,
-            test_package_names=None, builder_type=None):
+    def submit(self, url, verb='get', force=False, enable_unittests=False,
+               test_package_names=None, builder_type=None, progress=False,
+               follow=True):
+        """Send a request without waiting for its response and return
+        its request id. If follow is False, the request's events are
+        discarded."""
         if not self.sock:
             self.connect()
-        line = url
+        self.next_id += 1
+        request_id = self.next_id
         force = force or not urlparse.urlparse(url).scheme.startswith('http')
-        if force:
-            line += ' force'
-        if enable_unittests:
-            line += ' enable_unittests'
-        if builder_type:
-            line += ' builder_type_' + builder_type
-        if test_package_names:
-            line += ' test_packages'
-            for test_package in test_package_names:
-                line += ' ' + test_package
-        self.sock.sendall(line + '\n')
-        buf = ''
-        while not '\n' in buf:
-            data = self.sock.recv(1024)
-            if not data:
+        send_frame(self.sock, {
+            'id': request_id,
+            'verb': verb,
+            'url': url,
+            'force': force,
+            'enable_unittests': enable_unittests,
+            'test_package_names': list(test_package_names or []),
+            'builder_type': builder_type,
+            'progress': progress,
+        })
+        if follow:
+            self.events[request_id] = []
+        return request_id
+
+    def next_event(self, request_ids=None):
+        """Return the next event for one of request_ids, or for any
+        request if request_ids is None. Return None if the server hung
+        up."""
+        for request_id in sorted(self.events):
+            if (request_ids is None or request_id in request_ids) and \
+               self.events[request_id]:
+                return self._consume(self.events[request_id].pop(0))
+        while True:
+            event = recv_frame(self.sock)
+            if event is None:
                 print 'build server hung up!'
                 return None
-            buf += data
-        return json.loads(buf)
+            if event['id'] not in self.events:
+                # Nobody follows this request.
+                continue
+            if request_ids is None or event['id'] in request_ids:
+                return self._consume(event)
+            self.events[event['id']].append(event)
+
+    def _consume(self, event):
+        if event['event'] == 'result':
+            self.events.pop(event['id'], None)
+        return event
+
+    def wait(self, request_id, progress=None):
+        """Return the result of request_id, calling progress(event) for
+        each of its progress events."""
+        while True:
+            event = self.next_event([request_id])
+            if event is None:
+                return None
+            if event['event'] == 'result':
+                return event['result']
+            if event['event'] == 'progress' and progress:
+                progress(event)
+
+    def get(self, url, force=False, enable_unittests=False,
+            test_package_names=None, builder_type=None):
+        return self.wait(self.submit(url,
+                                     force=force,
+                                     enable_unittests=enable_unittests,
+                                     test_package_names=test_package_names,
+                                     builder_type=builder_type))
+
+    def get_many(self, requests):
+        """Pipeline a get for each of the dicts of keyword arguments in
+        requests and return the list of their results in the same
+        order."""
+        request_ids = [self.submit(**request) for request in requests]
+        results = {}
+        pending = set(request_ids)
+        while pending:
+            event = self.next_event(pending)
+            if event is None:
+                break
+            if event['event'] == 'result':
+                results[event['id']] = event['result']
+                pending.discard(event['id'])
+        return [results.get(request_id) for request_id in request_ids]
+
+    def prefetch(self, url, enable_unittests=False, test_package_names=None,
+                 builder_type=None, follow=False):
+        """Ask the server to cache the build without waiting for it.
+        Return the request id. If follow is True, the request id must
+        be passed to wait to follow its progress and consume its
+        events, otherwise its events are discarded."""
+        return self.submit(url,
+                           verb='prefetch',
+                           enable_unittests=enable_unittests,
+                           test_package_names=test_package_names,
+                           builder_type=builder_type,
+                           follow=follow)
+
+
+class BuildPrefetcher(object):
+    """Prefetch builds into the BuildCacheServer in the background so
+    that they are cached before the workers start their jobs.
+
+    At most max_concurrent prefetches are made at once. A prefetch is
+    skipped if the same build is already queued, if max_queued
+    prefetches are already queued, which would evict each other from
+    a cache of that many builds, or if the cache directory has less
+    than min_free_mb megabytes free. A skipped build is fetched by the
+    worker when it starts the job as before.
+    """
+
+    def __init__(self, cache_dir, port=DEFAULT_PORT, max_concurrent=1,
+                 max_queued=1, min_free_mb=0):
+        self.cache_dir = cache_dir
+        self.port = port
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.min_free_mb = min_free_mb
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {} # prefetch arguments indexed by build url
+        self.threads = []
+
+    def start(self):
+        for i in range(self.max_concurrent):
+            thread = threading.Thread(target=self.run,
+                                      name='BuildPrefetcher-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        self.threads = []
+
+    def free_mb(self):
+        stat = os.statvfs(self.cache_dir)
+        return stat.f_bavail * stat.f_frsize / (1024 * 1024)
+
+    def prefetch(self, build_url, enable_unittests=False,
+                 test_package_names=None, builder_type=None):
+        """Queue a prefetch of build_url. Return True if it was
+        queued."""
+        logger = utils.getLogger()
+        test_package_names = set(test_package_names or [])
+        with self.lock:
+            pending = self.pending.get(build_url)
+            if pending and (pending['started'] or
+                            (pending['enable_unittests'] >= enable_unittests and
+                             pending['test_package_names'] >= test_package_names)):
+                return False
+            if not pending and len(self.pending) >= self.max_queued:
+                logger.info('BuildPrefetcher: skipping %s: %d builds queued',
+                            build_url, len(self.pending))
+                return False
+            if self.min_free_mb and self.free_mb() < self.min_free_mb:
+                logger.info('BuildPrefetcher: skipping %s: less than %d MB free',
+                            build_url, self.min_free_mb)
+                return False
+            self.pending[build_url] = {
+                'started': False,
+                'enable_unittests': enable_unittests or bool(
+                    pending and pending['enable_unittests']),
+                'test_package_names': test_package_names.union(
+                    pending['test_package_names'] if pending else set()),
+                'builder_type': builder_type,
+            }
+            if pending:
+                # The queued prefetch has not started and will use
+                # the merged arguments.
+                return True
+        self.queue.put(build_url)
+        return True
+
+    def run(self):
+        logger = utils.getLogger()
+        while True:
+            build_url = self.queue.get()
+            if build_url is None:
+                return
+            with self.lock:
+                pending = self.pending[build_url]
+                pending['started'] = True
+                kwargs = dict((key, pending[key]) for key in
+                              ('enable_unittests', 'test_package_names',
+                               'builder_type'))
+            client = BuildCacheClient(port=self.port)
+            try:
+                start = time.time()
+                request_id = client.prefetch(build_url, follow=True, **kwargs)
+                result = client.wait(
+                    request_id,
+                    progress=lambda event: logger.debug(
+                        'BuildPrefetcher: %s: %s %s', build_url,
+                        event['stage'], event['url']))
+                if result and result['success']:
+                    logger.info('BuildPrefetcher: prefetched %s in %.1f seconds',
+                                build_url, time.time() - start)
+                else:
+                    logger.warning('BuildPrefetcher: failed to prefetch %s: %s',
+                                   build_url, result and result['error'])
+            except Exception:
+                logger.exception('BuildPrefetcher: %s', build_url)
+            finally:
+                client.close()
+                with self.lock:
+                    del self.pending[build_url]
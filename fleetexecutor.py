@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import Queue
+import threading
+import time
+import traceback
+
+
+class FleetResult(object):
+    """Result of calling a PhoneWorker method as part of a fleet
+    operation. If the call raised an exception or did not complete
+    before the timeout, error describes the failure."""
+    def __init__(self, phoneid, value=None, error=None):
+        self.phoneid = phoneid
+        self.value = value
+        self.error = error
+
+
+class FleetExecutor(object):
+    """Call a PhoneWorker method on several workers concurrently.
+
+    Each call is made in its own daemon thread. run() yields the
+    FleetResult for each worker as soon as its call completes. Calls
+    which have not completed timeout seconds after the operation
+    started are reported with a timed out error, but they keep running
+    and run() does not finish until they have completed. A caller
+    which holds the Autophone lock while consuming run() therefore
+    keeps it until no call is still changing worker state.
+    """
+
+    TIMEOUT = 60
+
+    def __init__(self, logger, timeout=TIMEOUT):
+        self.logger = logger
+        self.timeout = timeout
+
+    def _call(self, results, worker, method, args):
+        phoneid = worker.phone.id
+        try:
+            value = getattr(worker, method)(*args)
+            results.put(FleetResult(phoneid, value=value))
+        except Exception, e:
+            self.logger.exception('FleetExecutor: %s %s', phoneid, method)
+            results.put(FleetResult(
+                phoneid,
+                error=traceback.format_exception_only(type(e), e)[0].strip()))
+
+    def run(self, workers, method, *args):
+        results = Queue.Queue()
+        pending = set()
+        threads = []
+        for worker in workers:
+            pending.add(worker.phone.id)
+            thread = threading.Thread(target=self._call,
+                                      args=(results, worker, method, args),
+                                      name='Fleet-%s' % worker.phone.id)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            deadline = time.time() + self.timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    result = results.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                pending.discard(result.phoneid)
+                yield result
+            for phoneid in sorted(pending):
+                self.logger.warning('FleetExecutor: %s %s timed out after %s '
+                                    'seconds', phoneid, method, self.timeout)
+                yield FleetResult(phoneid,
+                                  error='timed out after %s seconds' %
+                                  self.timeout)
+        finally:
+            # Wait for the calls which timed out, or whose results
+            # were not consumed, since they are still changing the
+            # state of their workers.
+            for thread in threads:
+                thread.join()
+            while pending:
+                try:
+                    result = results.get_nowait()
+                except Queue.Empty:
+                    break
+                pending.discard(result.phoneid)
+                self.logger.info('FleetExecutor: %s %s completed after timing '
+                                 'out: %s', result.phoneid, method,
+                                 result.error or result.value)
+
+    def call(self, workers, method, *args):
+        """Call method on each of the workers and wait for the calls
+        to complete. Return the list of FleetResults."""
+        return list(self.run(workers, method, *args))
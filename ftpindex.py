@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import HTMLParser
+import re
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import metadataclient
+import utils
+
+
+class FtpIndex(object):
+    """Index of ftp.mozilla.org directory listings kept in the shared
+    metadata cache.
+
+    Each listing is stored as the list of (href, name) links it
+    contains together with the ETag and Last-Modified headers of the
+    response. Listings are reused for LISTING_TTL seconds after they
+    were last checked and are then revalidated with a conditional
+    request. Listings of build directories, which never change once
+    the build has been uploaded, are stored as immutable and are never
+    revalidated. Since a build directory may be listed while its
+    upload is still in progress, immutable may be a function of the
+    listing's links which returns True once the listing is complete.
+    Empty or failed listings are not stored.
+    """
+
+    LISTING_TTL = 60 * 60
+    MAX_CONCURRENT = 8
+
+    # Directory listings are simple enough that a regular expression
+    # is sufficient to extract their links.
+    re_link = re.compile(r'<a\s[^>]*?href\s*=\s*["\']([^"\']*)["\'][^>]*>(.*?)</a>',
+                         re.IGNORECASE | re.DOTALL)
+    re_tag = re.compile(r'<[^>]*>')
+
+    def __init__(self, client=None, max_concurrent=MAX_CONCURRENT):
+        self.client = client or metadataclient.get_client()
+        self.max_concurrent = max_concurrent
+
+    def parse_links(self, content):
+        """Return the list of (href, name) of the non-navigation links
+        in the html content."""
+        parser = HTMLParser.HTMLParser()
+        links = []
+        for href, text in self.re_link.findall(content):
+            href = parser.unescape(href)
+            name = parser.unescape(self.re_tag.sub('', text)).strip()
+            if href.startswith('?') or name == 'Parent Directory':
+                continue
+            links.append((href, name))
+        return links
+
+    def links(self, url, immutable=False):
+        """Return the list of (href, name) links in the directory
+        listing url, fetching or revalidating it if necessary.
+        immutable is either a bool or a function of the list of links
+        which returns True if the listing will not change."""
+        logger = utils.getLogger()
+        key = 'listing:%s' % url
+        found, listing = self.client.cache.get(key)
+        if found and (listing['immutable'] or
+                      time.time() - listing['checked'] < self.LISTING_TTL):
+            self.client.hits += 1
+            return [tuple(link) for link in listing['links']]
+        if self.client.offline:
+            return [tuple(link) for link in listing['links']] if found else []
+
+        self.client.misses += 1
+        headers = {}
+        if found:
+            if listing['etag']:
+                headers['If-None-Match'] = listing['etag']
+            if listing['last_modified']:
+                headers['If-Modified-Since'] = listing['last_modified']
+        try:
+            r = utils.get_remote_response(url, headers=headers)
+        except Exception:
+            logger.exception('FtpIndex: Unable to open %s', url)
+            return [tuple(link) for link in listing['links']] if found else []
+        if found and r.status_code == 304:
+            logger.debug('FtpIndex: %s not modified', url)
+            links = [tuple(link) for link in listing['links']]
+            listing['checked'] = time.time()
+            listing['immutable'] = self.is_immutable(links, immutable)
+            self.client.cache.set(key, listing)
+            return links
+        if not r.ok:
+            logger.warning('FtpIndex: Unable to open url %s : %s', url, r.reason)
+            return [tuple(link) for link in listing['links']] if found else []
+        links = self.parse_links(r.text)
+        if links:
+            self.client.cache.set(key, {
+                'links': links,
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'checked': time.time(),
+                'immutable': self.is_immutable(links, immutable),
+            })
+        return links
+
+    def is_immutable(self, links, immutable):
+        if callable(immutable):
+            return bool(immutable(links))
+        return immutable
+
+    def crawl(self, urls, immutable=False):
+        """Fetch the directory listings urls concurrently so that they
+        are indexed. Return a dict of their links indexed by url."""
+        urls = list(set(urls))
+        if not urls:
+            return {}
+        pool = ThreadPool(min(self.max_concurrent, len(urls)))
+        try:
+            listings = pool.map(lambda url: self.links(url, immutable=immutable),
+                                urls)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(urls, listings))
@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import mmap
+import struct
+
+import pytz
+
+from phonestatus import PhoneStatus
+
+# Phone statuses are stored in the table as their index in
+# PHONE_STATUSES plus one. Zero indicates the slot has not been
+# written.
+PHONE_STATUSES = (PhoneStatus.OK,
+                  PhoneStatus.IDLE,
+                  PhoneStatus.CHARGING,
+                  PhoneStatus.FETCHING,
+                  PhoneStatus.INSTALLING,
+                  PhoneStatus.WORKING,
+                  PhoneStatus.REBOOTING,
+                  PhoneStatus.DISCONNECTED,
+                  PhoneStatus.ERROR,
+                  PhoneStatus.DISABLED,
+                  PhoneStatus.SHUTDOWN)
+
+
+class HeartbeatTable(object):
+    """Table of worker heartbeats in shared memory.
+
+    The table is an anonymous shared mmap created in the main process
+    and inherited by the worker processes when they are forked. Each
+    worker is allocated a fixed size slot containing the time of its
+    last heartbeat and its current phone status. Workers update their
+    slot directly rather than sending a message to the main process
+    for each heartbeat.
+
+    Each slot has a single writer. A sequence number which is odd
+    while the slot is being written allows the main process to detect
+    and retry torn reads without locking.
+    """
+
+    MAX_SLOTS = 256
+    # sequence number, timestamp, status code
+    SLOT_FORMAT = '<IdBxxx'
+    DATA_FORMAT = '<dB'
+    SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+    READ_ATTEMPTS = 100
+
+    def __init__(self, max_slots=MAX_SLOTS):
+        self.max_slots = max_slots
+        self.mmap = mmap.mmap(-1, max_slots * self.SLOT_SIZE)
+        self.slots = {} # dict of slot indexes by phone id
+
+    def allocate(self, phoneid):
+        """Return the slot for phoneid, allocating it if necessary.
+        The slot is cleared so that heartbeats from a previous worker
+        for the same phone are not seen. Call from main process."""
+        if phoneid in self.slots:
+            slot = self.slots[phoneid]
+        else:
+            used = set(self.slots.values())
+            free = [i for i in range(self.max_slots) if i not in used]
+            if not free:
+                raise Exception('HeartbeatTable: no free slot for %s' %
+                                phoneid)
+            slot = free[0]
+            self.slots[phoneid] = slot
+        self._write(slot, 0.0, 0)
+        return slot
+
+    def free(self, phoneid):
+        """Release the slot for phoneid. Call from main process."""
+        slot = self.slots.pop(phoneid, None)
+        if slot is not None:
+            self._write(slot, 0.0, 0)
+
+    def _write(self, slot, timestamp, code):
+        offset = slot * self.SLOT_SIZE
+        seq = struct.unpack_from('<I', self.mmap, offset)[0]
+        struct.pack_into('<I', self.mmap, offset, (seq + 1) & 0xffffffff)
+        struct.pack_into(self.DATA_FORMAT, self.mmap, offset + 4,
+                         timestamp, code)
+        struct.pack_into('<I', self.mmap, offset, (seq + 2) & 0xffffffff)
+
+    def update(self, slot, phone_status, timestamp=None):
+        """Record a heartbeat with the current phone_status in slot.
+        Call from the worker process which owns the slot."""
+        if timestamp is None:
+            timestamp = datetime.datetime.now(tz=pytz.utc)
+        try:
+            code = PHONE_STATUSES.index(phone_status) + 1
+        except ValueError:
+            code = 0
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+        self._write(slot, (timestamp - epoch).total_seconds(), code)
+
+    def read(self, slot):
+        """Return (timestamp, phone_status) of the last heartbeat in
+        slot or (None, None) if none has been recorded."""
+        offset = slot * self.SLOT_SIZE
+        for attempt in range(self.READ_ATTEMPTS):
+            seq, timestamp, code = struct.unpack_from(self.SLOT_FORMAT,
+                                                      self.mmap, offset)
+            if seq & 1:
+                continue
+            if struct.unpack_from('<I', self.mmap, offset)[0] == seq:
+                break
+        else:
+            return None, None
+        if not timestamp:
+            return None, None
+        phone_status = PHONE_STATUSES[code - 1] if code else None
+        return (datetime.datetime.fromtimestamp(
+            timestamp, tz=pytz.utc).replace(microsecond=0), phone_status)
+
+    def get(self, phoneid):
+        """Return (timestamp, phone_status) of the last heartbeat for
+        phoneid. Call from main process."""
+        slot = self.slots.get(phoneid)
+        if slot is None:
+            return None, None
+        return self.read(slot)
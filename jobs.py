@@ -218,14 +218,22 @@ class Jobs(object):
 
         return new_tests
 
-    def jobs_pending(self, device=None):
+    def jobs_pending(self, device=None, build_url=None, exclude_job_id=None):
+        """Return the number of jobs pending for device. If build_url
+        is specified, only count the jobs for that build. If
+        exclude_job_id is specified, do not count that job."""
         conn = self._conn()
         if not device:
             device = self.default_device
-        cursor = self._execute_sql(
-            conn,
-            'select count(id) from jobs where device=?',
-            values=(device,))
+        sql = 'select count(id) from jobs where device=?'
+        values = [device]
+        if build_url:
+            sql += ' and build_url=?'
+            values.append(build_url)
+        if exclude_job_id is not None:
+            sql += ' and id!=?'
+            values.append(exclude_job_id)
+        cursor = self._execute_sql(conn, sql, values=values)
         count = cursor.fetchone()[0]
         cursor.close()
         self._close_connection(conn)
@@ -240,7 +248,150 @@ class Jobs(object):
             values=(attempts, jobid))
         self._commit_connection(conn)
 
-    def get_next_job(self, lifo=False, device=None, worker=None):
+    @staticmethod
+    def job_age(created, now=None):
+        """Return the age in seconds of a job created at the utc
+        isoformat timestamp created."""
+        if not now:
+            now = datetime.datetime.utcnow()
+        try:
+            created = datetime.datetime.strptime(created, '%Y-%m-%dT%H:%M:%S.%f')
+        except ValueError:
+            created = datetime.datetime.strptime(created, '%Y-%m-%dT%H:%M:%S')
+        return (now - created).total_seconds()
+
+    def select_job_row(self, job_rows, max_age, installed_build_url=None,
+                       is_build_cached=None):
+        """Select the next job from job_rows, which are ordered by
+        priority, preferring jobs whose build is already installed on
+        the device and then jobs whose build is already in the build
+        cache so that builds are not repeatedly installed and
+        downloaded when jobs for several builds are interleaved.
+
+        Try jobs retain their priority over other jobs. Jobs which
+        have been waiting for more than max_age seconds are run in
+        priority order before any other jobs so that the preference
+        for installed and cached builds can not starve them.
+        """
+        head = job_rows[0]
+        candidates = [row for row in job_rows
+                      if bool(row['istry']) == bool(head['istry'])]
+        now = datetime.datetime.utcnow()
+        for row in candidates:
+            if self.job_age(row['created'], now) > max_age:
+                return row, 'overdue'
+        if installed_build_url:
+            for row in candidates:
+                if row['build_url'] == installed_build_url:
+                    return row, 'installed'
+        if is_build_cached:
+            cached = {}
+            for row in candidates:
+                build_url = row['build_url']
+                if build_url not in cached:
+                    cached[build_url] = is_build_cached(build_url)
+                if cached[build_url]:
+                    return row, 'cached'
+        return head, 'ordered'
+
+    @staticmethod
+    def device_pool(device):
+        """Return the pool of identical devices to which device
+        belongs. Devices are named <pool>-<number>, e.g. nexus-5-07
+        belongs to the pool nexus-5."""
+        return '-'.join(device.split('-')[:-1])
+
+    @staticmethod
+    def match_test(worker, test_row):
+        """Return the worker's test which matches test_row or None."""
+        for test in worker.tests:
+            if test.name == test_row['name'] and \
+               test.config_file == test_row['config_file'] and \
+               test.chunk == test_row['chunk'] and \
+               test.repos == test_row['repos']:
+                return test
+        return None
+
+    def claim_job(self, conn, device, worker, steal_age):
+        """Claim a job from another device in the same pool as device
+        by reassigning it to device. Return the device from which the
+        job was claimed or None if no job could be claimed.
+
+        Only jobs which have been pending for more than steal_age
+        seconds, which are not being run by their device and whose
+        tests are all defined identically for worker may be claimed.
+        The claim is made with a single conditional update so that
+        only one device can claim a job.
+        """
+        logger = utils.getLogger()
+        pool = self.device_pool(device)
+        if not pool:
+            return None
+        job_cursor = self._execute_sql(
+            conn,
+            'select id,device,created,last_attempt,attempts,'
+            'instr(build_url,"try") as istry '
+            'from jobs where device like ? and device!=? and attempts<? '
+            'order by istry desc, created asc',
+            values=(pool + '-%', device, self.MAX_ATTEMPTS))
+        job_rows = job_cursor.fetchall()
+        job_cursor.close()
+        now = datetime.datetime.utcnow()
+        for job_id, job_device, created, last_attempt, attempts, istry in job_rows:
+            if self.device_pool(job_device) != pool or \
+               self.job_age(created, now) <= steal_age:
+                continue
+            if last_attempt and attempts:
+                # The job is being run by its device.
+                continue
+            test_cursor = self._execute_sql(
+                conn,
+                'select name, config_file, chunk, repos '
+                'from tests where jobid=?', values=(job_id,))
+            test_rows = [
+                {
+                    'name': test_row[0],
+                    'config_file': test_row[1],
+                    'chunk': test_row[2],
+                    'repos': sorted(json.loads(test_row[3]))
+                }
+                for test_row in test_cursor
+            ]
+            test_cursor.close()
+            if not test_rows or \
+               not all(self.match_test(worker, test_row) for test_row in test_rows):
+                continue
+            cursor = self._execute_sql(
+                conn,
+                'update jobs set device=? where id=? and device=? and '
+                'attempts=0 and last_attempt is null',
+                values=(device, job_id, job_device))
+            claimed = cursor.rowcount == 1
+            cursor.close()
+            self._commit_connection(conn)
+            if claimed:
+                logger.info('jobs.claim_job: device %s claimed job %s from %s',
+                            device, job_id, job_device)
+                return job_device
+        return None
+
+    def get_next_job(self, lifo=False, device=None, worker=None,
+                     affinity_max_age=0, installed_build_url=None,
+                     is_build_cached=None, steal_age=0):
+        """Return the next job for device.
+
+        Jobs are ordered with try jobs first then by creation time in
+        FIFO order or LIFO order if lifo is True. If affinity_max_age
+        is not zero, jobs for the build installed_build_url or for
+        builds for which is_build_cached(build_url) returns True are
+        preferred as long as no job has been pending for more than
+        affinity_max_age seconds. See select_job_row.
+
+        If steal_age is not zero and device has no jobs, a job which
+        has been pending for more than steal_age seconds on another
+        device in the same pool is claimed and returned with its
+        claimed_from item set to the other device. See claim_job.
+        """
         logger = utils.getLogger()
         if not device:
             device = self.default_device
@@ -266,47 +417,81 @@ class Jobs(object):
 
         self._commit_connection(conn)
 
-        job_cursor = self._execute_sql(
-            conn,
-            'select id,created,last_attempt,build_url,'
-            'build_id,build_type,build_abi,build_platform,build_sdk,'
-            'changeset,changeset_dirs,tree,revision,builder_type,'
-            'enable_unittests,attempts,instr(build_url,"try") as istry '
-            'from jobs where device=? order by istry desc, '
-            'created %s' % order,
-            values=(device,))
-
-        job_row = job_cursor.fetchone()
-        job_cursor.close()
-        if not job_row:
-            self._close_connection(conn)
-            return None
-
-        job = {'id': job_row[0],
-               'created': job_row[1],
-               'last_attempt': job_row[2],
-               'build_url': job_row[3],
-               'build_id': job_row[4],
-               'build_type': job_row[5],
-               'build_abi': job_row[6],
-               'build_platform': job_row[7],
-               'build_sdk': job_row[8],
-               'changeset': job_row[9],
-               'changeset_dirs': json.loads(job_row[10]),
-               'tree': job_row[11],
-               'revision': job_row[12],
-               'builder_type': job_row[13],
-               'enable_unittests': job_row[14],
-               'attempts': job_row[15],
-               'istry': job_row[16]}
-        job['attempts'] += 1
-        job['last_attempt'] = datetime.datetime.utcnow().isoformat()
+        claimed_from = None
+        if steal_age:
+            count_cursor = self._execute_sql(
+                conn,
+                'select count(id) from jobs where device=?',
+                values=(device,))
+            count = count_cursor.fetchone()[0]
+            count_cursor.close()
+            if not count:
+                claimed_from = self.claim_job(conn, device, worker, steal_age)
 
-        self._execute_sql(
-            conn,
-            'update jobs set attempts=?, last_attempt=? where id=?',
-            values=(job['attempts'], job['last_attempt'],
-                    job['id']))
+        while True:
+            job_cursor = self._execute_sql(
+                conn,
+                'select id,created,last_attempt,build_url,'
+                'build_id,build_type,build_abi,build_platform,build_sdk,'
+                'changeset,changeset_dirs,tree,revision,builder_type,'
+                'enable_unittests,attempts,instr(build_url,"try") as istry '
+                'from jobs where device=? order by istry desc, '
+                'created %s' % order,
+                values=(device,))
+
+            job_rows = [{'id': job_row[0],
+                         'created': job_row[1],
+                         'last_attempt': job_row[2],
+                         'build_url': job_row[3],
+                         'build_id': job_row[4],
+                         'build_type': job_row[5],
+                         'build_abi': job_row[6],
+                         'build_platform': job_row[7],
+                         'build_sdk': job_row[8],
+                         'changeset': job_row[9],
+                         'changeset_dirs': job_row[10],
+                         'tree': job_row[11],
+                         'revision': job_row[12],
+                         'builder_type': job_row[13],
+                         'enable_unittests': job_row[14],
+                         'attempts': job_row[15],
+                         'istry': job_row[16]}
+                        for job_row in job_cursor]
+            job_cursor.close()
+            if not job_rows:
+                self._close_connection(conn)
+                return None
+
+            if affinity_max_age and len(job_rows) > 1:
+                job, reason = self.select_job_row(
+                    job_rows, affinity_max_age,
+                    installed_build_url=installed_build_url,
+                    is_build_cached=is_build_cached)
+                logger.debug('jobs.get_next_job: selected %s job %s of %d',
+                             reason, job['id'], len(job_rows))
+            else:
+                job = job_rows[0]
+            job['changeset_dirs'] = json.loads(job['changeset_dirs'])
+            job['claimed_from'] = claimed_from
+            job['attempts'] += 1
+            job['last_attempt'] = datetime.datetime.utcnow().isoformat()
+
+            cursor = self._execute_sql(
+                conn,
+                'update jobs set attempts=?, last_attempt=? '
+                'where id=? and device=?',
+                values=(job['attempts'], job['last_attempt'],
+                        job['id'], device))
+            marked = cursor.rowcount == 1
+            cursor.close()
+            if not marked:
+                # The job was claimed by another device after it was
+                # selected. Select again.
+                logger.info('jobs.get_next_job: job %s was claimed by another '
+                            'device', job['id'])
+                self._commit_connection(conn)
+                continue
+            break
 
         job['tests'] = []
         test_cursor = self._execute_sql(
@@ -329,16 +514,13 @@ class Jobs(object):
         for test_row in test_rows:
             # Generate the list of tests to be executed for this job
             test_row['repos'].sort()
-            for test in worker.tests:
-                if test.name == test_row['name'] and \
-                   test.config_file == test_row['config_file'] and \
-                   test.chunk == test_row['chunk'] and \
-                   test.repos == test_row['repos']:
-                    if not test_row['guid']:
-                        logger.error('jobs.get_next_job: invalid job_guid: %s', job)
-                        raise Exception('Found test with invalid job_guid')
-                    test.job_guid = test_row['guid']
-                    job['tests'].append(test)
+            test = self.match_test(worker, test_row)
+            if test:
+                if not test_row['guid']:
+                    logger.error('jobs.get_next_job: invalid job_guid: %s', job)
+                    raise Exception('Found test with invalid job_guid')
+                test.job_guid = test_row['guid']
+                job['tests'].append(test)
         logger.debug('jobs.get_next_job: %s', job)
         self._commit_connection(conn)
         self._close_connection(conn)
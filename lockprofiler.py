@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import threading
+import time
+
+
+class LockSiteStats(object):
+    """Accumulated wait and hold times in seconds for the sampled
+    acquisitions of a lock at a call site."""
+    def __init__(self):
+        self.count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+
+class LockProfiler(object):
+    """Wrap a threading.Lock or RLock and measure, for every
+    sample_interval-th acquisition, how long the caller waited to
+    acquire the lock and how long it held it. The statistics are
+    accumulated per call site, identified by the file, line and
+    function which called acquire.
+
+    Unsampled acquisitions cost a counter increment. If sample_interval
+    is 0, no acquisitions are sampled.
+    """
+
+    def __init__(self, lock, sample_interval=0):
+        self.lock = lock
+        self.sample_interval = sample_interval
+        self.stats = {} # dict of LockSiteStats indexed by call site
+        self._stats_lock = threading.Lock()
+        self._counter = 0
+        # Each thread keeps a stack of (site, acquired time) for its
+        # sampled acquisitions or None for unsampled ones, so that
+        # reentrant acquisitions of an RLock are matched with their
+        # releases.
+        self._local = threading.local()
+
+    def _held(self):
+        try:
+            return self._local.held
+        except AttributeError:
+            self._local.held = []
+            return self._local.held
+
+    def acquire(self, depth=1):
+        """Acquire the lock. depth is the number of frames between the
+        caller of interest and this method."""
+        held = self._held()
+        self._counter += 1
+        if not self.sample_interval or self._counter % self.sample_interval:
+            self.lock.acquire()
+            held.append(None)
+            return
+        frame = sys._getframe(depth)
+        site = '%s:%d %s' % (os.path.basename(frame.f_code.co_filename),
+                             frame.f_lineno, frame.f_code.co_name)
+        start = time.time()
+        self.lock.acquire()
+        acquired = time.time()
+        held.append((site, acquired))
+        with self._stats_lock:
+            stats = self.stats.get(site)
+            if not stats:
+                stats = self.stats[site] = LockSiteStats()
+            stats.count += 1
+            wait = acquired - start
+            stats.wait_total += wait
+            stats.wait_max = max(stats.wait_max, wait)
+
+    def release(self):
+        held = self._held()
+        sample = held.pop() if held else None
+        self.lock.release()
+        if sample is None:
+            return
+        site, acquired = sample
+        hold = time.time() - acquired
+        with self._stats_lock:
+            stats = self.stats[site]
+            stats.hold_total += hold
+            stats.hold_max = max(stats.hold_max, hold)
+
+    def report(self):
+        """Return a text report of the sampled wait and hold times per
+        call site, ordered by total wait time."""
+        with self._stats_lock:
+            items = [(site, stats.count,
+                      stats.wait_total, stats.wait_max,
+                      stats.hold_total, stats.hold_max)
+                     for site, stats in self.stats.iteritems()]
+        if not self.sample_interval:
+            return 'lock profiling disabled\n'
+        items.sort(key=lambda item: item[2], reverse=True)
+        response = 'sampled 1 in %d of %d acquisitions\n' % (
+            self.sample_interval, self._counter)
+        response += '%-48s %8s %10s %10s %10s %10s\n' % (
+            'site', 'samples', 'wait avg', 'wait max', 'hold avg', 'hold max')
+        for site, count, wait_total, wait_max, hold_total, hold_max in items:
+            response += '%-48s %8d %10.6f %10.6f %10.6f %10.6f\n' % (
+                site, count, wait_total / count, wait_max,
+                hold_total / count, hold_max)
+        return response
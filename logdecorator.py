@@ -2,11 +2,21 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import logging
 import re
 import sys
 import traceback
 
 class LogDecorator(object):
+    """Wrap a logger, decorating each message with extraformat % extradict
+    where extradict['message'] is the original message.
+
+    Similar to logging.LoggerAdapter, the level is checked before the
+    message is expanded so that messages which will not be emitted cost
+    only the level check. The parts of extraformat surrounding
+    %(message)s are expanded once when the LogDecorator is created or
+    cloned.
+    """
     def __init__(self, logger, extradict, extraformat):
         self._logger = logger
         self._extradict = extradict
@@ -16,18 +26,39 @@ class LogDecorator(object):
             raise ValueError('format string contains a %(attribute)'
                              'pattern without a type specifier.')
 
+        self._prefix, self._suffix = self._compile()
+
+    def _compile(self):
+        """Return the expanded text preceding and following %(message)s
+        in the format, or (None, None) if the format can not be split
+        around a single %(message)s."""
+        parts = self._extraformat.split('%(message)s')
+        if len(parts) != 2:
+            return None, None
+        try:
+            expanded = []
+            for part in parts:
+                part = part % self._extradict
+                if not isinstance(part, unicode):
+                    part = unicode(part, errors='replace')
+                expanded.append(part)
+        except Exception:
+            return None, None
+        return expanded[0], expanded[1]
+
     def clone(self, extradict=None, extraformat=None):
         extradict = extradict or self._extradict
         extraformat = extraformat or self._extraformat
         return LogDecorator(self._logger, extradict, extraformat)
 
     def _expanded_message(self, message):
-        extradict = dict(self._extradict)
         try:
-            if isinstance(message, unicode):
-                extradict['message'] = message
-            else:
-                extradict['message'] = unicode(message, errors='replace')
+            if not isinstance(message, unicode):
+                message = unicode(message, errors='replace')
+            if self._prefix is not None:
+                return self._prefix + message + self._suffix
+            extradict = dict(self._extradict)
+            extradict['message'] = message
             extramessage = self._extraformat % extradict
         except:
             etype, evalue, etraceback = sys.exc_info()
@@ -36,32 +67,82 @@ class LogDecorator(object):
             print message
         return extramessage
 
+    def process(self, message, kwargs):
+        return self._expanded_message(message), kwargs
+
     def logger(self):
         return self._logger
 
     def getEffectiveLevel(self):
         return self._logger.getEffectiveLevel()
 
+    def isEnabledFor(self, lvl):
+        return self._logger.isEnabledFor(lvl)
+
     def debug(self, message, *args, **kwargs):
-        self._logger.debug(self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(self._expanded_message(message), *args, **kwargs)
 
     def info(self, message, *args, **kwargs):
-        self._logger.info(self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(self._expanded_message(message), *args, **kwargs)
 
     def warning(self, message, *args, **kwargs):
-        self._logger.warning(self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._logger.warning(self._expanded_message(message), *args, **kwargs)
 
     def warn(self, message, *args, **kwargs):
-        self._logger.warning(self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._logger.warning(self._expanded_message(message), *args, **kwargs)
 
     def error(self, message, *args, **kwargs):
-        self._logger.error(self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(self._expanded_message(message), *args, **kwargs)
 
     def critical(self, message, *args, **kwargs):
-        self._logger.critical(self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(logging.CRITICAL):
+            self._logger.critical(self._expanded_message(message), *args, **kwargs)
 
     def log(self, lvl, message, *args, **kwargs):
-        self._logger.log(lvl, self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(lvl):
+            message, kwargs = self.process(message, kwargs)
+            self._logger.log(lvl, message, *args, **kwargs)
 
     def exception(self, message, *args, **kwargs):
-        self._logger.exception(self._expanded_message(message), *args, **kwargs)
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.exception(self._expanded_message(message), *args, **kwargs)
+
+
+if __name__ == '__main__':
+    # Benchmark the per call cost of logging through a LogDecorator
+    # when the level is disabled compared with expanding the full
+    # format before calling the logger as was previously done.
+    import timeit
+
+    logger = logging.getLogger('logdecorator-benchmark')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    loggerdeco = LogDecorator(logger, {}, '%(message)s').clone(
+        extradict={'repo': 'mozilla-central',
+                   'buildid': '20161018000000',
+                   'buildtype': 'opt',
+                   'sdk': 'api-15',
+                   'platform': 'android-api-15',
+                   'testname': 's1s2'},
+        extraformat='S1S2Test %(repo)s %(buildid)s %(buildtype)s %(sdk)s '
+                    '%(platform)s %(testname)s %(message)s')
+    line = 'I/GeckoConsole( 1234): Some logcat line to be analyzed'
+    number = 200000
+
+    def eager():
+        extradict = dict(loggerdeco._extradict)
+        extradict['message'] = unicode('logcat: %s', errors='replace')
+        logger.debug(loggerdeco._extraformat % extradict, line)
+
+    def lazy():
+        loggerdeco.debug('logcat: %s', line)
+
+    for name, func in (('eager', eager), ('lazy', lazy)):
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print '%-6s %8.3f usec/call' % (name, seconds * 1e6 / number)
@@ -0,0 +1,322 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import taskcluster
+from thclient import TreeherderClient
+
+import utils
+
+
+class MetadataCache(object):
+    """Cache of JSON serializable values in a sqlite database shared
+    by all of the Autophone processes.
+
+    Each entry is indexed by a key such as 'task:<task_id>' or
+    'url:<url>' and expires ttl seconds after it was stored. Entries
+    stored with a ttl of None never expire.
+    """
+
+    def __init__(self, filename='metadata.sqlite', timeout=60):
+        self.filename = filename
+        self.timeout = timeout
+        conn = self._conn()
+        conn.execute('create table if not exists metadata ('
+                     'key text primary key, '
+                     'value text, '
+                     'created real, '
+                     'expires real)')
+        conn.commit()
+        conn.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.filename, timeout=self.timeout)
+
+    def get(self, key):
+        """Return (True, value) if key is cached and has not expired,
+        otherwise (False, None)."""
+        conn = self._conn()
+        try:
+            row = conn.execute('select value, expires from metadata where key=?',
+                               (key,)).fetchone()
+        finally:
+            conn.close()
+        if not row or (row[1] is not None and row[1] < time.time()):
+            return False, None
+        return True, json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        conn = self._conn()
+        try:
+            conn.execute('insert or replace into metadata values (?, ?, ?, ?)',
+                         (key, json.dumps(value), now, expires))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, key=None):
+        """Delete the entry for key or all entries if key is None."""
+        conn = self._conn()
+        try:
+            if key is None:
+                conn.execute('delete from metadata')
+            else:
+                conn.execute('delete from metadata where key=?', (key,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def purge(self):
+        """Delete the expired entries."""
+        conn = self._conn()
+        try:
+            conn.execute('delete from metadata where expires<?', (time.time(),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def entries(self, prefix=''):
+        """Return a list of (key, created, expires) for the entries
+        whose keys begin with prefix."""
+        conn = self._conn()
+        try:
+            return conn.execute('select key, created, expires from metadata '
+                                'where substr(key, 1, ?)=? order by key',
+                                (len(prefix), prefix)).fetchall()
+        finally:
+            conn.close()
+
+    def dump(self, path):
+        """Write the unexpired entries to the JSON file path so that
+        they can be loaded as fixtures."""
+        now = time.time()
+        conn = self._conn()
+        try:
+            fixtures = dict((key, json.loads(value)) for key, value, expires in
+                            conn.execute('select key, value, expires from metadata')
+                            if expires is None or expires >= now)
+        finally:
+            conn.close()
+        with open(path, 'w') as fixtures_file:
+            json.dump(fixtures, fixtures_file, indent=2, sort_keys=True)
+
+    def load(self, path):
+        """Store the entries from the JSON file path written by dump
+        without expiration."""
+        with open(path) as fixtures_file:
+            fixtures = json.load(fixtures_file)
+        for key, value in fixtures.iteritems():
+            self.set(key, value)
+
+
+class MetadataClient(object):
+    """Lookup build metadata from TaskCluster, Treeherder and hg
+    through a MetadataCache.
+
+    Task definitions, artifact lists of completed runs and revision
+    metadata are immutable and are cached forever. Treeherder jobs and
+    TaskCluster index listings are cached for TREEHERDER_JOB_TTL and
+    INDEX_TTL seconds. Lookups which fail are not cached.
+    Concurrent lookups of the same key by threads of the same process
+    are coalesced into a single request whose value, or exception, is
+    returned to, or raised in, each of the threads. If offline is True, lookups
+    which are not cached return None without making a request.
+    """
+
+    TREEHERDER_JOB_TTL = 60 * 60
+    INDEX_TTL = 60 * 60
+
+    def __init__(self, cache=None, offline=False):
+        self.cache = cache or MetadataCache()
+        self.offline = offline
+        self._queue = None
+        self._index = None
+        self._treeherder_client = None
+        self._lock = threading.Lock()
+        # dict of (event, [value, exc_info]) indexed by key
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def queue(self):
+        if not self._queue:
+            self._queue = taskcluster.queue.Queue()
+        return self._queue
+
+    @property
+    def index(self):
+        if not self._index:
+            self._index = taskcluster.index.Index()
+        return self._index
+
+    @property
+    def treeherder_client(self):
+        if not self._treeherder_client:
+            # Note this uses the production instance of Treeherder
+            # which should be alright since we are looking up build
+            # jobs which will always be available on the production
+            # instance.
+            self._treeherder_client = TreeherderClient()
+        return self._treeherder_client
+
+    def lookup(self, key, fetch, ttl=None):
+        """Return the cached value for key or the value returned by
+        fetch() which is cached unless it is None. If fetch() raises
+        an exception, it is raised in each of the threads waiting for
+        the lookup."""
+        found, value = self.cache.get(key)
+        if found:
+            self.hits += 1
+            return value
+        if self.offline:
+            return None
+        with self._lock:
+            inflight = self._inflight.get(key)
+            if inflight:
+                owner = False
+            else:
+                owner = True
+                inflight = self._inflight[key] = (threading.Event(),
+                                                  [None, None])
+        event, result = inflight
+        if not owner:
+            event.wait()
+            if result[1]:
+                raise result[1][0], result[1][1], result[1][2]
+            return result[0]
+        try:
+            self.misses += 1
+            value = fetch()
+            if value is not None:
+                self.cache.set(key, value, ttl)
+            result[0] = value
+            return value
+        except:
+            result[1] = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def get_json(self, url, ttl=None):
+        """Return the JSON content of url. Only use the default ttl of
+        None for urls whose content is immutable."""
+        return self.lookup('url:%s' % url,
+                           lambda: utils.get_remote_json(url),
+                           ttl=ttl)
+
+    def get_text(self, url, ttl=None):
+        """Return the content of url. Only use the default ttl of None
+        for urls whose content is immutable."""
+        return self.lookup('text:%s' % url,
+                           lambda: utils.get_remote_text(url),
+                           ttl=ttl)
+
+    def task_definition(self, task_id):
+        return self.lookup('task:%s' % task_id,
+                           lambda: self.queue.task(task_id))
+
+    def list_tasks(self, namespace):
+        """Return the TaskCluster index listTasks response for
+        namespace. Builds may still be added to a namespace so
+        non-empty responses are cached for INDEX_TTL seconds and empty
+        ones are not cached."""
+        return self.lookup('index:%s' % namespace,
+                           lambda: self.index.listTasks(namespace, {}).get(
+                               'tasks') or None,
+                           ttl=self.INDEX_TTL) or []
+
+    def artifacts(self, task_id, run_id):
+        """Return the list of artifacts of run_id of task_id. Only use
+        for completed runs whose artifacts can no longer change."""
+        def fetch():
+            artifacts = []
+            response = self.queue.listArtifacts(task_id, run_id)
+            while True:
+                if 'artifacts' not in response:
+                    utils.getLogger().warning(
+                        'MetadataClient: listArtifacts(%s, %s) '
+                        'response missing artifacts', task_id, run_id)
+                    return None
+                artifacts.extend(response['artifacts'])
+                if 'continuationToken' not in response:
+                    return artifacts
+                response = self.queue.listArtifacts(task_id, run_id, {
+                    'continuationToken': response['continuationToken']})
+
+        return self.lookup('artifacts:%s/%s' % (task_id, run_id), fetch) or []
+
+    def revision(self, changeset_url):
+        """Return the json-rev metadata for the hg changeset url
+        https://hg.mozilla.org/<repo>/rev/<revision>."""
+        return self.get_json(changeset_url.replace('/rev/', '/json-rev/'))
+
+    def treeherder_jobs(self, repo, job_guid):
+        """Return the list of Treeherder jobs for job_guid. Jobs which
+        have not been ingested yet are not cached."""
+        return self.lookup('treeherder:%s:%s' % (repo, job_guid),
+                           lambda: self.treeherder_client.get_jobs(
+                               repo, job_guid=job_guid) or None,
+                           ttl=self.TREEHERDER_JOB_TTL) or []
+
+
+_CLIENT = None
+_CLIENT_PID = None
+
+def get_client():
+    """Return the MetadataClient for this process. Each process
+    creates its own client since the in-flight lookups and the
+    TaskCluster and Treeherder clients are not shared across fork."""
+    global _CLIENT, _CLIENT_PID
+
+    if _CLIENT_PID != os.getpid():
+        _CLIENT = MetadataClient()
+        _CLIENT_PID = os.getpid()
+    return _CLIENT
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect the metadata cache.')
+    parser.add_argument('--cache',
+                        dest='cache',
+                        default='metadata.sqlite',
+                        help='Metadata cache database. (default: metadata.sqlite)')
+    parser.add_argument('command',
+                        choices=['list', 'show', 'delete', 'purge', 'dump', 'load'],
+                        help='list [prefix], show key, delete [key], purge, '
+                        'dump fixtures.json or load fixtures.json')
+    parser.add_argument('argument', nargs='?', default=None)
+    args = parser.parse_args()
+
+    cache = MetadataCache(args.cache)
+    if args.command == 'list':
+        for key, created, expires in cache.entries(args.argument or ''):
+            print '%s %s %s' % (time.strftime('%Y-%m-%dT%H:%M:%S',
+                                              time.localtime(created)),
+                                'never' if expires is None else
+                                time.strftime('%Y-%m-%dT%H:%M:%S',
+                                              time.localtime(expires)),
+                                key)
+    elif args.command == 'show':
+        found, value = cache.get(args.argument)
+        print json.dumps(value, indent=2, sort_keys=True) if found else 'not found'
+    elif args.command == 'delete':
+        cache.delete(args.argument)
+    elif args.command == 'purge':
+        cache.purge()
+    elif args.command == 'dump':
+        cache.dump(args.argument)
+    elif args.command == 'load':
+        cache.load(args.argument)
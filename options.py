@@ -33,7 +33,13 @@ class AutophoneOptions(object):
         self.platforms = []
         self.buildtypes = []
         self.lifo = False
+        self.build_affinity_max_age = 0
+        self.device_pool_steal_age = 0
         self.build_cache_port = -1
+        self.build_cache_host = ''
+        self.build_cache_peers = []
+        self.build_prefetch_concurrency = 0
+        self.build_prefetch_min_free_mb = 1024
         self.verbose = False
         self.treeherder_url = ''
         self.treeherder_client_id = ''
@@ -45,6 +51,8 @@ class AutophoneOptions(object):
         self.usbwatchdog_appname = ''
         self.usbwatchdog_poll_interval = 0
         self.device_test_root = ''
+        self.device_capabilities_dir = ''
+        self.lock_profile_interval = 0
         # Sensitive options should not be output to the logs
         self.phonedash_user = ''
         self.phonedash_password = ''
@@ -66,6 +74,8 @@ class AutophoneOptions(object):
         self.phone_max_reboots = PhoneWorker.PHONE_MAX_REBOOTS
         self.phone_ping_interval = PhoneWorker.PHONE_PING_INTERVAL
         self.phone_command_queue_timeout = PhoneWorker.PHONE_COMMAND_QUEUE_TIMEOUT
+        self.device_reboot_interval = PhoneWorker.DEVICE_REBOOT_INTERVAL
+        self.device_min_free_space = PhoneWorker.DEVICE_MIN_FREE_SPACE
         self.phone_crash_window = Crashes.CRASH_WINDOW
         self.phone_crash_limit = Crashes.CRASH_LIMIT
         # other
@@ -93,7 +103,13 @@ class AutophoneOptions(object):
                      'platforms',
                      'buildtypes',
                      'lifo',
+                     'build_affinity_max_age',
+                     'device_pool_steal_age',
                      'build_cache_port',
+                     'build_cache_host',
+                     'build_cache_peers',
+                     'build_prefetch_concurrency',
+                     'build_prefetch_min_free_mb',
                      'verbose',
                      'treeherder_url',
                      'treeherder_tier',
@@ -101,6 +117,8 @@ class AutophoneOptions(object):
                      'reboot_on_error',
                      'maximum_heartbeat',
                      'device_test_root',
+                     'device_capabilities_dir',
+                     'lock_profile_interval',
                      'build_cache_size',
                      'build_cache_expires',
                      'device_ready_retry_wait',
@@ -112,6 +130,8 @@ class AutophoneOptions(object):
                      'phone_max_reboots',
                      'phone_ping_interval',
                      'phone_command_queue_timeout',
+                     'device_reboot_interval',
+                     'device_min_free_space',
                      'phone_crash_window',
                      'phone_crash_limit',
                      'debug')
@@ -576,8 +576,9 @@ class PhoneTest(object):
                 if not self.dm.is_dir(self._base_device_path, root=True):
                     self.loggerdeco.debug('Attempt %d creating base device path %s',
                                           attempt, self._base_device_path)
-                    self.dm.mkdir(self._base_device_path, parents=True, root=True)
-                    self.dm.chmod(self._base_device_path, recursive=True, root=True)
+                    with self.dm.batch(root=True) as b:
+                        b.mkdir(self._base_device_path, parents=True)
+                        b.chmod(self._base_device_path, recursive=True)
                 success = True
                 break
             except ADBError:
@@ -788,12 +789,10 @@ class PhoneTest(object):
                                  "-a org.mozilla.gecko.SHUTDOWN "
                                  "-n %s/.App" % self.build.app_name)
         # Give the app a chance to shutdown.
-        for attempt in range(1, max_wait_time+1):
-            self.loggerdeco.debug('stop_application: waiting attempt: %s', attempt)
-            sleep(1)
-            result = not self.dm.process_exist(self.build.app_name)
-            if result:
-                break
+        self.loggerdeco.debug('stop_application: waiting up to %s seconds',
+                              max_wait_time)
+        result = self.dm.wait_for_process_exit(self.build.app_name,
+                                               timeout=max_wait_time)
         if not result:
             self.loggerdeco.info('stop_application: am force-stop')
             self.dm.shell_output("am force-stop %s" % self.build.app_name)
@@ -878,27 +877,21 @@ class PhoneTest(object):
     def wait_for_fennec(self, max_wait_time=60, wait_time=5,
                         kill_wait_time=20, root=True):
         # Wait for up to a max_wait_time seconds for fennec to close.
-        # Check that fennec is still running every wait_time
-        # seconds. If fennec doesn't close on its own, attempt up to 3
+        # If fennec doesn't close on its own, attempt up to 3
         # times to kill fennec, waiting kill_wait_time seconds between
         # attempts.  Return True if fennec exits on its own, False if
         # it needs to be killed.  Re-raise the last exception if
         # fennec can not be killed.
-        max_wait_attempts = max_wait_time / wait_time
+        # wait_time is retained for compatibility. The polling is now
+        # performed on the device by wait_for_process_exit.
         self.loggerdeco.debug('wait_for_fennec: '
                               'max_wait_time %s, '
-                              'wait_time %s, '
-                              'kill_wait_time %s, '
-                              'max_wait_attempts: %s' %
+                              'kill_wait_time %s' %
                               (max_wait_time,
-                               wait_time,
-                               kill_wait_time,
-                               max_wait_attempts))
-        for wait_attempt in range(1, max_wait_attempts+1):
-            self.loggerdeco.debug('wait_for_fennec: attempt %s waiting' % wait_attempt)
-            if not self.dm.process_exist(self.build.app_name):
-                return True
-            sleep(wait_time)
+                               kill_wait_time))
+        if self.dm.wait_for_process_exit(self.build.app_name,
+                                         timeout=max_wait_time):
+            return True
         max_killattempts = 3
         for kill_attempt in range(1, max_killattempts+1):
             try:
@@ -919,15 +912,12 @@ class PhoneTest(object):
         for attempt in range(1, self.options.phone_retry_limit+1):
             self.loggerdeco.debug('Attempt %d Installing local pages', attempt)
             try:
-                self.dm.rm(self._paths['dest'], recursive=True, force=True, root=True)
-                self.dm.mkdir(self._paths['dest'], parents=True, root=True)
-                for push_source in self._pushes:
-                    push_dest = self._pushes[push_source]
-                    if os.path.isdir(push_source):
-                        self.dm.push(push_source, push_dest)
-                    else:
-                        self.dm.push(push_source, push_dest)
-                self.dm.chmod(self._paths['dest'], recursive=True, root=True)
+                # Only push the pages which have changed since they
+                # were last installed on the device.
+                self.dm.sync(self._pushes,
+                             posixpath.join(self._paths['dest'],
+                                            '.autophone_pages_manifest'),
+                             mask='777', root=True)
                 success = True
                 break
             except ADBError:
@@ -1013,8 +1003,12 @@ class PhoneTest(object):
         self.loggerdeco.debug('PhoneTest.teardown_job')
         self.stop_time = datetime.datetime.utcnow()
         if self.stop_time and self.start_time:
-            self.loggerdeco.info('Test %s elapsed time: %s',
-                                 self.name, self.stop_time - self.start_time)
+            # ap-assignments.py parses this message to measure test
+            # durations.
+            self.loggerdeco.info('Test %s elapsed time: %s config: %s phone: %s',
+                                 self.name, self.stop_time - self.start_time,
+                                 os.path.basename(self.config_file),
+                                 self.phone.id)
         try:
             if self.worker_subprocess.is_ok():
                 # Do not attempt to process crashes if the device is
@@ -1108,14 +1102,15 @@ class PhoneTest(object):
                 if self.dm.exists(self.profile_path, root=root):
                     # If the profile already exists, chmod it to make sure
                     # we have permission to delete it.
-                    self.dm.chmod(self.profile_path, recursive=True, root=root)
-                    self.dm.rm(self.profile_path, recursive=True,
-                               force=True, root=root)
-                self.dm.chmod(profile_path_parent, root=root)
-                self.dm.mkdir(self.profile_path, root=root)
-                self.dm.chmod(self.profile_path, root=root)
-                self.dm.push(profile.profile, self.profile_path)
-                self.dm.chmod(self.profile_path, recursive=True, root=root)
+                    with self.dm.batch(root=root) as b:
+                        b.chmod(self.profile_path, recursive=True)
+                        b.rm(self.profile_path, recursive=True, force=True)
+                with self.dm.batch(root=root) as b:
+                    b.chmod(profile_path_parent)
+                    b.mkdir(self.profile_path)
+                    b.chmod(self.profile_path)
+                    b.push_tree(profile.profile, self.profile_path)
+                    b.chmod(self.profile_path, recursive=True)
                 success = True
                 break
             except ADBError:
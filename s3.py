@@ -14,6 +14,7 @@ import boto
 import boto.s3.connection
 
 import utils
+import zerocopy
 
 class S3Error(Exception):
     def __init__(self, message):
@@ -81,8 +82,10 @@ class S3Bucket(object):
             with tempfile.NamedTemporaryFile('w+b', suffix=ext) as tf:
                 logger.debug('Compressing: %s', path)
                 with gzip.GzipFile(path, 'wb', fileobj=tf) as gz:
-                    with open(path, 'rb') as f:
-                        gz.writelines(f)
+                    # Compress the mapped file in a single write rather
+                    # than copying it line by line.
+                    with zerocopy.mapped(path) as data:
+                        gz.write(data)
                 tf.flush()
                 tf.seek(0)
                 key.set_metadata('Content-Encoding', 'gzip')
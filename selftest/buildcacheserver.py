@@ -0,0 +1,280 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import builds
+import buildserver
+import utils
+
+
+class FakeBuildCache(object):
+    """BuildCache which reports a build download for each get and
+    returns the build url as the metadata. A get for a url in gates
+    does not complete until its gate is set."""
+
+    def __init__(self):
+        self.gates = {}
+
+    def get(self, build_url, force=False, enable_unittests=False,
+            test_package_names=None, builder_type=None, progress=None):
+        if progress:
+            progress('build', build_url)
+        gate = self.gates.get(build_url)
+        if gate:
+            gate.wait(10)
+        return {'success': True, 'error': '', 'metadata': build_url}
+
+
+class UnserializedBuildCacheServer(buildserver.BuildCacheServer):
+    """BuildCacheServer which does not serialize gets so that their
+    results can complete in any order."""
+
+    def acquire_cache(self, prefetch=False):
+        pass
+
+    def release_cache(self):
+        pass
+
+
+class BuildServerTestCase(unittest.TestCase):
+
+    def start_server(self, build_cache,
+                     server_class=buildserver.BuildCacheServer):
+        server = server_class(('127.0.0.1', 0), buildserver.BuildCacheHandler)
+        server.daemon_threads = True
+        server.build_cache = build_cache
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def client(self, server):
+        client = buildserver.BuildCacheClient(port=server.server_address[1])
+        self.addCleanup(lambda: client.sock and client.close())
+        return client
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        a, b = socket.socketpair()
+        buildserver.send_frame(a, {'id': 1, 'url': 'http://example.com/'})
+        self.assertEqual(buildserver.recv_frame(b),
+                         {'id': 1, 'url': 'http://example.com/'})
+        a.close()
+        self.assertEqual(buildserver.recv_frame(b), None)
+        b.close()
+
+    def test_max_frame_size(self):
+        a, b = socket.socketpair()
+        a.sendall(buildserver.FRAME_HEADER.pack(buildserver.MAX_FRAME_SIZE))
+        self.assertRaises(ValueError, buildserver.recv_frame, b)
+        self.assertRaises(ValueError, buildserver.send_frame, a,
+                          'x' * (buildserver.MAX_FRAME_SIZE - 2))
+        a.close()
+        b.close()
+
+
+class BuildCacheProtocolTest(BuildServerTestCase):
+
+    def test_pipelined_results_out_of_order(self):
+        build_cache = FakeBuildCache()
+        build_cache.gates['http://example.com/a/target.apk'] = threading.Event()
+        server = self.start_server(build_cache, UnserializedBuildCacheServer)
+        client = self.client(server)
+        request_a = client.submit('http://example.com/a/target.apk')
+        request_b = client.submit('http://example.com/b/target.apk')
+        event = client.next_event()
+        self.assertEqual(event['id'], request_b)
+        self.assertEqual(event['event'], 'result')
+        self.assertEqual(event['result']['metadata'],
+                         'http://example.com/b/target.apk')
+        build_cache.gates['http://example.com/a/target.apk'].set()
+        self.assertEqual(client.wait(request_a)['metadata'],
+                         'http://example.com/a/target.apk')
+        self.assertEqual(client.events, {})
+
+    def test_get_many_keeps_request_order(self):
+        build_cache = FakeBuildCache()
+        gate = threading.Event()
+        build_cache.gates['http://example.com/a/target.apk'] = gate
+        server = self.start_server(build_cache, UnserializedBuildCacheServer)
+        client = self.client(server)
+        threading.Timer(0.2, gate.set).start()
+        results = client.get_many([{'url': 'http://example.com/a/target.apk'},
+                                   {'url': 'http://example.com/b/target.apk'}])
+        self.assertEqual([result['metadata'] for result in results],
+                         ['http://example.com/a/target.apk',
+                          'http://example.com/b/target.apk'])
+
+    def test_prefetch_accepted_and_progress(self):
+        server = self.start_server(FakeBuildCache())
+        client = self.client(server)
+        request_id = client.prefetch('http://example.com/a/target.apk',
+                                     follow=True)
+        events = []
+        result = client.wait(request_id, progress=events.append)
+        self.assertTrue(result['success'])
+        self.assertEqual([(event['stage'], event['url']) for event in events],
+                         [('build', 'http://example.com/a/target.apk')])
+
+        request_id = client.prefetch('http://example.com/b/target.apk',
+                                     follow=True)
+        self.assertEqual(client.next_event([request_id])['event'], 'accepted')
+
+    def test_get_progress(self):
+        server = self.start_server(FakeBuildCache())
+        client = self.client(server)
+        request_id = client.submit('http://example.com/a/target.apk',
+                                   progress=True)
+        events = []
+        client.wait(request_id, progress=events.append)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['event'], 'progress')
+
+    def test_unfollowed_prefetch_events_are_discarded(self):
+        build_cache = FakeBuildCache()
+        gate = threading.Event()
+        build_cache.gates['http://example.com/a/target.apk'] = gate
+        server = self.start_server(build_cache, UnserializedBuildCacheServer)
+        client = self.client(server)
+        client.prefetch('http://example.com/a/target.apk')
+        # The prefetch's events arrive while waiting for the gets.
+        client.get('http://example.com/b/target.apk')
+        gate.set()
+        time.sleep(0.2)
+        result = client.get('http://example.com/c/target.apk')
+        self.assertEqual(result['metadata'], 'http://example.com/c/target.apk')
+        self.assertEqual(client.events, {})
+
+    def test_legacy_line_protocol(self):
+        server = self.start_server(FakeBuildCache())
+        sock = socket.create_connection(server.server_address)
+        sock.sendall('http://example.com/a/target.apk enable_unittests\n')
+        reply = ''
+        while not reply.endswith('\n'):
+            data = sock.recv(1024)
+            if not data:
+                break
+            reply += data
+        sock.sendall('quit\n')
+        sock.close()
+        self.assertEqual(json.loads(reply)['metadata'],
+                         'http://example.com/a/target.apk')
+
+
+class BuildCachePeerTest(BuildServerTestCase):
+
+    url = 'https://example.com/pub/build/target.tests.zip'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.upstream = []
+        self.urlretrieve = utils.urlretrieve
+        utils.urlretrieve = self.fake_urlretrieve
+        self.fetch_from_peer = buildserver.fetch_from_peer
+
+    def tearDown(self):
+        utils.urlretrieve = self.urlretrieve
+        buildserver.fetch_from_peer = self.fetch_from_peer
+        shutil.rmtree(self.root)
+
+    def fake_urlretrieve(self, url, path):
+        self.upstream.append(url)
+        with open(path, 'wb') as f:
+            f.write('upstream')
+
+    def build_cache(self, name, peers=None):
+        cache_dir = os.path.join(self.root, name)
+        os.mkdir(cache_dir)
+        return builds.BuildCache(['mozilla-central'], ['opt'], 'fennec',
+                                 ['android-api-16'], '.apk',
+                                 cache_dir=cache_dir, peers=peers)
+
+    def start_peer(self, data):
+        """Start a peer build cache server whose cache contains data
+        for self.url and return (server, artifact path)."""
+        build_cache = self.build_cache('peer')
+        cache_build_dir = os.path.join(build_cache.cache_dir,
+                                       build_cache.build_dir_name(self.url))
+        os.makedirs(cache_build_dir)
+        path = os.path.join(cache_build_dir, 'target.tests.zip')
+        with open(path, 'wb') as f:
+            f.write(data)
+        build_cache.add_to_manifest(cache_build_dir, self.url, path)
+        return self.start_server(build_cache), path
+
+    def retrieve(self, build_cache, url):
+        path = os.path.join(self.root, 'retrieved')
+        build_cache.retrieve(url, path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_peer_hit(self):
+        data = os.urandom(3 * buildserver.CHUNK_SIZE + 17)
+        server, path = self.start_peer(data)
+        build_cache = self.build_cache('local',
+                                       peers=[server.server_address])
+        self.assertEqual(self.retrieve(build_cache, self.url), data)
+        self.assertEqual(self.upstream, [])
+
+    def test_peer_miss_falls_back_upstream(self):
+        server, path = self.start_peer('data')
+        build_cache = self.build_cache('local',
+                                       peers=[server.server_address])
+        self.assertEqual(self.retrieve(build_cache, self.url + '.missing'),
+                         'upstream')
+        self.assertEqual(self.upstream, [self.url + '.missing'])
+
+    def test_peer_mismatch_falls_back_upstream(self):
+        server, path = self.start_peer('data')
+        with open(path, 'r+b') as f:
+            f.write('D')
+        build_cache = self.build_cache('local',
+                                       peers=[server.server_address])
+        self.assertEqual(self.retrieve(build_cache, self.url), 'upstream')
+        self.assertEqual(self.upstream, [self.url])
+
+    def test_unreachable_peer_is_not_retried(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        address = listener.getsockname()
+        listener.close()
+        attempts = []
+
+        def fetch_from_peer(*args, **kwargs):
+            attempts.append(args[:2])
+            return self.fetch_from_peer(*args, **kwargs)
+        buildserver.fetch_from_peer = fetch_from_peer
+
+        build_cache = self.build_cache('local', peers=[address])
+        self.assertEqual(self.retrieve(build_cache, self.url), 'upstream')
+        self.assertEqual(self.retrieve(build_cache, self.url), 'upstream')
+        self.assertEqual(attempts, [address])
+        self.assertEqual(len(self.upstream), 2)
+
+    def test_peers_may_only_fetch(self):
+        server, path = self.start_peer('data')
+        is_local = buildserver.BuildCacheHandler.is_local
+        buildserver.BuildCacheHandler.is_local = lambda handler: False
+        try:
+            client = self.client(server)
+            result = client.get('https://example.com/pub/build/target.apk')
+        finally:
+            buildserver.BuildCacheHandler.is_local = is_local
+        self.assertFalse(result['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import metadataclient
+
+
+class MetadataCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = metadataclient.MetadataCache(
+            filename=os.path.join(self.root, 'metadata.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_fixtures(self, fixtures):
+        path = os.path.join(self.root, 'fixtures.json')
+        with open(path, 'w') as fixtures_file:
+            json.dump(fixtures, fixtures_file)
+        return path
+
+
+class MetadataCacheTest(MetadataCacheTestCase):
+
+    def test_load_fixtures(self):
+        self.cache.load(self.write_fixtures({
+            'task:abc': {'workerType': 'gecko-3-b-android'},
+            'url:http://example.com/a.json': [1, 2, 3],
+        }))
+        self.assertEqual(self.cache.get('task:abc'),
+                         (True, {'workerType': 'gecko-3-b-android'}))
+        self.assertEqual(self.cache.get('url:http://example.com/a.json'),
+                         (True, [1, 2, 3]))
+        self.assertEqual(self.cache.get('task:missing'), (False, None))
+
+    def test_dump_and_load(self):
+        self.cache.set('task:abc', {'workerType': 'buildbot'})
+        self.cache.set('index:expired', ['task'], ttl=-1)
+        path = os.path.join(self.root, 'dump.json')
+        self.cache.dump(path)
+        cache = metadataclient.MetadataCache(
+            filename=os.path.join(self.root, 'loaded.sqlite'))
+        cache.load(path)
+        self.assertEqual(cache.get('task:abc'), (True, {'workerType': 'buildbot'}))
+        self.assertEqual(cache.get('index:expired'), (False, None))
+
+    def test_ttl_and_purge(self):
+        self.cache.set('index:expired', ['task'], ttl=-1)
+        self.cache.set('index:current', ['task'], ttl=3600)
+        self.cache.set('task:forever', {})
+        self.assertEqual(self.cache.get('index:expired'), (False, None))
+        self.assertEqual(self.cache.get('index:current'), (True, ['task']))
+        self.cache.purge()
+        self.assertEqual([entry[0] for entry in self.cache.entries()],
+                         ['index:current', 'task:forever'])
+
+
+class MetadataClientTest(MetadataCacheTestCase):
+
+    def test_offline(self):
+        self.cache.load(self.write_fixtures({'task:abc': {'workerType': 'buildbot'}}))
+        client = metadataclient.MetadataClient(cache=self.cache, offline=True)
+
+        def fetch():
+            self.fail('offline lookups must not fetch')
+        self.assertEqual(client.lookup('task:abc', fetch), {'workerType': 'buildbot'})
+        self.assertEqual(client.lookup('task:missing', fetch), None)
+        self.assertEqual(client.task_definition('missing'), None)
+
+    def test_lookup_caches_values_but_not_none(self):
+        client = metadataclient.MetadataClient(cache=self.cache)
+        self.assertEqual(client.lookup('url:a', lambda: None), None)
+        self.assertEqual(self.cache.get('url:a'), (False, None))
+        self.assertEqual(client.lookup('url:a', lambda: 'a'), 'a')
+        self.assertEqual(client.lookup('url:a', lambda: 'b'), 'a')
+        self.assertEqual((client.hits, client.misses), (1, 2))
+
+    def run_concurrent_lookups(self, client, fetch, count=4):
+        """Look up the same key in count threads while fetch is blocked
+        and return the list of (value, exception) for each thread."""
+        results = []
+        lock = threading.Lock()
+
+        def lookup():
+            try:
+                value = client.lookup('url:a', fetch)
+                error = None
+            except Exception, e:
+                value = None
+                error = e
+            with lock:
+                results.append((value, error))
+
+        threads = [threading.Thread(target=lookup) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results
+
+    def test_concurrent_lookups_are_coalesced(self):
+        client = metadataclient.MetadataClient(cache=self.cache)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.5)
+            return 'a'
+        results = self.run_concurrent_lookups(client, fetch)
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [('a', None)] * 4)
+
+    def test_concurrent_lookup_exception_is_raised_in_each_thread(self):
+        client = metadataclient.MetadataClient(cache=self.cache)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.5)
+            raise ValueError('fetch failed')
+        results = self.run_concurrent_lookups(client, fetch)
+        self.assertEqual(calls, [1])
+        self.assertEqual(len(results), 4)
+        for value, error in results:
+            self.assertEqual(value, None)
+            self.assertTrue(isinstance(error, ValueError))
+        self.assertEqual(self.cache.get('url:a'), (False, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -244,8 +244,7 @@ class PerfTest(PhoneTest):
         # Create JSON to send to webserver
         author = None
         if self.build.tree == 'try':
-            rev_json_url = self.build.changeset.replace('/rev/', '/json-rev/')
-            rev_json = utils.get_remote_json(rev_json_url)
+            rev_json = utils.get_revision_json(self.build.changeset)
             if rev_json:
                 author = rev_json['pushuser']
 
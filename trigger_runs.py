@@ -8,8 +8,11 @@ import json
 import logging
 import logging.handlers
 import multiprocessing
+import os
+import re
 import socket
 import sys
+import time
 
 import builds
 import build_dates
@@ -18,6 +21,14 @@ import utils
 import pytz
 
 PACIFIC = pytz.timezone('US/Pacific')
+# Seconds to wait for more of a reply which has not been terminated by
+# an ok line.
+REPLY_TIMEOUT = 120
+
+
+class TriggerRunsError(Exception):
+    pass
+
 
 def command_str(build, test_names, devices):
     # Dates are not json serializable. We don't need the build date in
@@ -33,6 +44,80 @@ def command_str(build, test_names, devices):
     return s
 
 
+def read_reply(s):
+    """Read the Autophone server's reply to a command. Return
+    (reply, ok) where ok is True if the reply was terminated by an ok
+    line. Replies which are not terminated by ok, such as errors, are
+    complete when the server closes the connection or sends nothing
+    more for REPLY_TIMEOUT seconds."""
+    reply = ''
+    s.settimeout(REPLY_TIMEOUT)
+    try:
+        while True:
+            if reply.endswith('\n') and \
+               reply.rstrip('\n').split('\n')[-1].strip() == 'ok':
+                return reply.strip(), True
+            data = s.recv(1024)
+            if not data:
+                break
+            reply += data
+    except socket.timeout:
+        pass
+    finally:
+        s.settimeout(None)
+    return reply.strip(), False
+
+
+def send_command(s, c):
+    """Send the command c to the Autophone server and return True if
+    it replied ok."""
+    logger = utils.getLogger()
+    sc = '%s' % c
+    logger.info(sc)
+    print sc
+    s.sendall(c + '\n')
+    reply, ok = read_reply(s)
+    sr = '- %s' % reply
+    logger.info(sr)
+    print sr
+    return ok
+
+
+def jobs_pending(s):
+    """Return the number of jobs pending on the Autophone server's
+    devices."""
+    s.sendall('autophone-jobspending\n')
+    reply, ok = read_reply(s)
+    match = re.search(r'^pending: (\d+)$', reply, re.MULTILINE)
+    if not ok or not match:
+        raise TriggerRunsError('Unexpected reply to autophone-jobspending: %r' %
+                               reply)
+    return int(match.group(1))
+
+
+def wait_for_jobs(s, max_pending_jobs, poll_interval):
+    """Wait until fewer than max_pending_jobs jobs are pending so that
+    builds are triggered no faster than the devices complete their
+    jobs."""
+    logger = utils.getLogger()
+    while True:
+        pending = jobs_pending(s)
+        if pending < max_pending_jobs:
+            return
+        logger.info('%d jobs pending, waiting %d seconds...',
+                    pending, poll_interval)
+        time.sleep(poll_interval)
+
+
+def read_checkpoint(checkpoint):
+    """Return the set of build urls already triggered according to
+    the checkpoint file."""
+    if not checkpoint or not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint) as checkpoint_file:
+        return set(line.strip() for line in checkpoint_file if line.strip())
+
+
 def trigger_runs(args, options):
     # Attempt to connect to the Autophone server early, so we don't
     # waste time fetching builds if the server is not available.
@@ -86,6 +171,13 @@ def trigger_runs(args, options):
         product, build_platforms,
         buildfile_ext)
 
+    if options.stream:
+        find_builds_by_revision = cache.iter_builds_by_revision
+        find_builds_by_time = cache.iter_builds_by_time
+    else:
+        find_builds_by_revision = cache.find_builds_by_revision
+        find_builds_by_time = cache.find_builds_by_time
+
     matching_builds = []
     if options.build_url:
         logger.debug('cache.find_builds_by_directory(%s)', options.build_url)
@@ -94,7 +186,7 @@ def trigger_runs(args, options):
         logger.debug('cache.find_builds_by_revision(%s, %s, %s)',
                      options.first_revision, options.last_revision,
                      options.build_location)
-        matching_builds = cache.find_builds_by_revision(
+        matching_builds = find_builds_by_revision(
             options.first_revision, options.last_revision,
             options.build_location)
     elif args[0] == 'latest':
@@ -111,24 +203,44 @@ def trigger_runs(args, options):
                 end_time = datetime.datetime.now(tz=PACIFIC)
         logger.debug('cache.find_builds_by_time(%s, %s, %s)',
                      start_time, end_time, options.build_location)
-        matching_builds = cache.find_builds_by_time(
+        matching_builds = find_builds_by_time(
             start_time, end_time, options.build_location)
 
     if not matching_builds:
         return 1
-    commands = [command_str(b, options.test_names, options.devices)
-                for b in matching_builds]
-    commands.append('exit')
+    # When streaming, matching_builds is a generator and the builds
+    # are triggered as they are found.
+    triggered = read_checkpoint(options.checkpoint)
+    if triggered:
+        logger.info('Skipping %d builds already triggered according to %s',
+                    len(triggered), options.checkpoint)
+    found = False
     logger.info('- %s', s.recv(1024).strip())
-    for c in commands:
-        sc = '%s' % c
-        logger.info(sc)
-        print sc
-        s.sendall(c + '\n')
-        sr = '- %s' % s.recv(1024).strip()
-        logger.info(sr)
-        print sr
-    return 0
+    try:
+        for build in matching_builds:
+            found = True
+            build_url = build['url']
+            if build_url in triggered:
+                logger.info('Skipping %s already triggered', build_url)
+                continue
+            if options.max_pending_jobs:
+                wait_for_jobs(s, options.max_pending_jobs, options.poll_interval)
+            if not send_command(s, command_str(build, options.test_names,
+                                               options.devices)):
+                raise TriggerRunsError('%s was not triggered' % build_url)
+            if options.checkpoint:
+                with open(options.checkpoint, 'a') as checkpoint_file:
+                    checkpoint_file.write(build_url + '\n')
+            triggered.add(build_url)
+    except TriggerRunsError, e:
+        logger.error('%s. Stopping.', e)
+        print '%s. Stopping.' % e
+        return 1
+    send_command(s, 'exit')
+    if options.checkpoint and os.path.exists(options.checkpoint):
+        # The backfill has completed.
+        os.unlink(options.checkpoint)
+    return 0 if found else 1
 
 
 def main():
@@ -223,6 +335,27 @@ If "latest" is given, test runs are initiated for the most recent build.'''
                       action='append',
                       help='Device on which to run the job.  Defaults to all '
                       'if not specified. Can be specified multiple times.')
+    parser.add_option('--stream', action='store_true',
+                      dest='stream', default=False,
+                      help='trigger each build found by date or revision as soon'
+                      ' as it is found rather than after all of the builds have'
+                      ' been found.')
+    parser.add_option('--max-pending-jobs', action='store', type='int',
+                      dest='max_pending_jobs', default=0,
+                      help='wait before triggering each build until fewer than'
+                      ' this many jobs are pending on the devices.'
+                      ' Defaults to 0 which does not wait.')
+    parser.add_option('--poll-interval', action='store', type='int',
+                      dest='poll_interval', default=60,
+                      help='seconds to wait before checking the pending jobs'
+                      ' again when --max-pending-jobs is reached.'
+                      ' Defaults to 60.')
+    parser.add_option('--checkpoint', action='store', type='string',
+                      dest='checkpoint',
+                      help='file recording the urls of the triggered builds.'
+                      ' Builds recorded in the file are skipped so that an'
+                      ' interrupted run can be resumed by repeating it.'
+                      ' The file is removed when the run completes.')
     (options, args) = parser.parse_args()
     if len(args) > 2 or (options.first_revision and not options.last_revision) or \
        (options.build_url and len(args) > 0):
@@ -18,12 +18,15 @@ import traceback
 import urlparse
 import uuid
 
+from multiprocessing.pool import ThreadPool
+
 import requests
 
 import taskcluster
 
 import build_dates
 import builds
+import metadataclient
 
 from sensitivedatafilter import SensitiveDataFilter
 
@@ -88,24 +91,39 @@ def get_remote_text(url):
             with local_file:
                 return local_file.read()
 
-        while True:
-            r = requests.get(url, headers={'user-agent': 'autophone'})
-            if r.ok:
-                return r.text
-            elif r.status_code != 503:
-                logger.warning("Unable to open url %s : %s",
-                               url, r.reason)
-                return None
-            # Server is too busy. Wait and try again.
-            # See https://bugzilla.mozilla.org/show_bug.cgi?id=1146983#c10
-            logger.warning("HTTP 503 Server Too Busy: url %s", url)
-            time.sleep(60 + random.randrange(0, 30, 1))
+        r = get_remote_response(url)
+        if r.ok:
+            return r.text
+        logger.warning("Unable to open url %s : %s",
+                       url, r.reason)
+        return None
     except Exception:
         logger.exception('Unable to open %s', url)
 
     return None
 
 
+def get_remote_response(url, headers=None):
+    """Return the response to a GET request for a remote url, waiting
+    and retrying while the server responds HTTP 503 Server Too Busy.
+
+    :param url: url of content to be retrieved.
+    :param headers: optional dict of additional request headers.
+    """
+    logger = getLogger()
+    request_headers = {'user-agent': 'autophone'}
+    if headers:
+        request_headers.update(headers)
+    while True:
+        r = requests.get(url, headers=request_headers)
+        if r.status_code != 503:
+            return r
+        # Server is too busy. Wait and try again.
+        # See https://bugzilla.mozilla.org/show_bug.cgi?id=1146983#c10
+        logger.warning("HTTP 503 Server Too Busy: url %s", url)
+        time.sleep(60 + random.randrange(0, 30, 1))
+
+
 def get_remote_json(url):
     """Return the json representation of the contents of a remote url if
     the HTTP response code is 200, otherwise return None.
@@ -223,6 +241,9 @@ def get_build_data(build_url, builder_type='taskcluster'):
         task_id = match.group(1)
         logger.debug("get_build_data: taskId %s", task_id)
         task_definition = get_taskcluster_task_definition(task_id)
+        if not task_definition:
+            logger.warning('get_build_data: no task definition for %s', task_id)
+            return None
         build_data = get_build_data_from_taskcluster_task_definition(task_definition)
         if build_data:
             build_data['url'] = build_url
@@ -280,10 +301,18 @@ def get_build_data(build_url, builder_type='taskcluster'):
             logger.debug('get_build_data: platform: %s, abi: %s, sdk: %s, debug: %s',
                          platform, abi, sdk, debug)
 
+    if ftp_build:
+        # The metadata files of builds archived on ftp never change
+        # so they are kept in the metadata cache.
+        client = metadataclient.get_client()
+        fetch_json, fetch_text = client.get_json, client.get_text
+    else:
+        fetch_json, fetch_text = get_remote_json, get_remote_text
+
     build_prefix, build_ext = os.path.splitext(build_url)
 
     build_json_url = build_prefix + '.json'
-    build_json = get_remote_json(build_json_url)
+    build_json = fetch_json(build_json_url)
     if build_json:
         build_id = build_json['buildid']
         formatstr, build_date = build_dates.parse_datetime(build_id, tz=build_id_tz)
@@ -308,7 +337,7 @@ def get_build_data(build_url, builder_type='taskcluster'):
                      build_id, platform, abi, sdk, repo, revision, changeset)
     if build_type is None or sdk is None or nightly is None or platform is None:
         build_mozinfo_json_url = build_prefix + '.mozinfo.json'
-        build_mozinfo_json = get_remote_json(build_mozinfo_json_url)
+        build_mozinfo_json = fetch_json(build_mozinfo_json_url)
         if build_mozinfo_json:
             if not build_type and 'debug' in build_mozinfo_json:
                 build_type = 'debug' if build_mozinfo_json['debug'] else 'opt'
@@ -332,7 +361,7 @@ def get_build_data(build_url, builder_type='taskcluster'):
     if not build_id or not changeset or not repo or not revision:
         build_id_tz = build_dates.PACIFIC
         build_txt = build_prefix + '.txt'
-        content = get_remote_text(build_txt)
+        content = fetch_text(build_txt)
         if not content:
             return None
 
@@ -414,21 +443,102 @@ def get_build_data(build_url, builder_type='taskcluster'):
     return build_data
 
 
-def get_changeset_dirs(changeset_url, max_changesets=32):
+def get_diff_paths(url):
+    """Return the set of file paths named in the headers of the diff at
+    url or None if the diff could not be retrieved.
+
+    The diff is processed line by line as it is received and only the
+    file header lines are examined.
+    """
+    logger = getLogger()
+    try:
+        while True:
+            r = requests.get(url, headers={'user-agent': 'autophone'},
+                             stream=True)
+            if r.ok:
+                break
+            r.close()
+            if r.status_code != 503:
+                logger.warning("Unable to open url %s : %s",
+                               url, r.reason)
+                return None
+            # Server is too busy. Wait and try again.
+            # See https://bugzilla.mozilla.org/show_bug.cgi?id=1146983#c10
+            logger.warning("HTTP 503 Server Too Busy: url %s", url)
+            time.sleep(60 + random.randrange(0, 30, 1))
+        paths = set()
+        in_header = False
+        try:
+            for line in r.iter_lines(chunk_size=64*1024):
+                # Each file's header begins with a diff line and ends
+                # at its first hunk. The body lines are skipped.
+                if line.startswith('diff '):
+                    in_header = True
+                elif line.startswith('@@'):
+                    in_header = False
+                elif in_header and \
+                     (line.startswith('--- a/') or line.startswith('+++ b/')):
+                    # skip markers, space and leading slash
+                    paths.add(line[6:].rstrip())
+        finally:
+            r.close()
+        return paths
+    except Exception:
+        logger.exception('Unable to open %s', url)
+    return None
+
+
+def get_changed_dirs(revision_url):
+    """Return the sorted list of the directories changed by the
+    changeset at revision_url https://hg.mozilla.org/<repo>/rev/<changeset>
+    or None if the changed files could not be determined.
+
+    The files are taken from the json-rev metadata if it lists them,
+    otherwise from the headers of the raw diff. The result is cached
+    by changeset since it can never change.
+    """
+    def fetch():
+        paths = None
+        rev_json = get_revision_json(revision_url)
+        if rev_json and isinstance(rev_json.get('files'), list):
+            paths = set()
+            for entry in rev_json['files']:
+                if isinstance(entry, dict):
+                    entry = entry.get('file')
+                if entry:
+                    paths.add(entry)
+        if paths is None:
+            paths = get_diff_paths(revision_url.replace('/rev/', '/raw-rev/'))
+        if paths is None:
+            return None
+        # Note that if the changeset was due to a change in a top
+        # level file or tagging of a branch, then the directory will
+        # be empty which will result in all directory restricted
+        # tests running which is alright.
+        return sorted(set(os.path.dirname(path) for path in paths))
+
+    return metadataclient.get_client().lookup('changeset_dirs:%s' % revision_url,
+                                              fetch)
+
+
+def get_changeset_dirs(changeset_url, max_changesets=32, max_concurrent=8):
     """Return a list of the directories changed in this changeset.
 
     If the number of changesets exceeds max_changesets, return []
     which will match any directory defined for a test.
+
+    The changed directories of up to max_concurrent changesets are
+    looked up concurrently.
     """
     logger = getLogger()
     url = changeset_url.replace('rev/', 'json-pushes?changeset=')
-    pushlog = get_remote_json(url)
+    pushlog = metadataclient.get_client().get_json(url)
 
     if not pushlog:
         logger.debug('get_changeset_dirs: Could not find pushlog at %s', url)
         return []
 
-    dirs_set = set()
+    revision_urls = []
     for pushid in pushlog:
         logger.debug('get_changeset_dirs: %s: pushid %s', changeset_url, pushid)
         try:
@@ -449,34 +559,29 @@ def get_changeset_dirs(changeset_url, max_changesets=32):
             logger.debug('get_changeset_dirs: Exception getting changesets: %s',
                          traceback.format_exc())
             continue
-        base_url = os.path.dirname(changeset_url).replace('rev', 'raw-rev')
+        base_url = os.path.dirname(changeset_url)
         for changeset in changesets:
-            #TODO: When Bug 1286353 is fixed, use json-rev for this,
-            #      as this requires retrieving and scanning the whole
-            #      diff.
-            url = os.path.join(base_url, changeset)
-            logger.debug('get_changeset_dirs: diff url: %s', url)
-            diff = get_remote_text(url)
-            if diff:
-                for line in diff.splitlines():
-                    if line.startswith('#') or line.find('/dev/null') != -1:
-                        continue
-                    if line.startswith('+++ b/') or line.startswith('--- a/'):
-                        # skip markers, space and leading slash
-                        path = os.path.dirname(line[6:])
-                        # Note that if the changeset was due to a
-                        # change in a top level file or tagging of a
-                        # branch, then path will be empty which will
-                        # result in all directory restricted tests
-                        # running which is alright.
-                        dirs_set.add(path)
-            else:
-                logger.debug('get_changeset_dirs: Could not find diff for '
-                             'revision %s at %s', changeset, url)
-                # We return an empty list here to force the test to be
-                # run, in case the missing diff here contained files
-                # we care about.
-                return []
+            revision_urls.append(os.path.join(base_url, changeset))
+
+    if not revision_urls:
+        return []
+    pool = ThreadPool(min(max_concurrent, len(revision_urls)))
+    try:
+        changed_dirs = pool.map(get_changed_dirs, revision_urls)
+    finally:
+        pool.close()
+        pool.join()
+
+    dirs_set = set()
+    for revision_url, dirs in zip(revision_urls, changed_dirs):
+        if dirs is None:
+            logger.debug('get_changeset_dirs: Could not find changed files for '
+                         'revision %s', revision_url)
+            # We return an empty list here to force the test to be
+            # run, in case the missing diff here contained files
+            # we care about.
+            return []
+        dirs_set.update(dirs)
 
     dirs = list(dirs_set)
     logger.debug('get_changeset_dirs: %s', dirs)
@@ -604,9 +709,12 @@ def urlretrieve(url, dest, max_attempts=3):
 
 
 def get_taskcluster_task_definition(task_id):
-    queue = taskcluster.queue.Queue()
-    task_definition = queue.task(task_id)
-    return task_definition
+    return metadataclient.get_client().task_definition(task_id)
+
+
+def get_revision_json(changeset_url):
+    """Return the json-rev metadata for the hg changeset url or None."""
+    return metadataclient.get_client().revision(changeset_url)
 
 
 def taskcluster_artifacts(task_id, run_id):
@@ -24,8 +24,9 @@ import buildserver
 import jobs
 import utils
 from adb import ADBError, ADBTimeoutError
+from autophonelogserver import LogRecordSocketHandler
 from autophonetreeherder import AutophoneTreeherder
-from builds import BuildMetadata
+from builds import BuildCache, BuildMetadata
 from logdecorator import LogDecorator
 from phonestatus import PhoneStatus
 from phonetest import PhoneTest, TreeherderStatus, TestStatus, FLASH_PACKAGE
@@ -90,6 +91,8 @@ class PhoneWorker(object):
     PHONE_MAX_REBOOTS = 3
     PHONE_PING_INTERVAL = 15*60
     PHONE_COMMAND_QUEUE_TIMEOUT = 10
+    DEVICE_REBOOT_INTERVAL = 10
+    DEVICE_MIN_FREE_SPACE = 500
 
     def __init__(self,
                  dm,
@@ -98,13 +101,17 @@ class PhoneWorker(object):
                  options,
                  autophone_queue,
                  loglevel,
-                 mailer):
+                 mailer,
+                 heartbeat_table,
+                 heartbeat_slot):
 
         self.state = ProcessStates.STARTING
         self.tests = tests
         self.dm = dm
         self.phone = phone
         self.options = options
+        self.heartbeat_table = heartbeat_table
+        self.heartbeat_slot = heartbeat_slot
         self.last_status_msg = None
         self.first_status_of_type = None
         self.last_status_of_previous_type = None
@@ -196,21 +203,54 @@ class PhoneWorker(object):
            msg.phone_status != self.last_status_msg.phone_status:
             self.last_status_of_previous_type = self.last_status_msg
             self.first_status_of_type = msg
-        if msg.message == 'Heartbeat':
-            self.last_status_msg.timestamp = msg.timestamp
-        else:
-            self.loggerdeco.debug('PhoneWorker:process_msg: %s', msg)
-            self.last_status_msg = msg
+        self.loggerdeco.debug('PhoneWorker:process_msg: %s', msg)
+        self.last_status_msg = msg
+
+    def last_heartbeat(self):
+        """Return (timestamp, phone_status) from the worker's last
+        heartbeat or status update, or (None, None) if it has not
+        reported yet."""
+        return self.heartbeat_table.read(self.heartbeat_slot)
+
+    def snapshot(self):
+        """Return a PhoneWorkerStatus snapshot of the worker's current
+        status."""
+        return PhoneWorkerStatus(self)
+
+    def status(self):
+        return self.snapshot().status()
+
+class PhoneWorkerStatus(object):
+    """Snapshot of a PhoneWorker's status taken in the main process.
+
+    The snapshot is not modified after it is created, so that it can be
+    used to report the status without holding the AutoPhone lock.
+    The PhoneTestMessages it refers to are replaced rather than
+    modified by PhoneWorker.process_msg.
+    """
+    def __init__(self, worker):
+        self.phone = worker.phone
+        self.state = worker.state
+        self.debug = worker.options.debug
+        self.heartbeat_table = worker.heartbeat_table
+        self.heartbeat_slot = worker.heartbeat_slot
+        self.last_status_msg = worker.last_status_msg
+        self.first_status_of_type = worker.first_status_of_type
+        self.last_status_of_previous_type = worker.last_status_of_previous_type
 
     def status(self):
         response = ''
         now = datetime.datetime.now(tz=pytz.utc).replace(microsecond=0)
         response += 'phone %s (%s):\n' % (self.phone.id, self.phone.serial)
         response += '  state %s\n' % self.state
-        response += '  debug level %d\n' % self.options.debug
+        response += '  debug level %d\n' % self.debug
         if not self.last_status_msg:
             response += '  no updates\n'
         else:
+            last_update = self.last_status_msg.timestamp
+            heartbeat = self.heartbeat_table.read(self.heartbeat_slot)[0]
+            if heartbeat and heartbeat > last_update:
+                last_update = heartbeat
             if self.last_status_msg.build and self.last_status_msg.build.id:
                 d = self.last_status_msg.build.id
                 d = '%s-%s-%s %s:%s:%s' % (d[0:4], d[4:6], d[6:8],
@@ -221,7 +261,7 @@ class PhoneWorker(object):
             else:
                 response += '  no build loaded\n'
             response += '  last update %s ago:\n    %s\n' % (
-                now - self.last_status_msg.timestamp,
+                now - last_update,
                 self.last_status_msg.short_desc())
             response += '  %s for %s\n' % (
                 self.last_status_msg.phone_status,
@@ -433,6 +473,18 @@ class PhoneWorkerSubProcess(object):
         self.build = None
         self.last_ping = None
         self.phone_status = None
+        # Number of builds installed since the device was last
+        # rebooted. None if the device has not been rebooted by this
+        # worker.
+        self.installs_since_reboot = None
+        # The build_url of the build which was left installed on the
+        # device after its job completed so that it can be reused by
+        # the next job for the same build.
+        self.installed_build_url = None
+        self.reboot_metrics = {'installs': 0,
+                               'reboots_skipped': 0,
+                               'reboots': 0,
+                               'reboot_seconds': 0.0}
         self.s3_bucket = None
         self.treeherder = None
         self.logcat = None
@@ -536,15 +588,21 @@ class PhoneWorkerSubProcess(object):
         phone_message = PhoneTestMessage(self.phone, build=build,
                                          phone_status=self.phone_status,
                                          message=message)
-        if message != 'Heartbeat':
-            self.loggerdeco.info(str(phone_message))
+        self.loggerdeco.info(str(phone_message))
+        self.heartbeat(timestamp=phone_message.timestamp)
         try:
             self.autophone_queue.put_nowait(phone_message)
         except Queue.Full:
             self.loggerdeco.warning('Autophone queue is full!')
 
-    def heartbeat(self):
-        self.update_status(message='Heartbeat')
+    def heartbeat(self, timestamp=None):
+        """Record that the worker is alive in its slot in the shared
+        heartbeat table. Only changes in status are sent to the main
+        process via the autophone_queue."""
+        self.parent_worker.heartbeat_table.update(
+            self.parent_worker.heartbeat_slot,
+            self.phone_status,
+            timestamp=timestamp)
 
     def flush_log(self):
         # All worker subprocess logging IO will occur only on
@@ -572,15 +630,15 @@ class PhoneWorkerSubProcess(object):
         """
         self.loggerdeco.debug('Checking path %s.', path)
         d = posixpath.join(path, 'autophone_check_path')
-        self.dm.rm(d, recursive=True, force=True, root=True)
-        self.dm.mkdir(d, parents=True, root=True)
-        self.dm.chmod(d, recursive=True, root=True)
         with tempfile.NamedTemporaryFile() as tmp:
             tmp.write('autophone test\n')
             tmp.flush()
-            self.dm.push(tmp.name,
-                         posixpath.join(d, 'path_check'))
-        self.dm.rm(d, recursive=True, root=True)
+            with self.dm.batch(root=True) as b:
+                b.rm(d, recursive=True, force=True)
+                b.mkdir(d, parents=True)
+                b.chmod(d, recursive=True)
+                b.push(tmp.name, posixpath.join(d, 'path_check'))
+                b.rm(d, recursive=True)
 
     def start_usbwatchdog(self):
         try:
@@ -608,6 +666,7 @@ class PhoneWorkerSubProcess(object):
     def reboot(self):
         self.loggerdeco.info('reboot')
         self.update_status(phone_status=PhoneStatus.REBOOTING)
+        start_time = time.time()
         self.dm.reboot()
         self.disable_chatty()
         # Setting svc power stayon true after rebooting is necessary
@@ -615,6 +674,108 @@ class PhoneWorkerSubProcess(object):
         # case for the optional usbwatchdog service.
         self.dm.power_on()
         self.start_usbwatchdog()
+        self.installs_since_reboot = 0
+        self.reboot_metrics['reboots'] += 1
+        self.reboot_metrics['reboot_seconds'] += time.time() - start_time
+
+    @staticmethod
+    def parse_df_free(output):
+        """Return the free space in bytes reported by df for a single
+        file system or None if the output is not recognized."""
+        lines = output.strip().splitlines()
+        if len(lines) < 2:
+            return None
+        header = lines[0].split()
+        columns = [column.lower() for column in header]
+        if 'free' in columns:
+            index = columns.index('free')
+        elif 'available' in columns:
+            index = columns.index('available')
+        else:
+            return None
+        # Long file system names may cause the values to be wrapped
+        # onto the following line.
+        values = ' '.join(lines[1:]).split()
+        if len(values) <= index:
+            return None
+        match = re.match(r'^([\d.]+)([KMGT]?)$', values[index])
+        if not match:
+            return None
+        # Values without units are in 1K blocks.
+        multiplier = 1024 ** (' KMGT'.index(match.group(2) or 'K'))
+        return int(float(match.group(1)) * multiplier)
+
+    def check_device_clean(self):
+        """Inspect the device before installing a build.
+
+        Returns (reasons, packages) where reasons is a list of the
+        reasons the device must be rebooted before the install, which
+        is empty if the device is clean, and packages is the list of
+        previously installed packages which must be uninstalled.
+
+        The installed packages, the running processes, the free space
+        on /data and the test root are checked with a single adb call.
+        """
+        reasons = []
+        if self.installs_since_reboot is None:
+            reasons.append('not rebooted since the worker started')
+        elif (self.options.device_reboot_interval and
+              self.installs_since_reboot >= self.options.device_reboot_interval):
+            reasons.append('%d installs since the last reboot' %
+                           self.installs_since_reboot)
+        ps = self.dm.get_ps_command()
+        with self.dm.batch() as b:
+            packages_result = b.shell('pm list packages', check=False)
+            ps_result = b.shell(ps, check=False)
+            df_result = b.shell('df /data', check=False)
+            test_root_result = b.is_dir(self.dm.test_root)
+        package_re = re.compile(r'^(org\.mozilla\..*(fennec|firefox|geckoview).*|%s)$' %
+                                re.escape(FLASH_PACKAGE))
+        if not packages_result.ok:
+            raise ADBError('Unable to list packages: %s' % packages_result.output)
+        packages = []
+        for line in packages_result.output.splitlines():
+            package = line.strip().replace('package:', '')
+            if package_re.match(package):
+                packages.append(package)
+        leftover = set()
+        for line in (ps_result.output or '').splitlines()[1:]:
+            fields = line.split()
+            if fields and package_re.match(fields[-1].split(':')[0]):
+                leftover.add(fields[-1])
+        if leftover:
+            reasons.append('processes still running: %s' %
+                           ', '.join(sorted(leftover)))
+        free = self.parse_df_free(df_result.output or '')
+        if free is None:
+            reasons.append('unable to determine free space on /data')
+        elif free < self.options.device_min_free_space * 1024 * 1024:
+            reasons.append('%d MB free on /data' % (free / (1024 * 1024)))
+        if not test_root_result.value:
+            reasons.append('test root %s is not accessible' %
+                           self.dm.test_root)
+        return reasons, packages
+
+    def is_build_cached(self, build_url):
+        """Return True if build_url does not need to be downloaded to
+        the build cache before it is installed."""
+        if self.options.override_build_dir:
+            return True
+        return BuildCache.is_cached(self.options.cache_dir, build_url)
+
+    def log_reboot_metrics(self, reasons):
+        metrics = self.reboot_metrics
+        if metrics['reboots']:
+            reboot_seconds = metrics['reboot_seconds'] / metrics['reboots']
+        else:
+            reboot_seconds = 0
+        self.loggerdeco.info(
+            'Reboot %s: %s. Reboots avoided for %d of %d installs, '
+            'average reboot %d seconds, estimated time saved %d seconds.',
+            'required' if reasons else 'skipped',
+            '; '.join(reasons) if reasons else 'device is clean',
+            metrics['reboots_skipped'], metrics['installs'],
+            reboot_seconds, metrics['reboots_skipped'] * reboot_seconds)
 
     def disable_phone(self, errmsg, send_email=True):
         """Completely disable phone. No further attempts to recover it will
@@ -822,6 +983,8 @@ class PhoneWorkerSubProcess(object):
         self.loggerdeco.info('Installing build %s.', self.build.id)
         # Record start time for the install so can track how long this takes.
         start_time = datetime.datetime.now(tz=pytz.utc)
+        # Seconds spent in each phase of the install.
+        phases = {}
         message = ''
         for attempt in range(1, self.options.phone_retry_limit+1):
             uninstalled = False
@@ -831,16 +994,38 @@ class PhoneWorkerSubProcess(object):
                 # Uninstall all org.mozilla.(fennec|firefox|geckoview) packages
                 # to make sure there are no previous installations of
                 # different versions of fennec which may interfere
-                # with the test.
-                mozilla_packages = [
-                    p.replace('package:', '') for p in
-                    self.dm.shell_output("pm list package org.mozilla").split()
-                    if re.match('package:.*(fennec|firefox|geckoview)', p)]
-                for p in mozilla_packages:
-                    self.dm.uninstall_app(p)
-                if self.dm.is_app_installed(FLASH_PACKAGE):
-                    self.dm.uninstall_app(FLASH_PACKAGE)
-                self.reboot()
+                # with the test. Only reboot if the device is not
+                # clean or it has not been rebooted recently.
+                phase_start = time.time()
+                reasons, packages = self.check_device_clean()
+                # Keep the build if it was left installed by the
+                # previous job for the same build and the device does
+                # not need to be rebooted.
+                reuse = (not reasons and
+                         self.installed_build_url == job['build_url'] and
+                         self.build.app_name in packages)
+                self.installed_build_url = None
+                for p in packages:
+                    if not reuse or p != self.build.app_name:
+                        self.dm.uninstall_app(p)
+                phases['clean'] = round(time.time() - phase_start, 1)
+                if reuse:
+                    self.installed_build_url = job['build_url']
+                    self.loggerdeco.info('Reusing installed build %s. '
+                                         'Elapsed time: %s phases: %s',
+                                         job['build_url'],
+                                         datetime.datetime.now(tz=pytz.utc) - start_time,
+                                         phases)
+                    return {'success': True, 'message': ''}
+                if reasons:
+                    phase_start = time.time()
+                    self.reboot()
+                    phases['reboot'] = round(time.time() - phase_start, 1)
+                else:
+                    self.reboot_metrics['reboots_skipped'] += 1
+                self.reboot_metrics['installs'] += 1
+                self.installs_since_reboot += 1
+                self.log_reboot_metrics(reasons)
                 uninstalled = True
                 break
             except ADBError, e:
@@ -873,9 +1058,12 @@ class PhoneWorkerSubProcess(object):
                 break
             try:
                 self.dm.install_app(self.build.apk)
+                self.installed_build_url = job['build_url']
                 stop_time = datetime.datetime.now(tz=pytz.utc)
-                self.loggerdeco.info('Install build %s elapsed time: %s',
-                                     job['build_url'], stop_time - start_time)
+                phases.update(self.dm.install_timings)
+                self.loggerdeco.info('Install build %s elapsed time: %s phases: %s',
+                                     job['build_url'], stop_time - start_time,
+                                     phases)
                 return {'success': True, 'message': ''}
             except ADBError, e:
                 message = 'Exception installing fennec attempt %d!\n\n%s' % (
@@ -896,6 +1084,8 @@ class PhoneWorkerSubProcess(object):
 
     def run_tests(self, job):
         """Install build, run tests, report results and uninstall build.
+        If build affinity is enabled and other jobs for the same build
+        are pending, the build is left installed for them.
         Returns True if the caller should call job_completed to remove
         the job from the jobs database.
 
@@ -1042,7 +1232,16 @@ class PhoneWorkerSubProcess(object):
 
             self.update_status(message='Test Complete')
 
+        if self.options.build_affinity_max_age and \
+           self.jobs.jobs_pending(device=self.phone.id,
+                                  build_url=job['build_url'],
+                                  exclude_job_id=job['id']):
+            # Leave the build installed for the next job which uses it.
+            self.loggerdeco.info('Keeping build %s installed for pending jobs.',
+                                 job['build_url'])
+            return True
         try:
+            self.installed_build_url = None
             if self.is_ok():
                 self.dm.uninstall_app(self.build.app_name)
         except:
@@ -1270,7 +1469,28 @@ class PhoneWorkerSubProcess(object):
                     # before attempting to get the next message.
                     time.sleep(60)
                 else:
-                    job = self.jobs.get_next_job(lifo=self.options.lifo, worker=self)
+                    job = self.jobs.get_next_job(
+                        lifo=self.options.lifo,
+                        worker=self,
+                        affinity_max_age=self.options.build_affinity_max_age,
+                        installed_build_url=self.installed_build_url,
+                        is_build_cached=self.is_build_cached,
+                        steal_age=self.options.device_pool_steal_age)
+                    if job and job['claimed_from']:
+                        # Resubmit the pending tests so that Treeherder
+                        # shows the device which claimed the job.
+                        self.loggerdeco.info('Claimed job %s from %s.',
+                                             job['build_url'], job['claimed_from'])
+                        self.treeherder.submit_pending(self.phone.id,
+                                                       job['build_url'],
+                                                       job['tree'],
+                                                       job['revision'],
+                                                       job['build_type'],
+                                                       job['build_abi'],
+                                                       job['build_platform'],
+                                                       job['build_sdk'],
+                                                       job['builder_type'],
+                                                       tests=job['tests'])
                     if job:
                         if not self.is_disabled():
                             self.handle_job(job)
@@ -1326,9 +1546,9 @@ class PhoneWorkerSubProcess(object):
         sys.stdout = file(self.outfile, 'a', 0)
         sys.stderr = sys.stdout
 
-        # use a socket handler to send the log to the main process
-        # logging server.
-        socket_handler = logging.handlers.SocketHandler(
+        # use a socket handler to send batches of log records to the
+        # main process logging server.
+        socket_handler = LogRecordSocketHandler(
             'localhost',
             logging.handlers.DEFAULT_TCP_LOGGING_PORT)
 
@@ -0,0 +1,231 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Access to cached files without copying their contents through
+Python.
+
+send_file() streams a file to a socket using the sendfile system
+call where it is available, so that the kernel copies the file's
+pages directly to the socket, and otherwise falls back to reading and
+sending the file in chunks. mapped() maps a file into memory so that
+it can be passed to consumers such as zlib as a single buffer.
+
+Running this module benchmarks the host CPU time used per GB sent
+over a loopback socket by each method.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import select
+import socket
+
+CHUNK_SIZE = 64 * 1024
+# Limit each sendfile call so that large files do not monopolize the
+# socket and so that count fits in a 32 bit size_t.
+MAX_SENDFILE_COUNT = 0x7ffff000
+
+
+def _load_sendfile():
+    if not os.uname()[0] == 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    func = getattr(libc, 'sendfile64', None) or getattr(libc, 'sendfile', None)
+    if func is None:
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_sendfile = _load_sendfile()
+HAVE_SENDFILE = _sendfile is not None
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Send at most count bytes of in_fd starting at offset to out_fd.
+    Return the number of bytes sent. Raises OSError if sendfile is not
+    available or fails."""
+    if not HAVE_SENDFILE:
+        raise OSError(errno.ENOSYS, 'sendfile is not available')
+    c_offset = ctypes.c_int64(offset)
+    sent = _sendfile(out_fd, in_fd, ctypes.byref(c_offset),
+                     min(count, MAX_SENDFILE_COUNT))
+    if sent < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return sent
+
+
+def _send_chunks(sock, file_obj, offset, size):
+    file_obj.seek(offset)
+    while size:
+        data = file_obj.read(min(size, CHUNK_SIZE))
+        if not data:
+            raise IOError(errno.EIO, 'unexpected end of file %s' % file_obj.name)
+        sock.sendall(data)
+        size -= len(data)
+
+
+def send_file(sock, file_obj, size, offset=0, use_sendfile=True):
+    """Send size bytes of the open file file_obj starting at offset to
+    the connected socket sock. The file's contents are sent by the
+    kernel with sendfile if possible, otherwise they are read and sent
+    in chunks."""
+    if not use_sendfile or not HAVE_SENDFILE:
+        _send_chunks(sock, file_obj, offset, size)
+        return
+    timeout = sock.gettimeout()
+    out_fd = sock.fileno()
+    in_fd = file_obj.fileno()
+    while size:
+        try:
+            sent = sendfile(out_fd, in_fd, offset, size)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                # The socket has a timeout and is non-blocking.
+                if not select.select([], [out_fd], [], timeout)[1]:
+                    raise socket.timeout('timed out')
+                continue
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno in (errno.EINVAL, errno.ENOSYS):
+                # The file or socket does not support sendfile.
+                _send_chunks(sock, file_obj, offset, size)
+                return
+            raise socket.error(e.errno, e.strerror)
+        if sent == 0:
+            raise IOError(errno.EIO, 'unexpected end of file %s' % file_obj.name)
+        offset += sent
+        size -= sent
+
+
+@contextlib.contextmanager
+def mapped(path):
+    """Yield a read only memory map of the file path. Empty files,
+    which can not be mapped, are yielded as an empty string."""
+    with open(path, 'rb') as file_obj:
+        if os.fstat(file_obj.fileno()).st_size == 0:
+            yield ''
+            return
+        mapping = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapping
+        finally:
+            mapping.close()
+
+
+def _receive(port, conn):
+    sock = socket.create_connection(('127.0.0.1', port))
+    received = 0
+    buf = bytearray(1024 * 1024)
+    while True:
+        count = sock.recv_into(buf)
+        if not count:
+            break
+        received += count
+    sock.close()
+    conn.send(received)
+
+
+def _benchmark(path, size, use_sendfile):
+    import multiprocessing
+    import resource
+    import time
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    receiver = multiprocessing.Process(target=_receive,
+                                       args=(listener.getsockname()[1],
+                                             child_conn))
+    receiver.start()
+    sock, _ = listener.accept()
+    listener.close()
+    # The receiver runs in a separate process so that only the CPU
+    # used to send the file is measured.
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.time()
+    with open(path, 'rb') as file_obj:
+        send_file(sock, file_obj, size, use_sendfile=use_sendfile)
+    sock.close()
+    elapsed = time.time() - start_time
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    received = parent_conn.recv()
+    receiver.join()
+    if received != size:
+        raise IOError(errno.EIO, 'sent %d bytes, received %d' % (size, received))
+    cpu = ((end_usage.ru_utime - start_usage.ru_utime) +
+           (end_usage.ru_stime - start_usage.ru_stime))
+    return cpu, elapsed
+
+
+def main():
+    import tempfile
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.set_usage("""
+    usage: %prog [options]
+
+    Measure the host CPU time used per GB to send a file over a loopback
+    socket with sendfile and with reads and sends.""")
+    parser.add_option('--file',
+                      dest='path',
+                      action='store',
+                      type='string',
+                      default=None,
+                      help='File to send, for example a cached build. '
+                      'Defaults to a temporary file of --size-mb megabytes.')
+    parser.add_option('--size-mb',
+                      dest='size_mb',
+                      action='store',
+                      type='int',
+                      default=512,
+                      help='Size of the temporary file. Defaults to 512.')
+    parser.add_option('--repeat',
+                      dest='repeat',
+                      action='store',
+                      type='int',
+                      default=3,
+                      help='Number of times to send the file with each '
+                      'method. The best time is reported. Defaults to 3.')
+    (options, args) = parser.parse_args()
+
+    path = options.path
+    tmpf = None
+    if not path:
+        tmpf = tempfile.NamedTemporaryFile(delete=False)
+        chunk = os.urandom(1024 * 1024)
+        for i in range(options.size_mb):
+            tmpf.write(chunk)
+        tmpf.close()
+        path = tmpf.name
+    try:
+        size = os.path.getsize(path)
+        gb = size / float(1024 ** 3)
+        methods = [('read/send', False)]
+        if HAVE_SENDFILE:
+            methods.append(('sendfile', True))
+        else:
+            print 'sendfile is not available on this host.'
+        for name, use_sendfile in methods:
+            results = [_benchmark(path, size, use_sendfile)
+                       for i in range(options.repeat)]
+            cpu, elapsed = min(results)
+            print '%-10s %6.3f cpu s/GB %8.1f MB/s' % (
+                name, cpu / gb, size / elapsed / (1024 ** 2) if elapsed else 0)
+    finally:
+        if tmpf:
+            os.unlink(tmpf.name)
+
+if __name__ == '__main__':
+    main()